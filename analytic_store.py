@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# analytic_store.py from https://github.com/sgofferj/python-sentinel-pipeline
+#
+# Copyright Stefan Gofferje
+#
+# Licensed under the Gnu General Public License Version 3 or higher (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+
+"""
+Storage encodings and readers of the analytic outputs.
+Indices are stored as float32, as half floats or as int16 fixed point, S1 sigma0 as
+float32 or as dB-quantized int16. Scale, offset and unit are recorded per band by GDAL,
+so readers decode every encoding back to the original float32 values. S2 indices can also
+go into one multi-band cube per scene, from which fusion reads all layers in one block read.
+"""
+
+import contextlib
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import rasterio as rio
+
+import constants as c
+
+# Name suffix of the per-scene S2 index cube
+CUBE_SUFFIX: str = "-INDICES"
+
+# Stored type, scale factor, add offset and creation options of every encoding
+INDEX_ENCODINGS: Dict[str, Dict[str, Any]] = {
+    "float32": {"dtype": "float32", "scale": 1.0, "offset": 0.0, "options": {}},
+    # Half floats (GTiff NBITS=16), GDAL expands them to float32 on read
+    "float16": {"dtype": "float32", "scale": 1.0, "offset": 0.0, "options": {"nbits": 16}},
+    # Fixed point with a resolution of 1e-4, [-1, 1] -> [-10000, 10000]
+    "int16": {"dtype": "int16", "scale": 1e-4, "offset": 0.0, "options": {"predictor": 2}},
+}
+
+# Encodings of the S1 sigma0 outputs (linear power, 0 = no data)
+SIGMA0_ENCODINGS: Dict[str, Dict[str, Any]] = {
+    "float32": INDEX_ENCODINGS["float32"],
+    # Half floats would flush the 1e-9 noise floor to 0 (no data), sigma0 stays float32
+    "float16": INDEX_ENCODINGS["float32"],
+    # dB with a resolution of 0.01 dB; 0 dB is a valid value, so no data gets its own code
+    "int16": {
+        "dtype": "int16",
+        "scale": 0.01,
+        "offset": 0.0,
+        "db": True,
+        "options": {"predictor": 2, "nodata": -32768},
+    },
+}
+
+
+def index_encoding() -> Dict[str, Any]:
+    """Encoding of the S2 index outputs selected by ANALYTIC_DTYPE."""
+    return INDEX_ENCODINGS.get(c.ANALYTIC_DTYPE, INDEX_ENCODINGS["float32"])
+
+
+def sigma0_encoding() -> Dict[str, Any]:
+    """Encoding of the S1 sigma0 outputs selected by ANALYTIC_DTYPE."""
+    return SIGMA0_ENCODINGS.get(c.ANALYTIC_DTYPE, SIGMA0_ENCODINGS["float32"])
+
+
+def encoded_profile(profile: Dict[str, Any], encoding: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns a copy of a float32 output profile storing the given encoding."""
+    profile = profile.copy()
+    profile.update(dtype=encoding["dtype"], **encoding["options"])
+    return profile
+
+
+def set_scaling(dst: Any, encoding: Dict[str, Any]) -> None:
+    """Records scale, offset and unit of an encoding on every band of an open output."""
+    if encoding["scale"] != 1.0 or encoding["offset"] != 0.0:
+        dst.scales = (encoding["scale"],) * dst.count
+        dst.offsets = (encoding["offset"],) * dst.count
+    if encoding.get("db"):
+        dst.units = ("dB",) * dst.count
+
+
+def encode(values: np.ndarray, out: np.ndarray, encoding: Dict[str, Any], work: np.ndarray) -> np.ndarray:
+    """Encodes float32 values into out, using the float32 buffer work for integer types."""
+    if out.dtype.kind == "f":
+        np.copyto(out, values)
+        return out
+    info = np.iinfo(out.dtype)
+    nodata = values <= 0 if encoding.get("db") else None
+    if nodata is not None:
+        # Linear power to dB, no data is coded separately below
+        np.maximum(values, 1e-30, out=work)
+        np.log10(work, out=work)
+        work *= 10
+        values = work
+    np.subtract(values, encoding["offset"], out=work)
+    np.divide(work, encoding["scale"], out=work)
+    np.rint(work, out=work)
+    np.clip(work, info.min + 1, info.max, out=work)
+    np.copyto(out, work, casting="unsafe")
+    if nodata is not None:
+        np.copyto(out, encoding["options"]["nodata"], where=nodata)
+    return out
+
+
+def decode(
+    data: np.ndarray, scale: float, offset: float, nodata: Optional[float] = None, db: bool = False
+) -> np.ndarray:
+    """
+    Decodes stored values to float32 (a no-op for unscaled float data).
+    dB layers are converted back to linear power, stored no data decodes to 0.
+    """
+    if data.dtype == np.float32 and scale == 1.0 and offset == 0.0 and not db:
+        return data
+    res = data.astype(np.float32)
+    if scale != 1.0:
+        res *= np.float32(scale)
+    if offset != 0.0:
+        res += np.float32(offset)
+    if db:
+        res /= 10
+        np.power(np.float32(10), res, out=res)
+    if nodata is not None:
+        res[data == nodata] = 0
+    return res
+
+
+def cube_name(name: str) -> str:
+    """Output name (without .tif) of the S2 index cube of a scene."""
+    return os.path.join(c.DIRS["ANA_S2_CUBE"], f"{name}{CUBE_SUFFIX}")
+
+
+def s2_index_path(name: str, index: str) -> str:
+    """Path of one S2 index of a scene: its own file, or the cube if only that exists."""
+    single = os.path.join(c.DIRS[f"ANA_S2_{index}"], f"{name}-{index}.tif")
+    cube = cube_name(name) + ".tif"
+    if os.path.exists(single) or not os.path.exists(cube):
+        return single
+    return cube
+
+
+def layer_band(src: rio.DatasetReader, layer: str) -> int:
+    """Band number of a named layer: matched by band description, or band 1 of single-band files."""
+    if layer in src.descriptions:
+        return src.descriptions.index(layer) + 1
+    if src.count == 1:
+        return 1
+    raise ValueError(f"{os.path.basename(src.name)} has no {layer} band")
+
+
+class LayerReader:
+    """
+    Reads named analytic layers of a scene as decoded float32 blocks.
+    Layers sharing a file (the bands of a cube) are read together in one call.
+    """
+
+    def __init__(self, paths: Dict[str, str]) -> None:
+        self._stack = contextlib.ExitStack()
+        self.files: Dict[str, rio.DatasetReader] = {}
+        self.layers: Dict[str, List[Tuple[str, int]]] = {}
+        try:
+            for layer, path in paths.items():
+                if path not in self.files:
+                    self.files[path] = self._stack.enter_context(rio.open(path))
+                    self.layers[path] = []
+                self.layers[path].append((layer, layer_band(self.files[path], layer)))
+        except Exception:
+            self._stack.close()
+            raise
+
+    def read(self, bounds: Tuple[float, float, float, float], shape: Tuple[int, int]) -> Dict[str, np.ndarray]:
+        """Reads every layer over the given bounds, resampled to shape (height, width)."""
+        res = {}
+        for path, src in self.files.items():
+            bands = [b for _, b in self.layers[path]]
+            data = src.read(bands, window=src.window(*bounds), out_shape=(len(bands), *shape))
+            for k, (layer, b) in enumerate(self.layers[path]):
+                res[layer] = decode(
+                    data[k],
+                    src.scales[b - 1],
+                    src.offsets[b - 1],
+                    src.nodatavals[b - 1],
+                    src.units[b - 1] == "dB",
+                )
+        return res
+
+    def close(self) -> None:
+        """Closes all files."""
+        self._stack.close()
+
+    def __enter__(self) -> "LayerReader":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+
+if __name__ == "__main__":
+    pass
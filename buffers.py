@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# buffers.py from https://github.com/sgofferj/python-sentinel-pipeline
+#
+# Copyright Stefan Gofferje
+#
+# Licensed under the Gnu General Public License Version 3 or higher (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+
+"""
+Preallocated block buffers for the macro-block renderers.
+A pool of buffer sets sized from c.BLOCK_SIZE is rotated through the reader, compute
+and writer stages, so steady-state rendering allocates nothing per block and peak
+memory is fixed by the number of slots.
+"""
+
+import queue
+from typing import Dict, Tuple, Union
+
+import numpy as np
+
+import constants as c
+
+# name -> (bands, dtype)
+BufferSpec = Dict[str, Tuple[int, Union[str, type, np.dtype]]]
+
+
+class BlockBuffers:
+    """One set of named buffers large enough for a full render block."""
+
+    def __init__(self, specs: BufferSpec, block_size: int = c.BLOCK_SIZE) -> None:
+        self.bands: Dict[str, int] = {name: bands for name, (bands, _) in specs.items()}
+        # Flat storage so that views of edge blocks stay C-contiguous
+        self._flat: Dict[str, np.ndarray] = {
+            name: np.empty(bands * block_size * block_size, dtype=dtype)
+            for name, (bands, dtype) in specs.items()
+        }
+
+    def get(self, name: str, height: int, width: int) -> np.ndarray:
+        """Returns a (height, width) or (bands, height, width) view of a buffer."""
+        bands = self.bands[name]
+        shape = (height, width) if bands == 1 else (bands, height, width)
+        return self._flat[name][: bands * height * width].reshape(shape)
+
+    @property
+    def nbytes(self) -> int:
+        """Total size of the buffer set in bytes."""
+        return sum(a.nbytes for a in self._flat.values())
+
+
+class BufferPool:
+    """Fixed number of BlockBuffers handed out to blocks in flight."""
+
+    def __init__(self, specs: BufferSpec, slots: int, block_size: int = c.BLOCK_SIZE) -> None:
+        self._free: queue.Queue = queue.Queue()
+        self.nbytes: int = 0
+        for _ in range(slots):
+            buf = BlockBuffers(specs, block_size)
+            self.nbytes += buf.nbytes
+            self._free.put(buf)
+        print(
+            f"Block buffer pool: {slots} slots, {self.nbytes / 1048576:.0f}MB preallocated.",
+            flush=True,
+        )
+
+    def acquire(self, timeout: float = 120) -> BlockBuffers:
+        """Waits for a free buffer set."""
+        return self._free.get(timeout=timeout)
+
+    def release(self, buf: BlockBuffers) -> None:
+        """Returns a buffer set once its block has been written."""
+        self._free.put(buf)
+
+
+if __name__ == "__main__":
+    pass
@@ -224,12 +224,22 @@ def cleanup_outputs(products: List[Dict[str, Any]], dry_run: bool = True) -> Non
     print(f"{count_label} {removed_count} visual output files.", flush=True)
 
 
+def remove_source(path: str) -> None:
+    """Removes an extracted .SAFE directory or a product zip archive."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
 def cleanup_source_data(products: List[Dict[str, Any]], dry_run: bool = True) -> None:
-    """Removes source .SAFE directories from DIRS['DL']."""
+    """Removes source .SAFE directories (and archives kept for /vsizip/ reading) from DIRS['DL']."""
     action = "Dry-run: Checking" if dry_run else "Cleaning up"
     print(f"{action} source .SAFE directories...", flush=True)
 
-    safe_dirs = [d for d in os.listdir(c.DIRS["DL"]) if d.endswith(".SAFE")]
+    safe_dirs = [
+        d for d in os.listdir(c.DIRS["DL"]) if d.endswith(".SAFE") or d.endswith(".SAFE.zip")
+    ]
     removed_safes = 0
 
     for prod in products:
@@ -249,7 +259,7 @@ def cleanup_source_data(products: List[Dict[str, Any]], dry_run: bool = True) ->
                             )
                         else:
                             print(f"Removing source S1 product: {safe}", flush=True)
-                            shutil.rmtree(safe_path)
+                            remove_source(safe_path)
                         removed_safes += 1
 
         # S2 Logic
@@ -266,7 +276,7 @@ def cleanup_source_data(products: List[Dict[str, Any]], dry_run: bool = True) ->
                             )
                         else:
                             print(f"Removing source S2 product: {safe}", flush=True)
-                            shutil.rmtree(safe_path)
+                            remove_source(safe_path)
                         removed_safes += 1
 
     count_label = "Would remove" if dry_run else "Removed"
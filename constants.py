@@ -14,7 +14,7 @@ Global constants and configuration for the Sentinel pipeline.
 """
 
 import os
-from typing import Dict
+from typing import Dict, List, Tuple
 
 import numpy as np
 from dotenv import load_dotenv
@@ -31,7 +31,8 @@ OUT_BASE: str = TARGET_DIR
 
 DIRS: Dict[str, str] = {
     "DL": os.path.join(DATA_DIR, "temp"),
-    "TMP": "/tmp",
+    # Scratch root for per-product intermediates (point at tmpfs/NVMe for speed)
+    "TMP": os.getenv("SCRATCH_DIR", "/tmp"),
     "OUT": OUT_BASE,
     # --- VISUAL (8-bit RGBA for Leaflet) ---
     "VIS_S1_VV": os.path.join(OUT_BASE, "visual/s1/vv"),
@@ -54,6 +55,7 @@ DIRS: Dict[str, str] = {
     "ANA_S2_NDRE": os.path.join(OUT_BASE, "analytic/s2/ndre"),
     "ANA_S2_NDBI": os.path.join(OUT_BASE, "analytic/s2/ndbi"),
     "ANA_S2_NBR": os.path.join(OUT_BASE, "analytic/s2/nbr"),
+    "ANA_S2_CUBE": os.path.join(OUT_BASE, "analytic/s2/cube"),
     # --- System ---
     "S1S2_LEGENDS": os.path.join(OUT_BASE, "legends"),
     "S1S2_LOGS": os.path.join(OUT_BASE, "logs"),
@@ -68,8 +70,43 @@ for directory in DIRS.values():
 # ----- Parallelism -------------------------------------------------
 # Default to 2 workers for 16GB systems, overridable via env
 WORKERS: int = int(os.getenv("PIPELINE_WORKERS", "2"))
-# Macro-block size for GPU saturation (2048^2 = 4M pixels)
-BLOCK_SIZE: int = 2048
+# Macro-block size for GPU saturation (2048^2 = 4M pixels). Output does not depend
+# on it, so it can be tuned for cache/memory alone.
+BLOCK_SIZE: int = int(os.getenv("BLOCK_SIZE", "2048"))
+# Snap all warps to the global EPSG:3857 grid in whole 256 px blocks, so products
+# share pixel alignment and COG tiles (fusion and mosaicking read without resampling)
+ALIGN_GRID: bool = os.getenv("ALIGN_GRID", "false").lower() in ("true", "1")
+ALIGN_BLOCK: int = 256
+# Upper-left corner of the EPSG:3857 extent, origin of the global grid
+GRID_ORIGIN: Tuple[float, float] = (-20037508.342789244, 20037508.342789244)
+# Independent products processed at once (1 = sequential)
+MAX_PARALLEL_PRODUCTS: int = int(os.getenv("MAX_PARALLEL_PRODUCTS", "1"))
+# Memory budget for parallel products in MB (0 = 75% of available RAM)
+PRODUCT_MEMORY_BUDGET_MB: int = int(os.getenv("PRODUCT_MEMORY_BUDGET_MB", "0"))
+
+# ----- Scratch Intermediates ---------------------------------------
+# Format of warped intermediates: deflate, zstd (level 1), none (uncompressed tiled GTiff),
+# raw (memory-mappable ENVI), or auto (raw if scratch space allows, compressed otherwise)
+SCRATCH_FORMAT: str = os.getenv("SCRATCH_FORMAT", "auto").lower()
+
+# ----- Analytic Outputs --------------------------------------------
+# Storage of the analytic outputs: float32, float16 (half-float indices, S1 stays float32)
+# or int16 (indices scaled by 1e-4, S1 sigma0 in 0.01 dB steps)
+ANALYTIC_DTYPE: str = os.getenv("ANALYTIC_DTYPE", "float32").lower()
+# Write the S2 indices of a scene as bands of one cube instead of one file per index
+S2_ANALYTIC_CUBE: bool = os.getenv("S2_ANALYTIC_CUBE", "false").lower() in ("true", "1")
+
+# ----- Stage Cache -------------------------------------------------
+# Persistent cache of warped intermediates (0 = disabled)
+STAGE_CACHE_MB: int = int(os.getenv("STAGE_CACHE_MB", "0"))
+STAGE_CACHE_DIR: str = os.getenv("STAGE_CACHE_DIR", os.path.join(DATA_DIR, "cache"))
+
+# ----- Warp Geometry Cache -----------------------------------------
+# Remap lattices of S1 warps, reused by repeat passes of the same orbit/slice (0 = disabled)
+GEOMETRY_CACHE_MB: int = int(os.getenv("GEOMETRY_CACHE_MB", "256"))
+GEOMETRY_CACHE_DIR: str = os.getenv("GEOMETRY_CACHE_DIR", os.path.join(DATA_DIR, "geometry"))
+# Largest GCP displacement in metres at which a cached geometry is still reused
+GEOMETRY_TOLERANCE_M: float = float(os.getenv("GEOMETRY_TOLERANCE_M", "1.0"))
 
 # ----- Sentinel 2 Band Mapping ---------------------------
 # Source: Sentinel-2 L2A Product Specification (via GDAL SENTINEL2 Driver)
@@ -84,6 +121,13 @@ BAND_RE1: int = 1  # B05 (705nm)
 BAND_SW1: int = 5  # B11 (1610nm)
 BAND_SW2: int = 6  # B12 (2190nm)
 
+# Spectral bands of the 10m/20m subdatasets read by the S2 renderer.
+# Whole subdatasets are kept so the GDAL band numbering above stays valid.
+S2_SUBDATASET_BANDS: Dict[str, List[str]] = {
+    "10m": ["B02", "B03", "B04", "B08"],
+    "20m": ["B05", "B06", "B07", "B8A", "B11", "B12"],
+}
+
 # ----- Sentinel 1 subdatasets --------------------------------------
 DS_VV: int = 1
 DS_VH: int = 2
@@ -98,6 +142,18 @@ S1_RATIO_MAX: float = 5.0
 S2_REF_MIN: int = 1000
 S2_REF_MAX: int = 4000
 
+# S2 visual band scaling: (DN min, DN max, gamma)
+# DN 1000 is 0.0 reflectance (baseline offset), BOA_QUANT=10000
+S2_BAND_SCALING: Dict[str, Tuple[int, int, float]] = {
+    "b02": (1000, 4000, 2.2),
+    "b03": (1000, 4000, 2.2),
+    "b04": (1000, 4000, 2.2),
+    # NIR and SWIR can have higher reflectance, use 0.0 to 0.5 range
+    "b08": (1000, 6000, 1.8),
+    "b11": (1000, 5000, 1.8),
+    "b12": (1000, 5000, 1.8),
+}
+
 # Multi-temporal Normalization percentiles
 S2_PCT_MIN: int = 2
 S2_PCT_MAX: int = 98
@@ -111,3 +167,55 @@ NDVI_PALETTE: Dict[str, np.ndarray] = {
     "g": np.array([0, 0, 153, 255, 235, 190, 145, 230, 204, 179, 145, 115, 68]),
     "b": np.array([0, 38, 0, 204, 175, 115, 55, 115, 89, 64, 43, 26, 0]),
 }
+
+# ----- Index and fusion palettes (node values and RGB at each node) --
+# RdYlGn-like ramp (-0.2 to 0.5)
+RDYLGN_PALETTE: Dict[str, np.ndarray] = {
+    "values": np.array([-0.2, 0.15, 0.5]),
+    "r": np.array([165, 255, 0]),
+    "g": np.array([0, 255, 104]),
+    "b": np.array([38, 191, 55]),
+}
+
+# Urban Heat Map ramp for NDBI
+URBAN_HEAT_PALETTE: Dict[str, np.ndarray] = {
+    "values": np.array([-0.6, -0.2, 0.05, 0.3]),
+    "r": np.array([20, 60, 255, 255]),
+    "g": np.array([20, 60, 255, 0]),
+    "b": np.array([40, 60, 0, 0]),
+}
+
+# Safety Green -> Electric Cyan -> Magma Red ramp for NDBI_CLEAN
+OSINT_PALETTE: Dict[str, np.ndarray] = {
+    "values": np.array([-0.6, -0.2, -0.05, 0.05, 0.2]),
+    "r": np.array([20, 0, 0, 255, 255]),
+    "g": np.array([20, 200, 255, 255, 0]),
+    "b": np.array([60, 0, 255, 0, 0]),
+}
+
+# Turbo-like ramp on [0, 1] for RADAR-BURN
+TURBO_PALETTE: Dict[str, np.ndarray] = {
+    "values": np.array([0.0, 0.25, 0.5, 0.75, 1.0]),
+    "r": np.array([0, 0, 0, 255, 255]),
+    "g": np.array([0, 255, 255, 255, 0]),
+    "b": np.array([255, 255, 0, 0, 0]),
+}
+
+# Safety Green (0) -> Electric Cyan (0.5) -> Magma Red (1.0) for TARGET-PROBE-V2
+FUSION_OSINT_PALETTE: Dict[str, np.ndarray] = {
+    "values": np.array([0.0, 0.5, 1.0]),
+    "r": np.array([0, 0, 255]),
+    "g": np.array([200, 255, 0]),
+    "b": np.array([0, 255, 0]),
+}
+
+# Palette of every colormapped output
+PALETTES: Dict[str, Dict[str, np.ndarray]] = {
+    "NDVI": NDVI_PALETTE,
+    "NDRE": RDYLGN_PALETTE,
+    "NBR": RDYLGN_PALETTE,
+    "NDBI": URBAN_HEAT_PALETTE,
+    "NDBI_CLEAN": OSINT_PALETTE,
+    "RADAR-BURN": TURBO_PALETTE,
+    "TARGET-PROBE-V2": FUSION_OSINT_PALETTE,
+}
@@ -14,11 +14,22 @@ Copernicus Data Space Ecosystem (CDSE) OData v1 API Connector.
 Handles authentication, product search, metadata retrieval, and downloads.
 """
 
+import os
 import re
-from typing import Any, Dict, List, Optional, Tuple, Union
+import shutil
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 from urllib.parse import quote
 
 import requests as req
+from requests.adapters import HTTPAdapter
+
+# Streaming chunk size for downloads (1 MiB)
+CHUNK_SIZE: int = 1024 * 1024
+# Connections kept open per host in the shared session
+POOL_SIZE: int = 16
 
 
 class connect:  # pylint: disable=invalid-name
@@ -27,38 +38,53 @@ class connect:  # pylint: disable=invalid-name
     using the OData API.
     """
 
+    download_url: str = (
+        "https://download.dataspace.copernicus.eu/odata/v1/Products({uuid})/$value"
+    )
+    token_url: str = (
+        "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/"
+        "protocol/openid-connect/token"
+    )
+
     def __init__(self, username: str, password: str) -> None:
-        url: str = (
-            "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/"
-            "protocol/openid-connect/token"
-        )
+        # Shared connection pool for concurrent and segmented downloads
+        self.session = req.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.last_stats: Dict[str, Dict[str, float]] = {}
+        self._token_lock = threading.Lock()
+        self.token: str = ""
+        self.refresh_token: str = ""
+
         data: Dict[str, str] = {
             "client_id": "cdse-public",
             "username": username,
             "password": password,
             "grant_type": "password",
         }
-        r = req.post(url, data=data, timeout=30)
+        r = req.post(self.token_url, data=data, timeout=30)
         self.status: int = r.status_code
         if self.status != 200:
             self.error: str = r.text
         else:
             rj = r.json()
-            self.token: str = rj["access_token"]
-            self.refresh_token: str = rj["refresh_token"]
+            self.token = rj["access_token"]
+            self.refresh_token = rj["refresh_token"]
 
     def refreshToken(self) -> None:  # pylint: disable=invalid-name
         """Refreshes the OIDC access token."""
-        url: str = (
-            "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/"
-            "protocol/openid-connect/token"
-        )
+        with self._token_lock:
+            self._refresh_token()
+
+    def _refresh_token(self) -> None:
+        """Token refresh request; callers hold the token lock."""
         data: Dict[str, str] = {
             "client_id": "cdse-public",
             "refresh_token": self.refresh_token,
             "grant_type": "refresh_token",
         }
-        r = req.post(url, data=data, timeout=30)
+        r = req.post(self.token_url, data=data, timeout=30)
         self.status = r.status_code
         if self.status != 200:
             self.error = r.text
@@ -242,33 +268,182 @@ class connect:  # pylint: disable=invalid-name
         )
         return result.groups()[0] if result else None
 
-    def download(self, uuid: str, filename: str, directory: str = ".", retries: int = 3) -> bool:
-        """Downloads a dataset from Copernicus with retry logic."""
-        url: str = (
-            f"https://download.dataspace.copernicus.eu/odata/v1/Products({uuid})/$value"
-        )
+    def _auth_headers(self, extra: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        """Returns request headers carrying the current access token."""
         headers: Dict[str, str] = {"Authorization": f"Bearer {self.token}"}
+        if extra:
+            headers.update(extra)
+        return headers
+
+    def _remote_size(self, url: str) -> Optional[int]:
+        """Returns the product size if the server supports byte ranges, otherwise None."""
+        r = self.session.get(
+            url, headers=self._auth_headers({"Range": "bytes=0-0"}), stream=True, timeout=60
+        )
+        try:
+            if r.status_code != 206:
+                return None
+            content_range: str = r.headers.get("Content-Range", "")
+            total = content_range.rsplit("/", 1)[-1]
+            return int(total) if total.isdigit() else None
+        finally:
+            r.close()
+
+    def _fetch_range(
+        self, url: str, path: str, start: int = 0, end: Optional[int] = None
+    ) -> int:
+        """
+        Streams a byte range (or the whole product) into path, resuming from what is
+        already on disk. Returns the number of bytes transferred by this call.
+        """
+        have: int = os.path.getsize(path) if os.path.exists(path) else 0
+        if end is not None and have >= end - start + 1:
+            return 0
+
+        extra: Dict[str, str] = {}
+        if end is not None:
+            extra["Range"] = f"bytes={start + have}-{end}"
+        elif have:
+            extra["Range"] = f"bytes={have}-"
+
+        r = self.session.get(
+            url, headers=self._auth_headers(extra), stream=True, timeout=120
+        )
+        with r:
+            if r.status_code == 416 and have and end is None:
+                # Partial file already holds the complete product
+                return 0
+            r.raise_for_status()
+            resumed = r.status_code == 206
+            if extra and not resumed and end is not None:
+                raise req.exceptions.RequestException(
+                    "Server ignored the byte range of a segment"
+                )
+            if have and resumed:
+                print(f"Resuming {os.path.basename(path)} at {have / 1048576:.1f}MB", flush=True)
+
+            written = 0
+            with open(path, "ab" if resumed else "wb") as file:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    if chunk:
+                        file.write(chunk)
+                        written += len(chunk)
+        return written
+
+    def _fetch_segments(self, url: str, path: str, size: int, segments: int) -> int:
+        """Downloads a product as parallel byte-range segments and joins them into path."""
+        step: int = -(-size // segments)
+        ranges: List[Tuple[int, int]] = [
+            (start, min(start + step, size) - 1) for start in range(0, size, step)
+        ]
+        seg_paths: List[str] = [f"{path}.{i}" for i in range(len(ranges))]
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            transferred = sum(
+                executor.map(
+                    lambda job: self._fetch_range(url, job[0], job[1][0], job[1][1]),
+                    zip(seg_paths, ranges),
+                )
+            )
+
+        with open(path, "wb") as joined:
+            for seg_path in seg_paths:
+                with open(seg_path, "rb") as seg:
+                    shutil.copyfileobj(seg, joined, CHUNK_SIZE)
+        for seg_path in seg_paths:
+            os.remove(seg_path)
+        return transferred
+
+    def download(  # pylint: disable=too-many-arguments
+        self,
+        uuid: str,
+        filename: str,
+        directory: str = ".",
+        retries: int = 3,
+        segments: int = 1,
+    ) -> bool:
+        """
+        Downloads a dataset from Copernicus with retry logic.
+        Partial downloads are kept as .part files and resumed with HTTP Range requests.
+        With segments > 1 the product is fetched as parallel byte-range segments.
+        """
+        url: str = self.download_url.format(uuid=uuid)
+        zip_path: str = f"{directory}/{filename}.zip"
+        part_path: str = f"{zip_path}.part"
 
         for attempt in range(retries):
             try:
                 print(f"Downloading {filename} (Attempt {attempt + 1}/{retries})...", flush=True)
-                # Increase timeout for large file streams
-                r = req.get(url, headers=headers, stream=True, timeout=120)
-                r.raise_for_status()
-
-                with open(f"{directory}/{filename}.zip", "wb") as file:
-                    for chunk in r.iter_content(chunk_size=1024 * 1024):
-                        if chunk:
-                            file.write(chunk)
+                start_time = time.time()
+                size: Optional[int] = None
+                if segments > 1 and not os.path.exists(part_path):
+                    size = self._remote_size(url)
+                if size:
+                    transferred = self._fetch_segments(url, part_path, size, segments)
+                else:
+                    transferred = self._fetch_range(url, part_path)
+                os.replace(part_path, zip_path)
+
+                elapsed = max(time.time() - start_time, 1e-6)
+                self.last_stats[uuid] = {
+                    "bytes": transferred,
+                    "seconds": elapsed,
+                    "mb_per_s": transferred / 1048576 / elapsed,
+                }
                 return True
             except (req.exceptions.RequestException, ConnectionError) as e:
                 print(f"Download failed: {e}", flush=True)
                 if attempt < retries - 1:
-                    wait = (attempt + 1) * 10
-                    print(f"Retrying in {wait}s...", flush=True)
-                    import time
-                    time.sleep(wait)
+                    delay = (attempt + 1) * 10
+                    print(f"Retrying in {delay}s (keeping partial data)...", flush=True)
+                    time.sleep(delay)
                     self.refreshToken() # Refresh token just in case it expired during long wait
                 else:
                     raise e
         return False
+
+    def download_many(  # pylint: disable=too-many-arguments
+        self,
+        products: List[Tuple[str, str]],
+        directory: str = ".",
+        workers: int = 2,
+        retries: int = 3,
+        segments: int = 1,
+    ) -> Iterator[Tuple[str, bool]]:
+        """
+        Downloads several (uuid, filename) products concurrently over the shared session.
+        Yields (uuid, success) as each download finishes. Products are submitted as the
+        results are consumed, so at most workers downloads are in flight and a slow
+        consumer holds back further downloads.
+        """
+        if not products:
+            return
+        workers = max(1, workers)
+
+        def fetch(uuid: str, filename: str) -> bool:
+            # Access tokens expire after minutes, so every product starts with a fresh one
+            self.refreshToken()
+            return self.download(uuid, filename, directory, retries, segments)
+
+        jobs = iter(products)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running: Dict[Any, str] = {}
+
+            def submit_next() -> None:
+                job = next(jobs, None)
+                if job is not None:
+                    running[executor.submit(fetch, *job)] = job[0]
+
+            for _ in range(workers):
+                submit_next()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    uuid = running.pop(future)
+                    try:
+                        success = future.result()
+                    except Exception as e:  # pylint: disable=broad-exception-caught
+                        print(f"Download of {uuid} failed: {e}", flush=True)
+                        success = False
+                    yield uuid, success
+                    submit_next()
@@ -28,7 +28,9 @@ from rasterio.windows import Window, from_bounds
 from shapely.geometry import mapping, shape
 from shapely.wkt import loads
 
+import analytic_store as store
 import cog_finalizer as cog
+import colormaps
 import constants as c
 import functions as func
 import legends
@@ -74,54 +76,15 @@ def build_overviews_gdal(path: str) -> None:
 
 
 def turbo_colormap(x_arr: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
-    """Linear interpolation for a Turbo-like ramp."""
-    r_c = np.clip(
-        np.where(x_arr < 0.5, 0, np.where(x_arr < 0.75, (x_arr - 0.5) / 0.25, 1.0)),
-        0,
-        1,
-    )
-    g_c = np.clip(
-        np.where(
-            x_arr < 0.25,
-            x_arr / 0.25,
-            np.where(x_arr < 0.75, 1.0, 1.0 - (x_arr - 0.75) / 0.25),
-        ),
-        0,
-        1,
-    )
-    b_c = np.clip(
-        np.where(
-            x_arr < 0.25, 1.0, np.where(x_arr < 0.5, 1.0 - (x_arr - 0.25) / 0.25, 0)
-        ),
-        0,
-        1,
-    )
-    return (
-        (r_c * 255).astype(np.uint8),
-        (g_c * 255).astype(np.uint8),
-        (b_c * 255).astype(np.uint8),
-    )
+    """Turbo-like ramp for values in [0, 1] (lookup table)."""
+    r_c, g_c, b_c = colormaps.palette("RADAR-BURN").apply(x_arr)
+    return r_c, g_c, b_c
 
 
 def osint_ramp_colormap(x_arr: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
-    """Safety Green (0) -> Electric Cyan (0.5) -> Magma Red (1.0)"""
-    if HAS_CUDA:
-        x_g = cp.array(x_arr)
-        r_g = cp.where(x_g < 0.5, 0, (x_g - 0.5) * 2 * 255)
-        g_g = cp.where(x_g < 0.5, 200 + (x_g * 2) * 55, 255 - (x_g - 0.5) * 2 * 255)
-        b_g = cp.where(x_g < 0.5, x_g * 2 * 255, 255 - (x_g - 0.5) * 2 * 255)
-        res = (
-            cp.asnumpy(r_g).astype(np.uint8),
-            cp.asnumpy(g_g).astype(np.uint8),
-            cp.asnumpy(b_g).astype(np.uint8),
-        )
-        del x_g, r_g, g_g, b_g
-        return res
-
-    r_c = np.where(x_arr < 0.5, 0, (x_arr - 0.5) * 2 * 255)
-    g_c = np.where(x_arr < 0.5, 200 + (x_arr * 2) * 55, 255 - (x_arr - 0.5) * 2 * 255)
-    b_c = np.where(x_arr < 0.5, x_arr * 2 * 255, 255 - (x_arr - 0.5) * 2 * 255)
-    return r_c.astype(np.uint8), g_c.astype(np.uint8), b_c.astype(np.uint8)
+    """Safety Green (0) -> Electric Cyan (0.5) -> Magma Red (1.0) (lookup table)"""
+    r_c, g_c, b_c = colormaps.palette("TARGET-PROBE-V2").apply(x_arr)
+    return r_c, g_c, b_c
 
 
 def load_log(sat: str) -> Optional[Dict[str, Any]]:
@@ -185,8 +148,9 @@ def get_processed_paths(
 
     tci_vis_path = os.path.join(c.DIRS["VIS_S2_TCI"], f"{s2_name}-TCI.tif")
     nirfc_vis_path = os.path.join(c.DIRS["VIS_S2_NIRFC"], f"{s2_name}-NIRFC.tif")
-    ndbi_ana_path = os.path.join(c.DIRS["ANA_S2_NDBI"], f"{s2_name}-NDBI.tif")
-    ndre_ana_path = os.path.join(c.DIRS["ANA_S2_NDRE"], f"{s2_name}-NDRE.tif")
+    # Separate index files or the scene's index cube (S2_ANALYTIC_CUBE)
+    ndbi_ana_path = store.s2_index_path(s2_name, "NDBI")
+    ndre_ana_path = store.s2_index_path(s2_name, "NDRE")
 
     return (
         vh_ana_path,
@@ -237,9 +201,11 @@ def fuse_radar_optical(
 
     func.perf_logger.start_step(f"Fusion: {out_name} RADAR-BURN", use_gpu=True)
     try:
-        with rio.open(tci_path) as s2_src, rio.open(vh_path) as s1_src:
-            out_w, out_h, out_transform, s2_win, inter_poly = calculate_tight_window(
-                inter_geom, s2_src
+        with rio.open(tci_path) as s2_src, store.LayerReader({"VH": vh_path}) as s1_src:
+            out_w, out_h, out_transform, s2_win, inter_poly = (
+                calculate_tight_window(  # pylint: disable=unused-variable
+                    inter_geom, s2_src
+                )
             )
             print(f"Fusing Target Probe (Ghost Blend: {out_w}x{out_h})...", flush=True)
 
@@ -262,24 +228,17 @@ def fuse_radar_optical(
 
             out_path = os.path.join(c.DIRS["VIS_FUSED"], f"{out_name}-RADAR-BURN.tif")
             with rio.open(out_path, "w", **profile) as dst:
-                # Map S2 window to S1 space
-                win_bounds = s2_src.window_bounds(s2_win)
-                s1_win = s1_src.window(*win_bounds)  # pylint: disable=unused-variable
-
                 for _, window in dst.block_windows(1):
                     # Calculate sub-windows for reading
                     dst_bounds = dst.window_bounds(window)
                     s2_sub_win = s2_src.window(*dst_bounds)
-                    s1_sub_win = s1_src.window(*dst_bounds)
 
                     s2_win_data = s2_src.read(
                         [1, 2, 3, 4],
                         window=s2_sub_win,
                         out_shape=(4, window.height, window.width),
                     )
-                    s1_vh_data = s1_src.read(
-                        1, window=s1_sub_win, out_shape=(window.height, window.width)
-                    )
+                    s1_vh_data = s1_src.read(dst_bounds, (window.height, window.width))["VH"]
 
                     if HAS_CUDA:
                         vh_g = cp.array(s1_vh_data, dtype=cp.float32)
@@ -352,9 +311,10 @@ def fuse_target_probe_v2(
 
     func.perf_logger.start_step(f"Fusion: {out_name} TARGET-PROBE-V2", use_gpu=True)
     try:
-        with rio.open(tci_path) as tci_src, rio.open(vh_path) as vh_src, rio.open(
-            ndbi_path
-        ) as ndbi_src, rio.open(ndre_path) as ndre_src:
+        # Decoded analytic layers; from a cube, NDBI and NDRE come from one read of the same tiles
+        with rio.open(tci_path) as tci_src, store.LayerReader(
+            {"VH": vh_path, "NDBI": ndbi_path, "NDRE": ndre_path}
+        ) as ana_src:
             out_w, out_h, out_transform, s2_win, inter_poly = (
                 calculate_tight_window(  # pylint: disable=unused-variable
                     inter_geom, tci_src
@@ -392,21 +352,8 @@ def fuse_target_probe_v2(
                         window=tci_src.window(*dst_bounds),
                         out_shape=(4, window.height, window.width),
                     )
-                    vh_data = vh_src.read(
-                        1,
-                        window=vh_src.window(*dst_bounds),
-                        out_shape=(window.height, window.width),
-                    )
-                    ndbi_data = ndbi_src.read(
-                        1,
-                        window=ndbi_src.window(*dst_bounds),
-                        out_shape=(window.height, window.width),
-                    )
-                    ndre_data = ndre_src.read(
-                        1,
-                        window=ndre_src.window(*dst_bounds),
-                        out_shape=(window.height, window.width),
-                    )
+                    layers = ana_src.read(dst_bounds, (window.height, window.width))
+                    vh_data, ndbi_data, ndre_data = layers["VH"], layers["NDBI"], layers["NDRE"]
 
                     if HAS_CUDA:
                         v_g = cp.array(vh_data)
@@ -481,9 +428,9 @@ def fuse_life_machine(
 
     func.perf_logger.start_step(f"Fusion: {out_name} LIFE-MACHINE", use_gpu=True)
     try:
-        with rio.open(tci_path) as tci_src, rio.open(vh_path) as vh_src, rio.open(
-            nirfc_path
-        ) as nirfc_src:
+        with rio.open(tci_path) as tci_src, store.LayerReader(
+            {"VH": vh_path}
+        ) as vh_src, rio.open(nirfc_path) as nirfc_src:
             out_w, out_h, out_transform, s2_win, inter_poly = (
                 calculate_tight_window(  # pylint: disable=unused-variable
                     inter_geom, tci_src
@@ -531,11 +478,7 @@ def fuse_life_machine(
                         window=tci_src.window(*dst_bounds),
                         out_shape=(window.height, window.width),
                     ).astype(float)
-                    vh_data = vh_src.read(
-                        1,
-                        window=vh_src.window(*dst_bounds),
-                        out_shape=(window.height, window.width),
-                    ).astype(float)
+                    vh_data = vh_src.read(dst_bounds, (window.height, window.width))["VH"].astype(float)
 
                     if HAS_CUDA:
                         vh_g = cp.array(vh_data)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# cpu_kernels.py from https://github.com/sgofferj/python-sentinel-pipeline
+#
+# Copyright Stefan Gofferje
+#
+# Licensed under the Gnu General Public License Version 3 or higher (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+
+"""
+Optional Numba-compiled CPU kernels.
+Fused single-pass, multi-threaded replacements for the NumPy expression chains of the
+sigma0 calibration and the Lee/Gamma MAP despeckle filters (Frost stays on NumPy, whose
+SIMD exp beats the scalar one). Used automatically on nodes without CUDA
+when numba is installed. Run this module directly for a parity check and timings
+against the NumPy implementations.
+"""
+
+import math
+import os
+import time
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+try:
+    import numba
+    from numba import njit, prange
+
+    HAS_NUMBA: bool = os.getenv("DISABLE_NUMBA", "false").lower() not in ("true", "1")
+    # Kernels are called from several compute-stage threads at once, which the
+    # default workqueue threading layer does not support
+    if os.getenv("NUMBA_THREADING_LAYER") is None:
+        numba.config.THREADING_LAYER = "threadsafe"
+except ImportError:
+    HAS_NUMBA = False
+    prange = range
+
+    def njit(*_args, **_kwargs):  # type: ignore[no-redef]
+        """Stand-in so the kernels stay importable (and plain Python) without numba."""
+        return lambda fn: fn
+
+
+# error_model="numpy" gives inf/nan on division by zero like the NumPy paths. The kernels
+# keep all arithmetic in float32 (as the NumPy paths do), which lets LLVM vectorize them.
+# nogil lets compute-stage and GDAL warper threads run kernels side by side.
+_JIT = {"parallel": True, "nogil": True, "cache": True, "error_model": "numpy"}
+
+
+@njit(**_JIT)
+def _sigma0(dn, cal, noise, out):
+    zero = np.float32(0.0)
+    floor = np.float32(1e-9)
+    for i in prange(dn.shape[0]):
+        for j in range(dn.shape[1]):
+            d = dn[i, j]
+            if d > zero:
+                c = cal[i, j]
+                # Valid pixels are never 0, which keeps nodata=0 meaning
+                out[i, j] = max((d * d - noise[i, j]) / (c * c), floor)
+            else:
+                out[i, j] = zero
+
+
+@njit(**_JIT)
+def _improved_lee(img, mean, var, overall_variance, clip_max, out):
+    zero = np.float32(0.0)
+    three = np.float32(3.0)
+    bias = np.float32(overall_variance + 1e-9)
+    top = np.float32(clip_max)
+    for i in prange(img.shape[0]):
+        for j in range(img.shape[1]):
+            x = img[i, j]
+            m = mean[i, j]
+            v = var[i, j]
+            if x > m + three * math.sqrt(v):
+                # Outliers keep their original value
+                res = x
+            else:
+                res = m + v / (v + bias) * (x - m)
+            out[i, j] = min(max(res, zero), top)
+
+
+@njit(**_JIT)
+def _refined_lee(img, mean, var, noise_var, clip_max, out):
+    zero = np.float32(0.0)
+    bias = np.float32(noise_var + 1e-9)
+    top = np.float32(clip_max)
+    for i in prange(img.shape[0]):
+        for j in range(img.shape[1]):
+            m = mean[i, j]
+            v = var[i, j]
+            res = m + v / (v + bias) * (img[i, j] - m)
+            out[i, j] = min(max(res, zero), top)
+
+
+@njit(**_JIT)
+def _gamma_map(img, mean, var, looks, clip_max, out):
+    zero = np.float32(0.0)
+    eps = np.float32(1e-9)
+    ci = np.float32(math.sqrt(1.0 / looks))
+    ci2 = np.float32(ci * ci)
+    num = np.float32(1.0 + ci2)
+    looks_1 = np.float32(looks + 1)
+    looks_4 = np.float32(4 * looks)
+    two = np.float32(2.0)
+    top = np.float32(clip_max)
+    for i in prange(img.shape[0]):
+        for j in range(img.shape[1]):
+            x = img[i, j]
+            m = mean[i, j]
+            cu = math.sqrt(var[i, j]) / (m + eps)
+            if cu > ci * two:
+                # Point target
+                res = x
+            elif cu <= ci:
+                # Homogeneous area
+                res = m
+            else:
+                alpha = num / (cu * cu - ci2 + eps)
+                alpha_l = alpha - looks_1
+                disc = max(alpha_l * alpha_l + looks_4 * alpha * x / (m + eps), zero)
+                res = m * (alpha_l + math.sqrt(disc)) / (two * alpha + eps)
+            out[i, j] = min(max(res, zero), top)
+
+
+def sigma0(dn: np.ndarray, cal: np.ndarray, noise: np.ndarray) -> np.ndarray:
+    """Calibrated, noise-removed sigma0 of one block: max((dn^2 - noise) / cal^2, 1e-9)."""
+    out = np.empty(dn.shape, dtype=np.float32)
+    _sigma0(dn, cal, noise, out)
+    return out
+
+
+def improved_lee(
+    img: np.ndarray, mean: np.ndarray, var: np.ndarray, overall_variance: float, clip_max: float
+) -> np.ndarray:
+    """Fused Improved Lee update from precomputed local statistics."""
+    out = np.empty(img.shape, dtype=np.float32)
+    _improved_lee(img, mean, var, float(overall_variance), float(clip_max), out)
+    return out
+
+
+def refined_lee(
+    img: np.ndarray, mean: np.ndarray, var: np.ndarray, noise_var: float, clip_max: float
+) -> np.ndarray:
+    """Fused Refined Lee update from precomputed local statistics."""
+    out = np.empty(img.shape, dtype=np.float32)
+    _refined_lee(img, mean, var, float(noise_var), float(clip_max), out)
+    return out
+
+
+def gamma_map(
+    img: np.ndarray, mean: np.ndarray, var: np.ndarray, looks: int, clip_max: float
+) -> np.ndarray:
+    """Fused Gamma MAP update from precomputed local statistics."""
+    out = np.empty(img.shape, dtype=np.float32)
+    _gamma_map(img, mean, var, float(looks), float(clip_max), out)
+    return out
+
+
+def _parity_check(size: int = 2048, rounds: int = 3) -> None:
+    """Compares every kernel with the NumPy implementation it replaces."""
+    # pylint: disable=import-outside-toplevel
+    # denoise consults the imported module, not __main__
+    import cpu_kernels as kernels
+    import denoise
+
+    if not kernels.HAS_NUMBA:
+        print("numba is not available (or DISABLE_NUMBA is set), nothing to compare.")
+        return
+
+    rng = np.random.default_rng(0)
+    img = rng.gamma(1.0, 0.1, (size, size)).astype(np.float32)
+    img[: size // 16] = 0
+    dn = rng.uniform(0, 400, (size, size)).astype(np.float32)
+    dn[: size // 16] = 0
+    cal = rng.uniform(400, 600, (size, size)).astype(np.float32)
+    noise = rng.uniform(0, 50, (size, size)).astype(np.float32)
+
+    def numpy_sigma0() -> np.ndarray:
+        valid = dn > 0
+        res = np.zeros_like(dn)
+        res[valid] = np.maximum((np.square(dn[valid]) - noise[valid]) / np.square(cal[valid]), 1e-9)
+        return res
+
+    # The filters pick their kernel themselves, so they run the same call twice
+    cases: Tuple[Tuple[str, Callable[[], np.ndarray], Optional[Callable[[], np.ndarray]]], ...] = (
+        ("sigma0", numpy_sigma0, lambda: kernels.sigma0(dn, cal, noise)),
+        ("improved_lee", lambda: denoise.improved_lee_filter(img, 3), None),
+        ("refined_lee", lambda: denoise.refined_lee_filter(img, 5), None),
+        ("gamma_map", lambda: denoise.gamma_map_filter(img, 5), None),
+    )
+
+    def timed(fn: Callable[[], np.ndarray]) -> Tuple[float, np.ndarray]:
+        best = float("inf")
+        res = fn()  # JIT warm-up
+        for _ in range(rounds):
+            start = time.perf_counter()
+            res = fn()
+            best = min(best, time.perf_counter() - start)
+        return best, res
+
+    print(f"Block {size}x{size}, best of {rounds}, {numba.get_num_threads()} threads:")
+    for name, ref_fn, jit_fn in cases:
+        kernels.HAS_NUMBA = False
+        t_ref, ref = timed(ref_fn)
+        kernels.HAS_NUMBA = True
+        t_jit, res = timed(jit_fn or ref_fn)
+        max_diff = float(np.max(np.abs(ref.astype(np.float64) - res)))
+        rel = max_diff / max(float(np.max(np.abs(ref))), 1e-12)
+        print(
+            f"  {name:13s} NumPy {t_ref * 1000:7.1f}ms  numba {t_jit * 1000:7.1f}ms "
+            f"({t_ref / t_jit:.1f}x)  max rel. diff {rel:.1e}"
+        )
+
+
+if __name__ == "__main__":
+    _parity_check()
@@ -12,13 +12,19 @@
 """
 SAR Denoising module.
 Implements Lee, Frost, and Gamma Map filters with optional CUDA acceleration.
+Without CUDA the Lee and Gamma MAP per-pixel updates run as fused numba kernels when available.
+
+The filters fall back to statistics of the array they are given. Block renderers pass
+scene-level statistics (see StatsAccumulator) and a halo of halo(size) pixels instead, so the
+result does not depend on the block layout.
 """
 
 import os
-from typing import Any, Optional
+from typing import Dict, Optional, Tuple
 
 import numpy as np
-from scipy.ndimage import uniform_filter
+
+import cpu_kernels
 
 # --- CUDA Autodetection ---
 try:
@@ -30,34 +36,143 @@ except ImportError:
     HAS_CUDA = False
 
 
-def improved_lee_filter(img: np.ndarray, size: int = 3) -> np.ndarray:
+def halo(size: int) -> int:
+    """Pixels of context a size x size window filter needs on each side of a block."""
+    return size // 2
+
+
+def _box_mean(img: np.ndarray, size: int) -> np.ndarray:
+    """
+    size x size moving average as running sums of shifted slices. Edges are mirrored
+    like scipy's uniform_filter (mode="reflect"), but each axis costs size - 1 adds
+    instead of a full filter pass.
+    """
+    height, width = img.shape
+    lo, hi = size // 2, (size - 1) // 2
+    padded = np.pad(img, ((0, 0), (lo, hi)), mode="symmetric")
+    rows = padded[:, 0:width].copy()
+    for k in range(1, size):
+        rows += padded[:, k : k + width]
+    padded = np.pad(rows, ((lo, hi), (0, 0)), mode="symmetric")
+    box = padded[0:height].copy()
+    for k in range(1, size):
+        box += padded[k : k + height]
+    box *= np.float32(1.0 / (size * size))
+    return box
+
+
+class LocalStats:
+    """
+    Moving-window mean and variance of one band of a block, shared by all filters run
+    on it (pass it as stats=). Each window size is computed once and cached; the cached
+    arrays are read-only. The CUDA paths compute their own statistics.
+    """
+
+    def __init__(self, img: np.ndarray) -> None:
+        self.img: np.ndarray = np.asarray(img, dtype=np.float32)
+        self._sq: Optional[np.ndarray] = None
+        self._cache: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def mean_var(self, size: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Local mean and (non-negative) local variance for a size x size window."""
+        if size not in self._cache:
+            if self._sq is None:
+                self._sq = np.square(self.img)
+            mean = _box_mean(self.img, size)
+            var = _box_mean(self._sq, size)
+            var -= np.square(mean)
+            np.maximum(var, 0, out=var)
+            self._cache[size] = (mean, var)
+        return self._cache[size]
+
+
+class StatsAccumulator:
+    """
+    Streams the scene-level statistics of one band over blocks.
+    Feed it the valid pixels of every block (and their local variance, where a filter
+    needs it), then read the values the filters take as keyword arguments.
+    """
+
+    def __init__(self) -> None:
+        self.count: int = 0
+        self.total: float = 0.0
+        self.total_sq: float = 0.0
+        self.local_var_total: float = 0.0
+        self.max: float = 0.0
+
+    def add(self, values: np.ndarray, local_var: Optional[np.ndarray] = None) -> None:
+        """Adds the valid pixels of one block."""
+        if values.size == 0:
+            return
+        v = values.astype(np.float64)
+        self.count += v.size
+        self.total += float(v.sum())
+        self.total_sq += float(np.square(v).sum())
+        self.max = max(self.max, float(v.max()))
+        if local_var is not None:
+            self.local_var_total += float(local_var.sum(dtype=np.float64))
+
+    def stats(self) -> Dict[str, float]:
+        """Scene variance, mean local variance and maximum of the streamed pixels."""
+        if self.count == 0:
+            return {"variance": 0.0, "mean_local_variance": 0.0, "max": 0.0}
+        mean = self.total / self.count
+        return {
+            "variance": max(self.total_sq / self.count - mean**2, 0.0),
+            "mean_local_variance": self.local_var_total / self.count,
+            "max": self.max,
+        }
+
+
+def improved_lee_filter(
+    img: np.ndarray,
+    size: int = 3,
+    overall_variance: Optional[float] = None,
+    clip_max: Optional[float] = None,
+    stats: Optional[LocalStats] = None,
+) -> np.ndarray:
     """Improved Lee Filter with optional CUDA acceleration."""
     if HAS_CUDA:
-        return _improved_lee_cuda(img, size)
+        return _improved_lee_cuda(img, size, overall_variance, clip_max)
 
-    img_f = img.astype(np.float32)
-    img_mean = uniform_filter(img_f, (size, size))
-    img_sqr_mean = uniform_filter(img_f**2, (size, size))
-    img_variance = np.maximum(img_sqr_mean - img_mean**2, 0)
-    overall_variance = np.var(img_f)
+    stats = stats or LocalStats(img)
+    img_f = stats.img
+    img_mean, img_variance = stats.mean_var(size)
+    if overall_variance is None:
+        overall_variance = float(np.var(img_f))
+    if clip_max is None:
+        clip_max = float(np.max(img_f))
+    if cpu_kernels.HAS_NUMBA:
+        return cpu_kernels.improved_lee(img_f, img_mean, img_variance, overall_variance, clip_max)
 
-    weighted_variance = img_variance / (img_variance + overall_variance + 1e-9)
-    img_lee = img_mean + weighted_variance * (img_f - img_mean)
+    weighted_variance = img_variance + np.float32(overall_variance + 1e-9)
+    np.divide(img_variance, weighted_variance, out=weighted_variance)
+    img_lee = img_f - img_mean
+    img_lee *= weighted_variance
+    img_lee += img_mean
 
-    std_dev = np.sqrt(img_variance)
-    is_outlier = img_f > (img_mean + 3 * std_dev)
-    img_lee[is_outlier] = img_f[is_outlier]
-    return np.clip(img_lee, 0, np.max(img_f))
+    # Outliers (mean + 3 sigma) keep their original value
+    threshold = np.sqrt(img_variance, out=weighted_variance)
+    threshold *= 3
+    threshold += img_mean
+    np.copyto(img_lee, img_f, where=img_f > threshold)
+    return np.clip(img_lee, 0, clip_max, out=img_lee)
 
 
-def _improved_lee_cuda(img: np.ndarray, size: int = 3) -> np.ndarray:
+def _improved_lee_cuda(
+    img: np.ndarray,
+    size: int = 3,
+    overall_variance: Optional[float] = None,
+    clip_max: Optional[float] = None,
+) -> np.ndarray:
     """CUDA implementation of Improved Lee Filter."""
     m_pool = cp.get_default_memory_pool()
     img_gpu = cp.array(img, dtype=cp.float32)
     img_mean = cp_uniform_filter(img_gpu, (size, size))
     img_sqr_mean = cp_uniform_filter(img_gpu**2, (size, size))
     img_variance = cp.maximum(img_sqr_mean - img_mean**2, 0)
-    overall_variance = cp.var(img_gpu)
+    if overall_variance is None:
+        overall_variance = cp.var(img_gpu)
 
     weighted_variance = img_variance / (img_variance + overall_variance + 1e-9)
     img_lee = img_mean + weighted_variance * (img_gpu - img_mean)
@@ -66,58 +181,96 @@ def _improved_lee_cuda(img: np.ndarray, size: int = 3) -> np.ndarray:
     is_outlier = img_gpu > (img_mean + 3 * std_dev)
     img_lee[is_outlier] = img_gpu[is_outlier]
 
-    res: np.ndarray = cp.asnumpy(cp.clip(img_lee, 0, cp.max(img_gpu)))
+    res: np.ndarray = cp.asnumpy(
+        cp.clip(img_lee, 0, cp.max(img_gpu) if clip_max is None else clip_max)
+    )
     del img_gpu, img_mean, img_sqr_mean, img_variance, img_lee
     m_pool.free_all_blocks()
     return res
 
 
-def refined_lee_filter(img: np.ndarray, size: int = 5) -> np.ndarray:
+def refined_lee_filter(
+    img: np.ndarray,
+    size: int = 5,
+    noise_var: Optional[float] = None,
+    clip_max: Optional[float] = None,
+    stats: Optional[LocalStats] = None,
+) -> np.ndarray:
     """Refined Lee Filter with optional CUDA acceleration."""
     if HAS_CUDA:
-        return _refined_lee_cuda(img, size)
+        return _refined_lee_cuda(img, size, noise_var, clip_max)
 
-    img_f = img.astype(np.float32)
-    img_mean = uniform_filter(img_f, (size, size))
-    img_sqr_mean = uniform_filter(img_f**2, (size, size))
-    img_var = np.maximum(img_sqr_mean - img_mean**2, 0)
-    noise_var = np.mean(img_var) * 0.5
-    weights = img_var / (img_var + noise_var + 1e-9)
-    img_refined = img_mean + weights * (img_f - img_mean)
-    return np.clip(img_refined, 0, np.max(img_f))
+    stats = stats or LocalStats(img)
+    img_f = stats.img
+    img_mean, img_var = stats.mean_var(size)
+    if noise_var is None:
+        noise_var = float(np.mean(img_var)) * 0.5
+    if clip_max is None:
+        clip_max = float(np.max(img_f))
+    if cpu_kernels.HAS_NUMBA:
+        return cpu_kernels.refined_lee(img_f, img_mean, img_var, noise_var, clip_max)
+    weights = img_var + np.float32(noise_var + 1e-9)
+    np.divide(img_var, weights, out=weights)
+    img_refined = img_f - img_mean
+    img_refined *= weights
+    img_refined += img_mean
+    return np.clip(img_refined, 0, clip_max, out=img_refined)
 
 
-def _refined_lee_cuda(img: np.ndarray, size: int = 5) -> np.ndarray:
+def _refined_lee_cuda(
+    img: np.ndarray,
+    size: int = 5,
+    noise_var: Optional[float] = None,
+    clip_max: Optional[float] = None,
+) -> np.ndarray:
     """CUDA implementation of Refined Lee Filter."""
     m_pool = cp.get_default_memory_pool()
     img_gpu = cp.array(img, dtype=cp.float32)
     img_mean = cp_uniform_filter(img_gpu, (size, size))
     img_sqr_mean = cp_uniform_filter(img_gpu**2, (size, size))
     img_var = cp.maximum(img_sqr_mean - img_mean**2, 0)
-    noise_var = cp.mean(img_var) * 0.5
+    if noise_var is None:
+        noise_var = cp.mean(img_var) * 0.5
     weights = img_var / (img_var + noise_var + 1e-9)
     img_refined = img_mean + weights * (img_gpu - img_mean)
-    res: np.ndarray = cp.asnumpy(cp.clip(img_refined, 0, cp.max(img_gpu)))
+    res: np.ndarray = cp.asnumpy(
+        cp.clip(img_refined, 0, cp.max(img_gpu) if clip_max is None else clip_max)
+    )
     del img_gpu, img_mean, img_sqr_mean, img_var, img_refined
     m_pool.free_all_blocks()
     return res
 
 
-def frost_filter(img: np.ndarray, size: int = 5, damping: float = 2.0) -> np.ndarray:
+def frost_filter(
+    img: np.ndarray,
+    size: int = 5,
+    damping: float = 2.0,
+    clip_max: Optional[float] = None,
+    stats: Optional[LocalStats] = None,
+) -> np.ndarray:
     """Frost Filter with optional CUDA acceleration."""
     if HAS_CUDA:
-        return _frost_cuda(img, size, damping)
+        return _frost_cuda(img, size, damping, clip_max)
 
-    img_f = img.astype(np.float32)
-    img_mean = uniform_filter(img_f, (size, size))
-    img_var = np.maximum(uniform_filter(img_f**2, (size, size)) - img_mean**2, 0)
-    coef_var = np.sqrt(img_var) / (img_mean + 1e-9)
-    weights = np.exp(-damping * coef_var)
-    img_frost = img_mean + weights * (img_f - img_mean)
-    return np.clip(img_frost, 0, np.max(img_f))
+    stats = stats or LocalStats(img)
+    img_f = stats.img
+    img_mean, img_var = stats.mean_var(size)
+    if clip_max is None:
+        clip_max = float(np.max(img_f))
 
+    weights = img_mean + np.float32(1e-9)
+    np.divide(np.sqrt(img_var), weights, out=weights)
+    weights *= np.float32(-damping)
+    np.exp(weights, out=weights)
+    img_frost = img_f - img_mean
+    img_frost *= weights
+    img_frost += img_mean
+    return np.clip(img_frost, 0, clip_max, out=img_frost)
 
-def _frost_cuda(img: np.ndarray, size: int = 5, damping: float = 2.0) -> np.ndarray:
+
+def _frost_cuda(
+    img: np.ndarray, size: int = 5, damping: float = 2.0, clip_max: Optional[float] = None
+) -> np.ndarray:
     """CUDA implementation of Frost Filter."""
     m_pool = cp.get_default_memory_pool()
     img_gpu = cp.array(img, dtype=cp.float32)
@@ -126,45 +279,68 @@ def _frost_cuda(img: np.ndarray, size: int = 5, damping: float = 2.0) -> np.ndar
     coef_var = cp.sqrt(img_var) / (img_mean + 1e-9)
     weights = cp.exp(-damping * coef_var)
     img_frost = img_mean + weights * (img_gpu - img_mean)
-    res: np.ndarray = cp.asnumpy(cp.clip(img_frost, 0, cp.max(img_gpu)))
+    res: np.ndarray = cp.asnumpy(
+        cp.clip(img_frost, 0, cp.max(img_gpu) if clip_max is None else clip_max)
+    )
     del img_gpu, img_mean, img_var, img_frost
     m_pool.free_all_blocks()
     return res
 
 
-def gamma_map_filter(img: np.ndarray, size: int = 5, looks: int = 1) -> np.ndarray:
+def gamma_map_filter(
+    img: np.ndarray,
+    size: int = 5,
+    looks: int = 1,
+    clip_max: Optional[float] = None,
+    stats: Optional[LocalStats] = None,
+) -> np.ndarray:
     """Gamma Map (MAP) Filter with optional CUDA acceleration."""
     if HAS_CUDA:
-        return _gamma_map_cuda(img, size, looks)
+        return _gamma_map_cuda(img, size, looks, clip_max)
 
-    img_f = img.astype(np.float32)
-    img_mean = uniform_filter(img_f, (size, size))
-    img_var = np.maximum(uniform_filter(img_f**2, (size, size)) - img_mean**2, 0)
-    ci = np.sqrt(1.0 / looks)
-    cu = np.sqrt(img_var) / (img_mean + 1e-9)
-    alpha = (1.0 + ci**2) / (cu**2 - ci**2 + 1e-9)
-    img_gamma = (
-        img_mean
-        * (
-            (alpha - looks - 1)
-            + np.sqrt(
-                np.maximum(
-                    (alpha - looks - 1) ** 2
-                    + 4 * alpha * looks * img_f / (img_mean + 1e-9),
-                    0,
-                )
-            )
-        )
-        / (2 * alpha + 1e-9)
-    )
-    mask = cu <= ci
-    img_gamma[mask] = img_mean[mask]
-    point_mask = cu > (ci * 2)
-    img_gamma[point_mask] = img_f[point_mask]
-    return np.clip(img_gamma, 0, np.max(img_f))
+    stats = stats or LocalStats(img)
+    img_f = stats.img
+    img_mean, img_var = stats.mean_var(size)
+    if clip_max is None:
+        clip_max = float(np.max(img_f))
+    if cpu_kernels.HAS_NUMBA:
+        return cpu_kernels.gamma_map(img_f, img_mean, img_var, looks, clip_max)
+
+    ci = float(np.sqrt(1.0 / looks))
 
+    # cu == ci divides by zero in float32; those pixels are replaced by the mean below
+    with np.errstate(divide="ignore", invalid="ignore"):
+        safe_mean = img_mean + np.float32(1e-9)
+        cu = np.sqrt(img_var)
+        cu /= safe_mean
+        # alpha = (1 + ci^2) / (cu^2 - ci^2 + 1e-9)
+        alpha = np.square(cu)
+        alpha += np.float32(1e-9 - ci**2)
+        np.divide(np.float32(1.0 + ci**2), alpha, out=alpha)
+        alpha_l = alpha - np.float32(looks + 1)
 
-def _gamma_map_cuda(img: np.ndarray, size: int = 5, looks: int = 1) -> np.ndarray:
+        # mean * (alpha_l + sqrt(max(alpha_l^2 + 4 * alpha * looks * img / mean, 0))) / (2 * alpha + 1e-9)
+        img_gamma = np.divide(img_f, safe_mean)
+        img_gamma *= alpha
+        img_gamma *= np.float32(4 * looks)
+        img_gamma += np.square(alpha_l, out=safe_mean)
+        np.maximum(img_gamma, 0, out=img_gamma)
+        np.sqrt(img_gamma, out=img_gamma)
+        img_gamma += alpha_l
+        img_gamma *= img_mean
+        alpha *= 2
+        alpha += np.float32(1e-9)
+        img_gamma /= alpha
+
+    # Homogeneous areas take the mean, point targets keep their value
+    np.copyto(img_gamma, img_mean, where=cu <= ci)
+    np.copyto(img_gamma, img_f, where=cu > (ci * 2))
+    return np.clip(img_gamma, 0, clip_max, out=img_gamma)
+
+
+def _gamma_map_cuda(
+    img: np.ndarray, size: int = 5, looks: int = 1, clip_max: Optional[float] = None
+) -> np.ndarray:
     """CUDA implementation of Gamma Map Filter."""
     m_pool = cp.get_default_memory_pool()
     img_gpu = cp.array(img, dtype=cp.float32)
@@ -189,7 +365,9 @@ def _gamma_map_cuda(img: np.ndarray, size: int = 5, looks: int = 1) -> np.ndarra
     )
     img_gamma[cu <= ci] = img_mean[cu <= ci]
     img_gamma[cu > (ci * 2)] = img_gpu[cu > (ci * 2)]
-    res: np.ndarray = cp.asnumpy(cp.clip(img_gamma, 0, cp.max(img_gpu)))
+    res: np.ndarray = cp.asnumpy(
+        cp.clip(img_gamma, 0, cp.max(img_gpu) if clip_max is None else clip_max)
+    )
     del img_gpu, img_mean, img_var, img_gamma
     m_pool.free_all_blocks()
     return res
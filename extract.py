@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# extract.py from https://github.com/sgofferj/python-sentinel-pipeline
+#
+# Copyright Stefan Gofferje
+#
+# Licensed under the Gnu General Public License Version 3 or higher (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+
+"""
+Product archive extraction.
+S2 archives are extracted by subdataset: every JP2 GDAL lists in the 10m/20m
+subdatasets the configured processes open (spectral bands plus the AOT/WVP/SCL
+rasters and CLD/SNW probability masks of L2A), together with the (small) metadata
+files GDAL needs. Everything else (60m data, TCI, other QI masks) is skipped.
+"""
+
+import os
+import re
+import zipfile
+from typing import Callable, Iterable
+
+import constants as c
+
+# Matches band files of L2A (T32UNE_..._B02_10m.jp2) and L1C (T32UNE_..._B02.jp2)
+S2_BAND_RE = re.compile(r"_(B\d[\dA])(?:_(\d+m))?\.jp2$", re.IGNORECASE)
+
+# Matches the L2A auxiliary rasters GDAL adds to the subdataset of their resolution
+S2_AUX_RE = re.compile(r"_(AOT|WVP|SCL)_(\d+m)\.jp2$", re.IGNORECASE)
+
+# Matches the L2A cloud/snow probability masks (GDAL bands CLD and SNW)
+S2_MASK_RE = re.compile(r"/MSK_(?:CLDPRB|SNWPRB)_(\d+m)\.jp2$", re.IGNORECASE)
+
+
+def s2_member_needed(name: str, resolutions: Iterable[str]) -> bool:
+    """Decides if a member of an S2 product archive belongs to one of the subdatasets kept."""
+    if not name.lower().endswith(".jp2"):
+        # Manifests, granule metadata and other small auxiliary files
+        return True
+    resolutions = {r.lower() for r in resolutions}
+    if "/QI_DATA/" in name:
+        mask = S2_MASK_RE.search(name)
+        return mask is not None and mask.group(1).lower() in resolutions
+    aux = S2_AUX_RE.search(name)
+    if aux:
+        return aux.group(2).lower() in resolutions
+    match = S2_BAND_RE.search(name)
+    if not match:
+        # TCI rasters
+        return False
+    band, resolution = match.group(1).upper(), match.group(2)
+    if resolution is None:
+        # L1C keeps every band at its native resolution in a single folder
+        return any(band in c.S2_SUBDATASET_BANDS.get(r, []) for r in resolutions)
+    return resolution.lower() in resolutions and band in c.S2_SUBDATASET_BANDS[resolution.lower()]
+
+
+def extract_members(
+    zip_path: str, directory: str, needed: Callable[[str], bool]
+) -> None:
+    """Extracts the members of a zip archive accepted by needed, reporting the savings."""
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        members = [m for m in zip_ref.infolist() if not m.is_dir() and needed(m.filename)]
+        total = sum(m.file_size for m in zip_ref.infolist())
+        kept = sum(m.file_size for m in members)
+        for member in members:
+            zip_ref.extract(member, directory)
+    print(
+        f"Extracted {len(members)} files of {os.path.basename(zip_path)} "
+        f"({kept / 1048576:.0f}MB of {total / 1048576:.0f}MB).",
+        flush=True,
+    )
+
+
+def extract_s2_product(zip_path: str, directory: str, resolutions: Iterable[str]) -> None:
+    """Extracts the metadata and the members of the given subdatasets (e.g. ["10m", "20m"])."""
+    resolutions = list(resolutions)
+    extract_members(zip_path, directory, lambda name: s2_member_needed(name, resolutions))
+
+
+if __name__ == "__main__":
+    pass
@@ -13,18 +13,21 @@
 General utility functions and Performance Logging for the Sentinel pipeline.
 """
 
+import fnmatch
 import json
+import math
 import os
+import queue
 import subprocess
 import threading
 import time
 from datetime import datetime, timedelta, timezone
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import psutil
 import rasterio as rio
-from osgeo import gdal
+from osgeo import gdal, osr
 from rasterio.warp import transform_bounds
 from rasterio.windows import Window, from_bounds
 
@@ -163,6 +166,12 @@ class PerformanceLogger:
         self._monitor_thread = threading.Thread(target=monitor, daemon=True)
         self._monitor_thread.start()
 
+    def attach_process(self) -> None:
+        """Re-binds monitoring to the current process (used by forked product workers)."""
+        self.process = psutil.Process(os.getpid())
+        if self.logfile:
+            self._start_monitoring()
+
     def start_step(self, name: str, use_gpu: bool = False) -> None:
         """Starts tracking a new pipeline step."""
         self.step_name = name
@@ -237,6 +246,172 @@ class PerformanceLogger:
 # Global singleton
 perf_logger = PerformanceLogger()
 
+# ----- Global grid -------------------------------------------------
+
+
+def snap_bounds(bounds: Tuple[float, float, float, float], res: float) -> List[float]:
+    """
+    Grows (minx, miny, maxx, maxy) in EPSG:3857 to whole ALIGN_BLOCK blocks of the
+    global grid anchored at GRID_ORIGIN.
+    """
+    step = res * c.ALIGN_BLOCK
+    origin_x, origin_y = c.GRID_ORIGIN
+    # The epsilon keeps bounds that already sit on the grid from growing a block
+    eps = 1e-6
+    return [
+        origin_x + math.floor((bounds[0] - origin_x) / step + eps) * step,
+        origin_y - math.ceil((origin_y - bounds[1]) / step - eps) * step,
+        origin_x + math.ceil((bounds[2] - origin_x) / step - eps) * step,
+        origin_y - math.floor((origin_y - bounds[3]) / step + eps) * step,
+    ]
+
+
+def warped_footprint(src: Any, dst_srs: str = "EPSG:3857") -> Tuple[float, float, float, float]:
+    """
+    Bounds (minx, miny, maxx, maxy) a source (path or dataset, georeferenced or
+    GCP-based) covers once warped to dst_srs. No pixels are read.
+    """
+    ds = gdal.Open(src) if isinstance(src, str) else src
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(dst_srs)
+    vrt = gdal.AutoCreateWarpedVRT(ds, None, srs.ExportToWkt(), gdal.GRA_Bilinear)
+    geo_t = vrt.GetGeoTransform()
+    footprint = (
+        geo_t[0],
+        geo_t[3] + geo_t[5] * vrt.RasterYSize,
+        geo_t[0] + geo_t[1] * vrt.RasterXSize,
+        geo_t[3],
+    )
+    vrt = None
+    return footprint
+
+
+def warped_nbytes(src: Any, res: float, bands: int, itemsize: int) -> int:
+    """Uncompressed size of a warp of src to EPSG:3857 at res (for the scratch format)."""
+    minx, miny, maxx, maxy = warped_footprint(src)
+    return int(math.ceil((maxx - minx) / res) * math.ceil((maxy - miny) / res) * bands * itemsize)
+
+
+def aligned_bounds(src: Any, res: float, dst_srs: str = "EPSG:3857") -> List[float]:
+    """
+    Output bounds for gdal.Warp that put a source on the global grid.
+    Only meaningful for EPSG:3857 targets.
+    """
+    return snap_bounds(warped_footprint(src, dst_srs), res)
+
+# ----- Block renderer helpers --------------------------------------
+
+# End marker a block reader posts instead of None when it failed
+READ_FAILED: object = object()
+
+
+def halo_window(
+    window: Window, halo: int, width: int, height: int
+) -> Tuple[Window, Tuple[slice, slice]]:
+    """
+    Grows a block window by halo pixels on each side, clipped to the raster.
+    Returns the padded window and the slices that crop the block back out of it.
+    """
+    col0 = max(int(window.col_off) - halo, 0)
+    row0 = max(int(window.row_off) - halo, 0)
+    col1 = min(int(window.col_off + window.width) + halo, width)
+    row1 = min(int(window.row_off + window.height) + halo, height)
+    top = int(window.row_off) - row0
+    left = int(window.col_off) - col0
+    crop = (
+        slice(top, top + int(window.height)),
+        slice(left, left + int(window.width)),
+    )
+    return Window(col0, row0, col1 - col0, row1 - row0), crop
+
+
+def drain_writes(write_queue: queue.Queue, discard: Optional[Callable[[Any], None]] = None) -> None:
+    """
+    Consumes a writer queue up to its end marker. A failed writer calls this after
+    setting its write_failed event, so the compute stage never blocks on a full queue.
+    """
+    try:
+        while (item := write_queue.get(timeout=120)) is not None:
+            if discard:
+                discard(item)
+    except queue.Empty:
+        pass
+
+
+def run_compute_stage(
+    read_queue: queue.Queue,
+    write_queue: queue.Queue,
+    compute: Callable[[int, Any], Any],
+    workers: int,
+    label: str,
+    discard: Optional[Callable[[Any], None]] = None,
+    write_failed: Optional[threading.Event] = None,
+) -> bool:
+    """
+    Fans the compute stage of a block renderer out over worker threads.
+    compute(worker_id, item) turns a reader item into a writer item; NumPy/SciPy release
+    the GIL for the heavy lifting. Blocks reach the writer out of order, which is fine for
+    windowed writes. Ends the writer queue and returns True if every block was processed.
+    A reader that fails ends its queue with READ_FAILED instead of None, a writer that fails
+    sets write_failed (and drains its queue, see drain_writes); both fail the stage.
+    The writer may still fail after the stage returned, so callers check write_failed again
+    once the writer thread has been joined.
+    discard(item) is called for blocks dropped after a failure (e.g. to free pooled buffers).
+    """
+    failed = threading.Event()
+    write_failed = write_failed or threading.Event()
+    finished: List[bool] = [False] * workers
+
+    def worker(worker_id: int) -> None:
+        while not failed.is_set():
+            if write_failed.is_set():
+                failed.set()
+                return
+            try:
+                item = read_queue.get(timeout=120)
+            except queue.Empty:
+                print(f"\nCRITICAL: {label} Reader timed out (Deadlock?).", flush=True)
+                failed.set()
+                return
+            if item is None or item is READ_FAILED:
+                # Hand the end marker on to the remaining workers
+                read_queue.put(item)
+                if item is READ_FAILED:
+                    failed.set()
+                else:
+                    finished[worker_id] = True
+                return
+            try:
+                write_queue.put(compute(worker_id, item), timeout=120)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                print(f"\nCRITICAL: {label} processing loop failed: {e}", flush=True)
+                failed.set()
+                return
+
+    threads = [
+        threading.Thread(target=worker, args=(i,), daemon=True) for i in range(workers)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if failed.is_set():
+        # Unblock the reader so it can run to its end marker
+        try:
+            while (item := read_queue.get(timeout=120)) is not None and item is not READ_FAILED:
+                if discard:
+                    discard(item)
+        except queue.Empty:
+            pass
+    try:
+        write_queue.put(None, timeout=120)
+    except queue.Full:
+        print(f"\nCRITICAL: {label} Writer stopped consuming (Deadlock?).", flush=True)
+        return False
+    return all(finished) and not failed.is_set() and not write_failed.is_set()
+
+
 # ----- General helper functions ------------------------------------
 
 
@@ -321,6 +496,34 @@ def get_window(
     return win.intersection(Window(0, 0, width, height))
 
 
+def vsi_exists(path: str) -> bool:
+    """Checks if a path exists, including GDAL virtual paths like /vsizip/."""
+    return gdal.VSIStatL(path) is not None
+
+
+def vsi_glob(pattern: str) -> List[str]:
+    """Matches a filename pattern in a single directory, including GDAL virtual paths."""
+    directory, name_pattern = os.path.split(pattern)
+    entries: List[str] = gdal.ReadDir(directory) or []
+    return sorted(
+        os.path.join(directory, e) for e in entries if fnmatch.fnmatch(e, name_pattern)
+    )
+
+
+def vsi_read(path: str) -> bytes:
+    """Reads a whole file through GDAL's virtual file system (e.g. from inside a zip)."""
+    handle = gdal.VSIFOpenL(path, "rb")
+    if handle is None:
+        raise FileNotFoundError(path)
+    try:
+        gdal.VSIFSeekL(handle, 0, 2)
+        size: int = gdal.VSIFTellL(handle)
+        gdal.VSIFSeekL(handle, 0, 0)
+        return bytes(gdal.VSIFReadL(1, size, handle))
+    finally:
+        gdal.VSIFCloseL(handle)
+
+
 def output_exists(name: str) -> bool:
     """Checks if output file exists and is not empty (min 100KB for safety)."""
     full_path: str = f"{name}.tif"
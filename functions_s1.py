@@ -21,20 +21,25 @@ import re
 import subprocess
 import threading
 from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
 import numpy as np
 import rasterio as rio
 from osgeo import gdal
 from rasterio.enums import ColorInterp
 
+import analytic_store as store
 import cog_finalizer as cog
 import constants as c
 import denoise
 import functions as func
 import legends
 import metadata_engine as meta
+import recipes
+import stage_cache
 from s1_calibrator import S1Calibrator
+from buffers import BufferPool
+from scratch import BandReader, ScratchWorkspace
 import gpu_warp
 
 # --- CUDA Acceleration ---
@@ -47,6 +52,26 @@ except ImportError:
 
 gdal.UseExceptions()
 
+# Bump when calibration or warping changes the warped sigma0 intermediates
+PREPARE_VERSION: int = 2
+# Let the CPU warper read calibrated VRTs instead of materialized sigma0 rasters
+FUSED_CALIBRATION: bool = os.getenv("S1_FUSED_CALIBRATION", "true").lower() in ("true", "1")
+# Lattice remap warp on the CPU: "true" always, "auto" when the geometry cache holds the
+# lattice of the product's orbit/slice, "false" never (ENABLE_GPU_WARP always uses it)
+LATTICE_WARP: str = os.getenv("S1_LATTICE_WARP", "auto").lower()
+
+# Modules whose code determines the rendered S1 outputs
+RENDER_MODULES: List[str] = ["functions_s1.py", "s1_calibrator.py", "denoise.py", "gpu_warp.py"]
+
+# Despeckle window sizes, and the block halo that makes them seam-free
+VV_FILTER_SIZE: int = 5
+VH_FILTER_SIZE: int = 3
+RATIO_FILTER_SIZE: int = 5
+FILTER_HALO: int = denoise.halo(max(VV_FILTER_SIZE, VH_FILTER_SIZE, RATIO_FILTER_SIZE))
+
+# Visual buffer sets in flight: computing, writing plus queued blocks
+BUFFER_SLOTS: int = 4
+
 
 def build_overviews_gdal(path: str) -> None:
     """Uses gdaladdo for memory-efficient overview building."""
@@ -81,58 +106,143 @@ def build_overviews_gdal(path: str) -> None:
     func.perf_logger.end_step()
 
 
-def prepare(ds_obj: gdal.Dataset) -> None:
+def prepare(ds_obj: gdal.Dataset, ws: ScratchWorkspace) -> None:
     """Calibrates, denoises, and reprojects S1 data to Float32 Sigma0 + Alpha."""
     safe_path: str = os.path.dirname(ds_obj.GetDescription())
+    use_gpu_warp = HAS_CUDA and os.getenv("ENABLE_GPU_WARP", "false").lower() in ("true", "1")
     cal = S1Calibrator(safe_path)
+    # VH and repeat passes of this orbit/slice reuse the VV remap lattice
+    geometry_id = cal.geometry_id()
+    use_lattice = use_gpu_warp or LATTICE_WARP in ("true", "1") or (
+        LATTICE_WARP == "auto"
+        and gpu_warp.has_cached_geometry(cal.subdataset("VV"), "EPSG:3857", 10, geometry_id)
+    )
+
+    fused = FUSED_CALIBRATION and not use_lattice
+    # Sigma0 + alpha per polarization, plus the calibrated swaths without fusion
+    nbytes = func.warped_nbytes(ds_obj, 10, 4, 4)
+    if not fused:
+        nbytes += ds_obj.RasterXSize * ds_obj.RasterYSize * 2 * 4
+    ws.choose_format(nbytes)
+    names = ws.raster_files("vv") + ws.raster_files("vh")
+    vv_path, vh_path = ws.file(ws.raster("vv")), ws.file(ws.raster("vh"))
+
+    cache_key = stage_cache.cache.key(
+        os.path.basename(safe_path),
+        "s1_sigma0_warp",
+        {
+            "version": PREPARE_VERSION,
+            "crs": "EPSG:3857",
+            "res": 10,
+            "aligned": c.ALIGN_GRID,
+            "lattice_warp": use_lattice,
+            "format": ws.format,
+        },
+    )
+    if stage_cache.cache.fetch(cache_key, ws, names):
+        return
+
     print("Calibrating and denoising bands (with alpha mask)...", flush=True)
 
-    # 1. VV Calibration
-    func.perf_logger.start_step("S1 Prepare (VV Calibration)", use_gpu=True)
-    cal.calibrate("VV", "/tmp/vv_raw.tif", block_size=1024, build_ov=False, workers=c.WORKERS)
-    func.perf_logger.end_step()
+    driver, creation_options = ws.creation()
+    warp_options: Dict[str, Any] = dict(
+        format=driver, dstSRS="EPSG:3857", xRes=10, yRes=10,
+        multithread=True, warpMemoryLimit=2048,
+        warpOptions=[f"NUM_THREADS={c.WORKERS}"],
+        creationOptions=creation_options,
+        dstAlpha=True, srcNodata=0,
+    )
 
-    # 2. VH Calibration
-    func.perf_logger.start_step("S1 Prepare (VH Calibration)", use_gpu=True)
-    cal.calibrate("VH", "/tmp/vh_raw.tif", block_size=1024, build_ov=False, workers=c.WORKERS)
+    def warp(dst: str, src: str) -> None:
+        # ALIGN_GRID snaps the output extent to the global grid
+        bounds = func.aligned_bounds(src, 10) if c.ALIGN_GRID else None
+        gdal.Warp(dst, src, options=gdal.WarpOptions(outputBounds=bounds, **warp_options))
+
+    def prime() -> None:
+        # Lattice for the next pass of this orbit/slice (cheap: one transform per GRID_STEP²)
+        if LATTICE_WARP == "auto":
+            gpu_warp.prime_geometry(cal.subdataset("VV"), "EPSG:3857", 10, geometry_id)
+
+    if fused:
+        # Calibration + Warping in one pass: the warper pulls sigma0 blocks from VRTs
+        func.perf_logger.start_step("S1 Calibrate + Warp (EPSG:3857)")
+        print("Reprojecting calibrated VRTs to EPSG:3857...", flush=True)
+        with cal.calibrated_vrts({"VV": ws.file("vv_raw.vrt"), "VH": ws.file("vh_raw.vrt")}) as vrts:
+            warp(vv_path, vrts["VV"])
+            warp(vh_path, vrts["VH"])
+        ws.remove("vv_raw.vrt", "vh_raw.vrt")
+        prime()
+        stage_cache.cache.store(cache_key, ws, names)
+        func.perf_logger.end_step()
+        return
+
+    # 1. VV + VH Calibration in one pass
+    func.perf_logger.start_step("S1 Prepare (VV+VH Calibration)", use_gpu=True)
+    cal.calibrate_many(
+        {"VV": ws.file("vv_raw.tif"), "VH": ws.file("vh_raw.tif")},
+        block_size=1024, build_ov=False, workers=c.WORKERS,
+        creation_options=ws.creation(tiff=True)[1],
+    )
     func.perf_logger.end_step()
 
-    # 3. Warping
+    # 2. Warping
     func.perf_logger.start_step("S1 Warp (EPSG:3857)")
     print("Reprojecting to EPSG:3857...", flush=True)
 
-    if HAS_CUDA and os.getenv("ENABLE_GPU_WARP", "false").lower() in ("true", "1"):
-        print("Using CUDA Acceleration for S1 Warp...", flush=True)
+    if use_lattice:
+        print(f"Using the {'CUDA' if gpu_warp.HAS_CUDA else 'CPU'} lattice remap for S1 Warp...", flush=True)
         # Warp VV and VH independently for maximum stability
-        gpu_warp.reproject_with_cuda("/tmp/vv_raw.tif", "/tmp/vv.tif", dst_crs="EPSG:3857", resolution=10, dst_alpha=True)
-        gpu_warp.reproject_with_cuda("/tmp/vh_raw.tif", "/tmp/vh.tif", dst_crs="EPSG:3857", resolution=10, dst_alpha=True)
+        creation = ws.creation_profile()
+        gpu_warp.reproject_with_cuda(ws.file("vv_raw.tif"), vv_path, dst_crs="EPSG:3857", resolution=10, dst_alpha=True, geometry_id=geometry_id, creation=creation)
+        gpu_warp.reproject_with_cuda(ws.file("vh_raw.tif"), vh_path, dst_crs="EPSG:3857", resolution=10, dst_alpha=True, geometry_id=geometry_id, creation=creation)
     else:
         # Standard CPU Path
-        warp_options = gdal.WarpOptions(
-            dstSRS="EPSG:3857", xRes=10, yRes=10,
-            multithread=True, warpMemoryLimit=2048,
-            warpOptions=[f"NUM_THREADS={c.WORKERS}"],
-            creationOptions=["TILED=YES", "COMPRESS=DEFLATE", "BLOCKXSIZE=256", "BLOCKYSIZE=256", "BIGTIFF=YES"],
-            dstAlpha=True, srcNodata=0,
-        )
-        gdal.Warp("/tmp/vv.tif", "/tmp/vv_raw.tif", options=warp_options)
-        gdal.Warp("/tmp/vh.tif", "/tmp/vh_raw.tif", options=warp_options)
-        
-    # Cleanup raw calibrated bands
-    for f in ["/tmp/vv_raw.tif", "/tmp/vh_raw.tif"]:
-        if os.path.exists(f): os.remove(f)
-        
-    func.perf_logger.end_step()
+        warp(vv_path, ws.file("vv_raw.tif"))
+        warp(vh_path, ws.file("vh_raw.tif"))
+        prime()
 
+    # Cleanup raw calibrated bands
+    ws.remove("vv_raw.tif", "vh_raw.tif")
+    stage_cache.cache.store(cache_key, ws, names)
 
-def cleanup() -> None:
-    """Removes intermediate temporary files."""
-    for f in ["/tmp/vv.tif", "/tmp/vh.tif"]:
-        if os.path.exists(f): os.remove(f)
+    func.perf_logger.end_step()
 
 
-def _render_internal(visual_paths: Dict[str, str], analytic_paths: Dict[str, str]) -> None:
-    """Macro-block threaded renderer for maximum GPU saturation using Double Buffering."""
+def cleanup(ws: ScratchWorkspace) -> None:
+    """Removes intermediate temporary files and the product workspace."""
+    ws.remove_raster("vv", "vh")
+    ws.cleanup()
+
+
+def _scene_stats(vv: BandReader, vh: BandReader, with_ratio: bool) -> Dict[str, Dict[str, float]]:
+    """
+    Pre-pass over the warped scene collecting the despeckle statistics once.
+    Uses the same halo blocks as the renderer, so every filter sees scene-level
+    noise figures instead of ones that change with the block layout.
+    """
+    acc = {b: denoise.StatsAccumulator() for b in ("vv", "vh", "ratio")}
+    width, height = vv.src.width, vv.src.height
+    for r in range(0, height, c.BLOCK_SIZE):
+        for col in range(0, width, c.BLOCK_SIZE):
+            window = rio.windows.Window(col, r, min(c.BLOCK_SIZE, width - col), min(c.BLOCK_SIZE, height - r))
+            padded, crop = func.halo_window(window, FILTER_HALO, width, height)
+            vv_pad = vv.read(padded)
+            vv_blk = vv_pad[crop]; vh_blk = vh.read(window)
+            # Warped nodata is 0, calibrated pixels are always > 0
+            valid = vv_blk > 0
+            vv_var = denoise.LocalStats(vv_pad).mean_var(VV_FILTER_SIZE)[1]
+            acc["vv"].add(vv_blk[valid], vv_var[crop][valid])
+            acc["vh"].add(vh_blk[valid])
+            if with_ratio:
+                acc["ratio"].add(vv_blk[valid] / (vh_blk[valid] + 1e-9))
+    return {b: a.stats() for b, a in acc.items()}
+
+
+def _render_internal(ws: ScratchWorkspace, visual_paths: Dict[str, str], analytic_paths: Dict[str, str]) -> bool:
+    """
+    Macro-block threaded renderer for maximum GPU saturation using Double Buffering.
+    Returns True if every block was rendered.
+    """
     func.perf_logger.start_step("S1 Single-Pass Render", use_gpu=True)
     print(f"Starting Prefetch S1 Render (Block: {c.BLOCK_SIZE})...", flush=True)
 
@@ -141,30 +251,54 @@ def _render_internal(visual_paths: Dict[str, str], analytic_paths: Dict[str, str
     ratio_min: float = c.S1_RATIO_MIN
     ratio_range: float = c.S1_RATIO_MAX - c.S1_RATIO_MIN
 
-    with rio.open("/tmp/vv.tif") as vv_src, rio.open("/tmp/vh.tif") as vh_src:
+    with rio.open(ws.file(ws.raster("vv"))) as vv_src, rio.open(ws.file(ws.raster("vh"))) as vh_src:
         print(f"Source Dimensions: {vv_src.width}x{vv_src.height}", flush=True)
+
+        # Raw intermediates are read as memory-map views: the reader only slices
+        vv_band, vh_band = BandReader(vv_src, 1), BandReader(vh_src, 1)
+        alpha_band = BandReader(vv_src, 2)
+        stats = _scene_stats(vv_band, vh_band, "RATIO" in visual_paths)
+        vv_opts = {"noise_var": stats["vv"]["mean_local_variance"] * 0.5, "clip_max": stats["vv"]["max"]}
+        vh_opts = {"overall_variance": stats["vh"]["variance"], "clip_max": stats["vh"]["max"]}
+        ratio_opts = {"clip_max": stats["ratio"]["max"]}
         
         v_prof = vv_src.profile.copy()
         v_prof.update(
-            photometric="RGB", count=4, dtype=rio.uint8, nodata=None,
+            driver="GTiff", interleave="pixel", photometric="RGB", count=4, dtype=rio.uint8, nodata=None,
             compress="DEFLATE", tiled=True, blockxsize=256, blockysize=256, num_threads=2,
             BIGTIFF="YES",
         )
 
         a_prof = vv_src.profile.copy()
         a_prof.update(
-            count=1, dtype=rio.float32, nodata=0,
+            driver="GTiff", count=1, dtype=rio.float32, nodata=0,
             compress="DEFLATE", tiled=True, blockxsize=256, blockysize=256, num_threads=2,
             BIGTIFF="YES",
         )
+        encoding = store.sigma0_encoding()
+        a_prof = store.encoded_profile(a_prof, encoding)
 
-        v_handles = {p: rio.open(path + ".tif", "w", **v_prof) for p, path in visual_paths.items() if not func.output_exists(path)}
-        a_handles = {p: rio.open(path + ".tif", "w", **a_prof) for p, path in analytic_paths.items() if not func.output_exists(path)}
+        v_handles = {p: rio.open(path + ".tif", "w", **v_prof) for p, path in visual_paths.items()}
+        a_handles = {p: rio.open(path + ".tif", "w", **a_prof) for p, path in analytic_paths.items()}
+        for h in a_handles.values():
+            store.set_scaling(h, encoding)
 
         # Explicitly set Alpha interpretation for visual products
         for h in v_handles.values():
             h.colorinterp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue, ColorInterp.alpha]
 
+        # GPU filters serialize on the device, CPU filters fan out over PIPELINE_WORKERS
+        workers = 1 if HAS_CUDA else max(1, c.WORKERS)
+        # Visual outputs are composed straight into pooled buffers, quantized analytic ones encoded
+        encoded = a_prof["dtype"] != "float32"
+        pool = BufferPool(
+            {
+                **{f"{p}_VIS": (4, np.uint8) for p in v_handles},
+                **{f"{p}_ANA": (1, a_prof["dtype"]) for p in a_handles if encoded},
+            },
+            slots=BUFFER_SLOTS + workers - 1,
+        )
+
         read_queue: queue.Queue = queue.Queue(maxsize=2)
         write_queue: queue.Queue = queue.Queue(maxsize=2)
 
@@ -172,35 +306,47 @@ def _render_internal(visual_paths: Dict[str, str], analytic_paths: Dict[str, str
             try:
                 if vv_src.height == 0 or vv_src.width == 0:
                     print("Error: Source file has 0 dimensions.", flush=True)
-                    read_queue.put(None); return
+                    read_queue.put(func.READ_FAILED); return
                     
                 for r in range(0, vv_src.height, c.BLOCK_SIZE):
                     for col in range(0, vv_src.width, c.BLOCK_SIZE):
                         window = rio.windows.Window(col, r, min(c.BLOCK_SIZE, vv_src.width - col), min(c.BLOCK_SIZE, vv_src.height - r))
-                        vv_data = vv_src.read(1, window=window)
-                        vh_data = vh_src.read(1, window=window)
-                        # Read geometric alpha from warped Band 2
-                        alpha = vv_src.read(2, window=window).astype(np.uint8)
-                        read_queue.put((window, vv_data, vh_data, alpha), timeout=120)
+                        # Filters see a halo of real neighbours, results are cropped back
+                        padded, crop = func.halo_window(window, FILTER_HALO, vv_src.width, vv_src.height)
+                        vv_data = vv_band.read(padded)
+                        vh_data = vh_band.read(padded)
+                        # Geometric alpha from warped Band 2
+                        alpha = alpha_band.read(window)
+                        slot = pool.acquire()
+                        read_queue.put((window, crop, slot, vv_data, vh_data, alpha), timeout=120)
                 read_queue.put(None, timeout=120)
             except Exception as e:
                 print(f"\nCRITICAL: S1 Reader thread failed: {e}", flush=True)
-                read_queue.put(None)
+                read_queue.put(func.READ_FAILED)
+
+        write_failed = threading.Event()
 
         def writer_thread() -> None:
+            pending = None
             try:
                 while True:
                     item = write_queue.get(timeout=120)
                     if item is None:
                         write_queue.task_done(); break
-                    window, res = item
+                    window, slot, res = pending = item
                     for p, h in v_handles.items():
                         if f"{p}_VIS" in res: h.write(res[f"{p}_VIS"], window=window)
                     for p, h in a_handles.items():
                         if f"{p}_ANA" in res: h.write(res[f"{p}_ANA"], 1, window=window)
+                    pending = None
+                    pool.release(slot)
                     write_queue.task_done()
             except Exception as e:
                 print(f"\nCRITICAL: S1 Writer thread failed: {e}", flush=True)
+                write_failed.set()
+                if pending is not None:
+                    pool.release(pending[1])
+                func.drain_writes(write_queue, lambda item: pool.release(item[1]))
 
         t_read = threading.Thread(target=reader_thread, daemon=True)
         t_write = threading.Thread(target=writer_thread, daemon=True)
@@ -212,51 +358,65 @@ def _render_internal(visual_paths: Dict[str, str], analytic_paths: Dict[str, str
             db_vals[m] = 10 * np.log10(arr[m])
             return np.clip((db_vals - db_min) / db_range * 255, 0, 255).astype(np.uint8)
 
+        def compute_block(_worker_id: int, item: Any) -> Any:
+            """Denoises and scales one block into its analytic and visual products."""
+            window, crop, slot, vv_raw, vh_raw, alpha = item
+            h, w = window.height, window.width
+            results = {}
+
+            # Processing: one set of local statistics per band and block, shared by its filters
+            vv_stats, vh_stats = denoise.LocalStats(vv_raw), denoise.LocalStats(vh_raw)
+            vv_denoised = np.ascontiguousarray(denoise.refined_lee_filter(vv_raw, size=VV_FILTER_SIZE, stats=vv_stats, **vv_opts)[crop])
+            vh_denoised = np.ascontiguousarray(denoise.improved_lee_filter(vh_raw, size=VH_FILTER_SIZE, stats=vh_stats, **vh_opts)[crop])
+            results["VV_ANA"] = vv_denoised; results["VH_ANA"] = vh_denoised
+
+            s_vv, s_vh = db_scale(vv_denoised), db_scale(vh_denoised)
+            if encoded:
+                work = np.empty((h, w), dtype=np.float32)
+                for p in a_handles:
+                    results[f"{p}_ANA"] = store.encode(
+                        results[f"{p}_ANA"], slot.get(f"{p}_ANA", h, w), encoding, work
+                    )
+            alpha = alpha.astype(np.uint8)
+            m_norm = alpha / 255.0
+
+            def compose(name: str, layers: List[np.ndarray]) -> np.ndarray:
+                # Alpha-masked layers (one layer = greyscale) plus alpha, in the pooled buffer
+                out = slot.get(name, h, w)
+                for i, layer in enumerate(layers):
+                    np.multiply(layer, m_norm, out=out[i], casting="unsafe")
+                for i in range(len(layers), 3):
+                    out[i] = out[0]
+                out[3] = alpha
+                return out
+
+            if "VV" in v_handles: results["VV_VIS"] = compose("VV_VIS", [s_vv])
+            if "VH" in v_handles: results["VH_VIS"] = compose("VH_VIS", [s_vh])
+            if "RATIO" in v_handles:
+                ratio = vv_raw / (vh_raw + 1e-9)
+                ratio_denoised = denoise.gamma_map_filter(
+                    ratio, size=RATIO_FILTER_SIZE, looks=1, stats=denoise.LocalStats(ratio), **ratio_opts
+                )[crop]
+                s_r = np.clip((ratio_denoised - ratio_min) / ratio_range * 255, 0, 255).astype(np.uint8)
+                results["RATIO_VIS"] = compose("RATIO_VIS", [s_vv, s_vh, s_r])
+
+            return window, slot, results
+
         try:
-            while True:
-                try:
-                    item = read_queue.get(timeout=120)
-                except queue.Empty:
-                    print("\nCRITICAL: S1 Reader timed out (Deadlock?).", flush=True); break
-                    
-                if item is None:
-                    write_queue.put(None, timeout=120); read_queue.task_done(); break
-
-                try:
-                    window, vv_raw, vh_raw, alpha = item
-                    results = {}
-
-                    # Processing
-                    vv_denoised = denoise.refined_lee_filter(vv_raw, size=5)
-                    vh_denoised = denoise.improved_lee_filter(vh_raw, size=3)
-                    results["VV_ANA"] = vv_denoised; results["VH_ANA"] = vh_denoised
-
-                    s_vv, s_vh = db_scale(vv_denoised), db_scale(vh_denoised)
-                    m_norm = alpha.astype(float) / 255.0
-                    def apply_mask(img): return (img.astype(float) * m_norm).astype(np.uint8)
-
-                    if "VV" in v_handles: results["VV_VIS"] = np.stack([apply_mask(s_vv)]*3 + [alpha], axis=0)
-                    if "VH" in v_handles: results["VH_VIS"] = np.stack([apply_mask(s_vh)]*3 + [alpha], axis=0)
-                    if "RATIO" in v_handles:
-                        ratio_denoised = denoise.gamma_map_filter(vv_raw / (vh_raw + 1e-9), size=5, looks=1)
-                        s_r = np.clip((ratio_denoised - ratio_min) / ratio_range * 255, 0, 255).astype(np.uint8)
-                        results["RATIO_VIS"] = np.stack([apply_mask(s_vv), apply_mask(s_vh), apply_mask(s_r), alpha], axis=0)
-
-                    write_queue.put((window, results), timeout=120)
-                except Exception as e:
-                    print(f"\nCRITICAL: S1 processing loop failed: {e}", flush=True)
-                    break
-                    
-                read_queue.task_done()
+            completed = func.run_compute_stage(
+                read_queue, write_queue, compute_block, workers, "S1",
+                discard=lambda item: pool.release(item[2]), write_failed=write_failed,
+            )
         finally:
-            write_queue.put(None, timeout=5)
             t_read.join(); t_write.join()
             vis_output_paths: List[str] = [h.name for h in v_handles.values()]
             for h in list(v_handles.values()) + list(a_handles.values()): h.close()
+        # The writer may fail on the last blocks, after the compute stage ended
+        completed = completed and not write_failed.is_set()
 
         func.perf_logger.end_step()
 
-        if vis_output_paths:
+        if completed and vis_output_paths:
             # Memory Safety: We use max 2 parallel finalizers if not overriden.
             # Each finalizer will use GDAL_NUM_THREADS=1 to avoid OOM spikes.
             max_finalizers = int(os.getenv("MAX_PARALLEL_FINALIZERS", "2"))
@@ -275,6 +435,18 @@ def _render_internal(visual_paths: Dict[str, str], analytic_paths: Dict[str, str
 
         legends.save_all_legends(c.DIRS["S1S2_LEGENDS"])
         gc.collect()
+    return completed
+
+
+def _recipe_params(product: str, visual: bool) -> Dict[str, Any]:
+    """Rendering constants a visual or analytic S1 output depends on."""
+    if not visual:
+        # Outputs written before the encoding was configurable stay valid as float32
+        return {"encoding": "int16"} if store.sigma0_encoding()["dtype"] == "int16" else {}
+    params: Dict[str, Any] = {"db": [c.S1_DB_MIN, c.S1_DB_MAX]}
+    if product == "RATIO":
+        params["ratio"] = [c.S1_RATIO_MIN, c.S1_RATIO_MAX]
+    return params
 
 
 def run_pipeline(ds_obj: gdal.Dataset, processes: List[str], fusion_processes: List[str] = []) -> None:
@@ -284,7 +456,6 @@ def run_pipeline(ds_obj: gdal.Dataset, processes: List[str], fusion_processes: L
     if not times_match: return
     name = f"S1_{times_match.groups()[0]}"
 
-    prepare(ds_obj)
     v_paths: Dict[str, str] = {}
     a_paths: Dict[str, str] = {}
 
@@ -306,5 +477,30 @@ def run_pipeline(ds_obj: gdal.Dataset, processes: List[str], fusion_processes: L
 
     if "RATIOVVVH" in processes:
         v_paths["RATIO"] = f"{c.DIRS['VIS_S1_RATIO']}/{name}"
-    _render_internal(v_paths, a_paths)
-    cleanup()
+
+    # Incremental re-render: only outputs whose input or recipe changed
+    input_id = os.path.basename(os.path.dirname(desc))
+    v_recipes = {p: recipes.output_recipe(input_id, _recipe_params(p, True), RENDER_MODULES) for p in v_paths}
+    a_recipes = {p: recipes.output_recipe(input_id, _recipe_params(p, False), RENDER_MODULES) for p in a_paths}
+    v_paths = recipes.stale_outputs(v_paths, v_recipes)
+    a_paths = recipes.stale_outputs(a_paths, a_recipes)
+    if not v_paths and not a_paths:
+        print(f"All S1 outputs of {name} are up to date.", flush=True)
+        return
+
+    ws = ScratchWorkspace(name)
+    try:
+        prepare(ds_obj, ws)
+        rendered = False
+        try:
+            rendered = _render_internal(ws, v_paths, a_paths)
+        finally:
+            # A False return or an exception: partial outputs must go, with or without manifest
+            if not rendered:
+                recipes.discard_outputs({**v_paths, **{f"ANA_{p}": path for p, path in a_paths.items()}})
+        if rendered:
+            # Only outputs whose writer confirmed every block get a manifest
+            recipes.write_manifests(v_paths, v_recipes)
+            recipes.write_manifests(a_paths, a_recipes)
+    finally:
+        cleanup(ws)
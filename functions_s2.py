@@ -15,6 +15,7 @@ Handles warping, multispectral index calculation, and single-pass rendering.
 Uses Fixed Reflectance Scaling (Reflectance 0.0-0.3 -> 0-255) for tile consistency.
 """
 
+import contextlib
 import gc
 import os
 import queue
@@ -22,18 +23,24 @@ import re
 import subprocess
 import threading
 from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, List, Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 import numpy as np
 import rasterio as rio
-from osgeo import gdal
+from osgeo import gdal, osr
 from rasterio.enums import ColorInterp
 
+import analytic_store as store
 import cog_finalizer as cog
+import colormaps
 import constants as c
 import functions as func
 import legends
 import metadata_engine as meta
+import recipes
+import stage_cache
+from buffers import BlockBuffers, BufferPool
+from scratch import BandReader, ScratchWorkspace
 
 # --- CUDA Acceleration ---
 try:
@@ -45,6 +52,122 @@ except ImportError:
 
 gdal.UseExceptions()
 
+# Bump when warping changes the prepared S2 intermediates
+PREPARE_VERSION: int = 2
+
+# Modules whose code determines the rendered S2 outputs
+RENDER_MODULES: List[str] = ["functions_s2.py", "colormaps.py"]
+
+# Block buffer sets in flight: reading, computing, writing plus one queued
+BUFFER_SLOTS: int = 4
+
+# Scaled bands each visual product is composed of
+VISUAL_BANDS: Dict[str, List[str]] = {
+    "TCI": ["b04", "b03", "b02"],
+    "NIRFC": ["b08", "b04", "b03"],
+    "AP": ["b12", "b11", "b08"],
+    "CAMO": ["b03"],
+}
+
+# "stack": warp only the bands the requested products need into one 10m stack, every
+#          resolution group from its native resolution (the 20m bands are resampled once)
+# "lazy": expose those warps as warped VRTs the renderer reads (no intermediate raster)
+# "split": warp the whole 10m and 20m subdatasets into separate files
+S2_PREPARE_MODE: str = os.getenv("S2_PREPARE_MODE", "stack").lower()
+
+# Resolution of the subdatasets S2_BANDS refers to by index
+SUBDATASET_RES: Tuple[str, str] = ("10m", "20m")
+
+# Subdataset (0 = 10m, 1 = 20m) and GDAL band number of every band the renderer reads
+S2_BANDS: Dict[str, Tuple[int, int]] = {
+    "b02": (0, c.BAND_BLU),
+    "b03": (0, c.BAND_GRN),
+    "b04": (0, c.BAND_RED),
+    "b08": (0, c.BAND_NIR),
+    "b05": (1, c.BAND_RE1),
+    "b11": (1, c.BAND_SW1),
+    "b12": (1, c.BAND_SW2),
+}
+
+# Bands (a, b) of each normalized difference index (a - b) / (a + b)
+INDEX_BANDS: Dict[str, Tuple[str, str]] = {
+    "ndvi": ("b08", "b04"),
+    "ndre": ("b08", "b05"),
+    "ndbi": ("b11", "b08"),
+    "nbr": ("b08", "b12"),
+}
+
+# All S2 products in render order
+S2_PRODUCTS: List[str] = ["TCI", "NIRFC", "AP", "NDVI", "NDBI", "NDRE", "NBR", "CAMO", "NDBI_CLEAN"]
+
+# Map dependencies: visual_product -> [required_analytic_indices]
+ANALYTIC_DEPS: Dict[str, List[str]] = {
+    "NDVI": ["NDVI"],
+    "NDRE": ["NDRE"],
+    "NDBI": ["NDBI"],
+    "NDBI_CLEAN": ["NDBI", "NDRE"],
+    "CAMO": ["NDVI", "NDRE"],
+    "NBR": ["NBR"],
+}
+
+# Indices each visual product is derived from
+PRODUCT_INDICES: Dict[str, List[str]] = {
+    "NDVI": ["ndvi"],
+    "NDRE": ["ndre"],
+    "NDBI": ["ndbi"],
+    "NDBI_CLEAN": ["ndbi", "ndre"],
+    "NBR": ["nbr"],
+    "CAMO": ["ndvi", "ndre"],
+}
+
+
+def required_indices(visual: Iterable[str], analytic: Iterable[str]) -> List[str]:
+    """Normalized difference indices the requested visual and analytic outputs need."""
+    needed = {i for p in visual for i in PRODUCT_INDICES.get(p, [])}
+    needed.update(p.lower() for p in analytic)
+    return [i for i in INDEX_BANDS if i in needed]
+
+
+def required_bands(visual: Iterable[str], analytic: Iterable[str]) -> List[str]:
+    """S2 bands the requested outputs are computed from. b02 always, it carries the alpha."""
+    visual, analytic = list(visual), list(analytic)
+    needed = {"b02"}
+    needed.update(b for p in visual for b in VISUAL_BANDS.get(p, []))
+    for i in required_indices(visual, analytic):
+        needed.update(INDEX_BANDS[i])
+    return [b for b in S2_BANDS if b in needed]
+
+
+def plan_outputs(processes: Iterable[str], fusion_processes: Iterable[str]) -> Tuple[List[str], List[str]]:
+    """Visual and analytic S2 outputs of the requested processes and fusion products."""
+    processes, fusion_processes = list(processes), list(fusion_processes)
+    # Track which analytics we actually need to produce
+    needed_analytics = set()
+    for p in processes:
+        needed_analytics.update(ANALYTIC_DEPS.get(p, []))
+    # Add fusion dependencies for S2:
+    if "TARGET-PROBE-V2" in fusion_processes:
+        needed_analytics.update(["NDBI", "NDRE"])
+
+    visual = [p for p in S2_PRODUCTS if p in processes]
+    # Always produce analytic if it's in the 'needed' set or if explicitly requested
+    analytic = [
+        p for p in S2_PRODUCTS
+        if (p in needed_analytics or p in processes) and f"ANA_S2_{p}" in c.DIRS
+    ]
+    return visual, analytic
+
+
+def required_subdatasets(processes: Iterable[str], fusion_processes: Iterable[str]) -> List[str]:
+    """
+    Resolutions of the subdatasets a run with these processes opens. The 10m one
+    always (b02 carries the alpha), split mode warps both subdatasets in full.
+    """
+    if S2_PREPARE_MODE == "split":
+        return list(SUBDATASET_RES)
+    bands = required_bands(*plan_outputs(processes, fusion_processes))
+    return [res for sub, res in enumerate(SUBDATASET_RES) if any(S2_BANDS[b][0] == sub for b in bands)]
+
 
 def build_overviews_gdal(path: str) -> None:
     """Uses gdaladdo for memory-efficient overview building."""
@@ -95,116 +218,201 @@ def get_time(name: str) -> Optional[str]:
     return result.groups()[0] if result else None
 
 
-def prepare(ds_obj: gdal.Dataset) -> None:
-    """Reprojects required Sentinel-2 bands to EPSG:3857 at 10m resolution."""
+def _band_vrt(subdatasets: List[str], bands: List[str], ws: ScratchWorkspace, name: str) -> str:
+    """
+    VRT stacking the given bands of one subdataset at its native resolution.
+    Nothing is read until it is warped.
+    """
+    singles = []
+    for b in bands:
+        sub, band_no = S2_BANDS[b]
+        gdal.Translate(ws.file(f"{b}.vrt"), subdatasets[sub], format="VRT", bandList=[band_no])
+        singles.append(ws.file(f"{b}.vrt"))
+    gdal.BuildVRT(ws.file(f"{name}.vrt"), singles, separate=True)
+    return ws.file(f"{name}.vrt")
+
+
+def _create_stack(
+    path: str, bounds: List[float], res: int, count: int, data_type: int, driver: str, options: List[str]
+) -> gdal.Dataset:
+    """Empty EPSG:3857 raster covering bounds at res, for the resolution groups to be warped into."""
+    minx, miny, maxx, maxy = bounds
+    width = int(round((maxx - minx) / res))
+    height = int(round((maxy - miny) / res))
+    if driver == "GTiff":
+        # Each group fills its own bands, so no tile is compressed twice
+        options = options + ["INTERLEAVE=BAND"]
+    ds = gdal.GetDriverByName(driver).Create(path, width, height, count, data_type, options=options)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.SetGeoTransform((minx, res, 0, maxy, 0, -res))
+    return ds
+
+
+def prepare(
+    ds_obj: gdal.Dataset, ws: ScratchWorkspace, bands: Optional[Iterable[str]] = None
+) -> Dict[str, Tuple[str, int]]:
+    """
+    Reprojects required Sentinel-2 bands to EPSG:3857 at 10m resolution.
+    Returns the file and band number the renderer reads every prepared band from.
+    """
     func.perf_logger.start_step("S2 Warp (EPSG:3857)")
-    print("Reprojecting required S2 bands to EPSG:3857 (10m aligned)...", flush=True)
+    selected: List[str] = [b for b in S2_BANDS if bands is None or b in set(bands)]
+    mode = S2_PREPARE_MODE if S2_PREPARE_MODE in ("stack", "lazy", "split") else "stack"
+    print(
+        f"Reprojecting {len(selected)} S2 bands to EPSG:3857 (10m aligned, {mode})...",
+        flush=True,
+    )
 
-    sub10m: str = ds_obj.GetSubDatasets()[0][0]
-    sub20m: str = ds_obj.GetSubDatasets()[1][0]
+    subdatasets: List[str] = [sd[0] for sd in ds_obj.GetSubDatasets()[:2]]
+    if mode != "lazy":
+        # Split mode also writes the 20m bands the renderer does not read
+        count = 10 if mode == "split" else len(selected)
+        ws.choose_format(func.warped_nbytes(subdatasets[0], 10, count, 2))
+    driver, creation_options = ws.creation()
 
-    warp_options = {
+    warp_options: Dict[str, Any] = {
+        "format": driver,
         "dstSRS": "EPSG:3857",
         "xRes": 10,
         "yRes": 10,
         "multithread": True,
         "warpMemoryLimit": 256,
         "warpOptions": [f"NUM_THREADS={c.WORKERS}"],
-        "creationOptions": [
-            "TILED=YES",
-            "BLOCKXSIZE=256",
-            "BLOCKYSIZE=256",
-            "COMPRESS=DEFLATE",
-            "BIGTIFF=YES",
-        ],
+        "creationOptions": creation_options,
         "resampleAlg": gdal.GRA_Bilinear,
     }
 
-    gdal.Warp("/tmp/s2_10m.tif", sub10m, **warp_options)
-    master_info = gdal.Info("/tmp/s2_10m.tif", format="json")
-    bounds = master_info["cornerCoordinates"]
-    out_bounds: List[float] = [
-        bounds["lowerLeft"][0],
-        bounds["lowerLeft"][1],
-        bounds["upperRight"][0],
-        bounds["upperRight"][1],
-    ]
-    gdal.Warp("/tmp/s2_20m.tif", sub20m, outputBounds=out_bounds, **warp_options)
+    if mode == "split":
+        files = [ws.file(ws.raster("s2_10m")), ws.file(ws.raster("s2_20m"))]
+        names = ws.raster_files("s2_10m") + ws.raster_files("s2_20m")
+        sources = {b: (files[sub], n) for b, (sub, n) in S2_BANDS.items() if b in selected}
+    else:
+        # Bands grouped by subdataset, each group is warped from its native resolution
+        groups = {
+            sub: [b for b in selected if S2_BANDS[b][0] == sub]
+            for sub in range(len(SUBDATASET_RES))
+        }
+        groups = {sub: group for sub, group in groups.items() if group}
+        if mode == "stack":
+            names = ws.raster_files("s2_stack")
+            stack = ws.file(ws.raster("s2_stack"))
+            sources = {b: (stack, i + 1) for i, b in enumerate(selected)}
+        else:
+            # Lazy warps are VRTs of workspace files, they are not worth caching
+            names = []
+            lazy = {sub: ws.file(f"s2_{SUBDATASET_RES[sub]}.vrt") for sub in groups}
+            sources = {b: (lazy[sub], i + 1) for sub, group in groups.items() for i, b in enumerate(group)}
+
+    # Warped bands only depend on the product, the band selection and the target grid
+    product_id: str = os.path.basename(os.path.dirname(ds_obj.GetDescription()))
+    cache_key = stage_cache.cache.key(
+        product_id,
+        "s2_warp",
+        {
+            "version": PREPARE_VERSION,
+            **{k: warp_options[k] for k in ("dstSRS", "xRes", "yRes", "resampleAlg")},
+            "aligned": c.ALIGN_GRID,
+            "mode": mode,
+            "bands": selected if mode != "split" else list(S2_BANDS),
+            "format": ws.format,
+        },
+    )
+    if names and stage_cache.cache.fetch(cache_key, ws, names):
+        func.perf_logger.end_step()
+        return sources
+
+    if mode != "split":
+        # Every group lands on the grid of the 10m subdataset
+        if c.ALIGN_GRID:
+            out_bounds = func.aligned_bounds(subdatasets[0], 10)
+        else:
+            out_bounds = list(func.warped_footprint(subdatasets[0]))
+        band_vrts = {
+            sub: _band_vrt(subdatasets, group, ws, f"s2_{SUBDATASET_RES[sub]}_bands")
+            for sub, group in groups.items()
+        }
+        if mode == "stack":
+            data_type = gdal.Open(next(iter(band_vrts.values()))).GetRasterBand(1).DataType
+            dst = _create_stack(stack, out_bounds, 10, len(selected), data_type, driver, creation_options)
+            # The grid is set by the stack, only the resampling options apply
+            into_options = {
+                k: v for k, v in warp_options.items()
+                if k not in ("format", "dstSRS", "xRes", "yRes", "creationOptions")
+            }
+            for sub, group in groups.items():
+                gdal.Warp(
+                    dst,
+                    band_vrts[sub],
+                    srcBands=list(range(1, len(group) + 1)),
+                    dstBands=[selected.index(b) + 1 for b in group],
+                    **into_options,
+                )
+            dst = None
+        else:
+            lazy_options = {k: v for k, v in warp_options.items() if k != "creationOptions"}
+            lazy_options["format"] = "VRT"
+            for sub, band_vrt in band_vrts.items():
+                gdal.Warp(lazy[sub], band_vrt, outputBounds=out_bounds, **lazy_options)
+    elif c.ALIGN_GRID:
+        # Both subdatasets land on the same global grid blocks
+        out_bounds = func.aligned_bounds(subdatasets[0], 10)
+        gdal.Warp(files[0], subdatasets[0], outputBounds=out_bounds, **warp_options)
+        gdal.Warp(files[1], subdatasets[1], outputBounds=out_bounds, **warp_options)
+    else:
+        gdal.Warp(files[0], subdatasets[0], **warp_options)
+        master_info = gdal.Info(files[0], format="json")
+        bounds = master_info["cornerCoordinates"]
+        out_bounds = [
+            bounds["lowerLeft"][0],
+            bounds["lowerLeft"][1],
+            bounds["upperRight"][0],
+            bounds["upperRight"][1],
+        ]
+        gdal.Warp(files[1], subdatasets[1], outputBounds=out_bounds, **warp_options)
+    if names:
+        stage_cache.cache.store(cache_key, ws, names)
 
     gc.collect()
     func.perf_logger.end_step()
+    return sources
 
 
-def cleanup() -> None:
-    """Removes intermediate temporary files."""
-    for f in ["/tmp/s2_10m.tif", "/tmp/s2_20m.tif"]:
-        if os.path.exists(f):
-            os.remove(f)
-
-
-def _apply_rdylgn(
-    data: np.ndarray, vmin: float = -0.2, vmax: float = 0.5
-) -> List[np.ndarray]:
-    """Applies a hardcoded RdYlGn-like colormap to normalized data."""
-    nodes: List[float] = [vmin, (vmin + vmax) / 2, vmax]
-    rs: List[int] = [165, 255, 0]
-    gs: List[int] = [0, 255, 104]
-    bs: List[int] = [38, 191, 55]
-    flat = data.flatten()
-    r = np.interp(flat, nodes, rs).astype(np.uint8).reshape(data.shape)
-    g = np.interp(flat, nodes, gs).astype(np.uint8).reshape(data.shape)
-    b = np.interp(flat, nodes, bs).astype(np.uint8).reshape(data.shape)
-    return [r, g, b]
-
-
-def _apply_urban_heat(data: np.ndarray) -> List[np.ndarray]:
-    """Applies a custom Urban Heat Map colormap to NDBI data (-1 to 1)."""
-    nodes: List[float] = [-0.6, -0.2, 0.05, 0.3]
-    rs: List[int] = [20, 60, 255, 255]
-    gs: List[int] = [20, 60, 255, 0]
-    bs: List[int] = [40, 60, 0, 0]
-    flat = data.flatten()
-    r = np.interp(flat, nodes, rs).astype(np.uint8).reshape(data.shape)
-    g = np.interp(flat, nodes, gs).astype(np.uint8).reshape(data.shape)
-    b = np.interp(flat, nodes, bs).astype(np.uint8).reshape(data.shape)
-    return [r, g, b]
-
-
-def _apply_osint_ramp(
-    data: np.ndarray, vmin: float = -0.6, vmax: float = 0.2
-) -> List[np.ndarray]:
-    """Safety Green -> Electric Cyan -> Magma Red"""
-    nodes: List[float] = [vmin, -0.2, -0.05, 0.05, vmax]
-    rs: List[int] = [20, 0, 0, 255, 255]
-    gs: List[int] = [20, 200, 255, 255, 0]
-    bs: List[int] = [60, 0, 255, 0, 0]
-    flat = data.flatten()
-    r = np.interp(flat, nodes, rs).astype(np.uint8).reshape(data.shape)
-    g = np.interp(flat, nodes, gs).astype(np.uint8).reshape(data.shape)
-    b = np.interp(flat, nodes, bs).astype(np.uint8).reshape(data.shape)
-    return [r, g, b]
+def cleanup(ws: ScratchWorkspace) -> None:
+    """Removes intermediate temporary files and the product workspace."""
+    ws.remove_raster("s2_10m", "s2_20m", "s2_stack")
+    ws.remove(*(f"s2_{res}.vrt" for res in SUBDATASET_RES))
+    ws.cleanup()
 
 
 def _render_internal(
+    sources: Dict[str, Tuple[str, int]],
     visual_paths: Dict[str, str],
     analytic_paths: Dict[str, str],
     skip_overviews: bool = False,
-) -> None:
-    """Macro-block threaded renderer for S2 indices using Double Buffering and GPU Concurrency."""
+    cube: Optional[str] = None,
+) -> bool:
+    """
+    Macro-block threaded renderer for S2 indices using Double Buffering and GPU Concurrency.
+    sources maps every prepared band to its file and band number (see prepare).
+    With cube set, the analytic indices are written as named bands of that one file.
+    Returns True if every block was rendered.
+    """
     func.perf_logger.start_step("S2 Single-Pass Render", use_gpu=True)
     print(f"Starting Overdrive S2 Render (Block: {c.BLOCK_SIZE})...", flush=True)
     ref_min: int = c.S2_REF_MIN
     ref_max: int = c.S2_REF_MAX
-    cv, cr, cg, cb = (
-        c.NDVI_PALETTE["values"],
-        c.NDVI_PALETTE["r"],
-        c.NDVI_PALETTE["g"],
-        c.NDVI_PALETTE["b"],
-    )
 
-    with rio.open("/tmp/s2_10m.tif") as src10, rio.open("/tmp/s2_20m.tif") as src20:
+    indices = required_indices(visual_paths, analytic_paths)
+    with contextlib.ExitStack() as stack:
+        files = {f: stack.enter_context(rio.open(f)) for f in sorted({f for f, _ in sources.values()})}
+        # Every prepared file covers the same 10m grid
+        src10 = files[sources["b02"][0]]
         v_prof = src10.profile.copy()
         v_prof.update(
+            driver="GTiff",
+            interleave="pixel",
             photometric="RGB",
             count=4,
             dtype=rio.uint8,
@@ -219,6 +427,7 @@ def _render_internal(
 
         a_prof = src10.profile.copy()
         a_prof.update(
+            driver="GTiff",
             count=1,
             dtype=rio.float32,
             nodata=0,
@@ -229,17 +438,29 @@ def _render_internal(
             num_threads=2,
             BIGTIFF="YES",
         )
+        encoding = store.index_encoding()
+        a_prof = store.encoded_profile(a_prof, encoding)
 
+        # On the stack, so a failure while opening or rendering still closes them
         v_handles = {
-            p: rio.open(path + ".tif", "w", **v_prof)
+            p: stack.enter_context(rio.open(path + ".tif", "w", **v_prof))
             for p, path in visual_paths.items()
-            if not func.output_exists(path)
-        }
-        a_handles = {
-            p: rio.open(path + ".tif", "w", **a_prof)
-            for p, path in analytic_paths.items()
-            if not func.output_exists(path)
         }
+        a_layers = list(analytic_paths)
+        a_handles = {}
+        cube_handle = None
+        if cube and a_layers:
+            # Pixel interleaved, so one tile read returns every index of a block
+            cube_handle = stack.enter_context(rio.open(cube + ".tif", "w", **{**a_prof, "count": len(a_layers)}))
+            cube_handle.descriptions = tuple(a_layers)
+            store.set_scaling(cube_handle, encoding)
+        else:
+            a_handles = {
+                p: stack.enter_context(rio.open(path + ".tif", "w", **a_prof))
+                for p, path in analytic_paths.items()
+            }
+            for h in a_handles.values():
+                store.set_scaling(h, encoding)
 
         # Explicitly set color interpretation for visual products
         for h in v_handles.values():
@@ -250,6 +471,45 @@ def _render_internal(
                 ColorInterp.alpha,
             ]
 
+        # Per-block buffers rotate through reader -> compute -> writer
+        # Raw intermediates are read as memory-map views, the others into pooled buffers
+        readers = {b: BandReader(files[f], n) for b, (f, n) in sources.items()}
+        band_specs = {
+            b: (1, files[f].dtypes[n - 1])
+            for b, (f, n) in sources.items()
+            if not readers[b].mapped
+        }
+        index_specs = {i: (1, np.float32) for i in indices}
+        vis_specs = {f"{p}_VIS": (4, np.uint8) for p in v_handles}
+        # Cube bands and integer encodings are packed into one buffer,
+        # plain float files are written straight from the index buffers
+        packed = bool(a_layers) and (cube_handle is not None or a_prof["dtype"] != "float32")
+        ana_specs = {"ANA": (len(a_layers), a_prof["dtype"])} if packed else {}
+        # GPU kernels serialize on the device, CPU math fans out over PIPELINE_WORKERS
+        workers = 1 if HAS_CUDA else max(1, c.WORKERS)
+        pool = BufferPool(
+            {**band_specs, **index_specs, **vis_specs, **ana_specs},
+            slots=BUFFER_SLOTS + workers - 1,
+        )
+
+        # Compute-stage scratch of each worker, reused for every block
+        scaled_bands = sorted({b for p in v_handles for b in VISUAL_BANDS.get(p, [])})
+        scratches = [
+            BlockBuffers(
+                {
+                    **{f"s_{b}": (1, np.uint8) for b in scaled_bands},
+                    "alpha": (1, np.uint8),
+                    "alpha_mask": (1, np.bool_),
+                    "valid": (1, np.bool_),
+                    "work": (1, np.float32),
+                    "denom": (1, np.float32),
+                    "clean": (1, np.float32),
+                    "lut_idx": (1, np.intp),
+                }
+            )
+            for _ in range(workers)
+        ]
+
         read_queue: queue.Queue = queue.Queue(maxsize=2)
         write_queue: queue.Queue = queue.Queue(maxsize=2)
 
@@ -263,50 +523,45 @@ def _render_internal(
                             min(c.BLOCK_SIZE, src10.width - col),
                             min(c.BLOCK_SIZE, src10.height - r),
                         )
+                        h, w = window.height, window.width
+                        slot = pool.acquire()
                         bands = {
-                            "b02": src10.read(c.BAND_BLU, window=window),
-                            "b03": src10.read(c.BAND_GRN, window=window),
-                            "b04": src10.read(c.BAND_RED, window=window),
-                            "b08": src10.read(c.BAND_NIR, window=window),
-                            "b05": src20.read(
-                                c.BAND_RE1,
-                                window=window,
-                                out_shape=(window.height, window.width),
-                            ),
-                            "b11": src20.read(
-                                c.BAND_SW1,
-                                window=window,
-                                out_shape=(window.height, window.width),
-                            ),
-                            "b12": src20.read(
-                                c.BAND_SW2,
-                                window=window,
-                                out_shape=(window.height, window.width),
-                            ),
+                            b: reader.read(window, None if reader.mapped else slot.get(b, h, w))
+                            for b, reader in readers.items()
                         }
-                        read_queue.put((window, bands), timeout=120)
+                        read_queue.put((window, slot, bands), timeout=120)
                 read_queue.put(None, timeout=120)
             except Exception as e:
                 print(f"\nCRITICAL: S2 Reader thread failed: {e}", flush=True)
-                read_queue.put(None)
+                read_queue.put(func.READ_FAILED)
+
+        write_failed = threading.Event()
 
         def writer_thread() -> None:
+            pending = None
             try:
                 while True:
                     item = write_queue.get(timeout=120)
                     if item is None:
                         write_queue.task_done()
                         break
-                    window, results = item
+                    window, slot, results = pending = item
                     for p, h in v_handles.items():
                         if f"{p}_VIS" in results:
                             h.write(results[f"{p}_VIS"], window=window)
-                    for p, h in a_handles.items():
-                        if f"{p}_ANA" in results:
-                            h.write(results[f"{p}_ANA"], 1, window=window)
+                    if cube_handle is not None:
+                        cube_handle.write(results["ANA"], window=window)
+                    for k, h in enumerate(a_handles.values()):
+                        h.write(results["ANA"][k], 1, window=window)
+                    pending = None
+                    pool.release(slot)
                     write_queue.task_done()
             except Exception as e:
                 print(f"\nCRITICAL: S2 Writer thread failed: {e}", flush=True)
+                write_failed.set()
+                if pending is not None:
+                    pool.release(pending[1])
+                func.drain_writes(write_queue, lambda item: pool.release(item[1]))
 
         t_read = threading.Thread(target=reader_thread, daemon=True)
         t_write = threading.Thread(target=writer_thread, daemon=True)
@@ -315,6 +570,8 @@ def _render_internal(
 
         def scale(
             band: np.ndarray,
+            out: np.ndarray,
+            res: np.ndarray,
             mn: float = ref_min,
             mx: float = ref_max,
             gamma: float = 2.2,
@@ -322,200 +579,179 @@ def _render_internal(
             """
             Fixed-Threshold Reflectance Scaling.
             Maps Reflectance 0.0 (DN 1000) to 0.3 (DN 4000) to 0-255 with Gamma 2.2.
-            This ensures tile consistency.
+            This ensures tile consistency. Works in place on the float32 buffer res.
             """
-            res = (band.astype(np.float32) - mn) / (mx - mn)
-            res = np.clip(res, 0, 1)
+            np.subtract(band, mn, out=res, dtype=np.float32)
+            np.divide(res, mx - mn, out=res)
+            np.clip(res, 0, 1, out=res)
             if gamma != 1.0:
-                res = np.power(res, 1 / gamma)
-            return (res * 255).astype(np.uint8)
-
-        while True:
-            try:
-                item = read_queue.get(timeout=120)
-            except queue.Empty:
-                print("\nCRITICAL: S2 Reader timed out (Deadlock?).", flush=True)
-                break
-
-            if item is None:
-                write_queue.put(None, timeout=120)
-                read_queue.task_done()
-                break
-
-            try:
-                window, bands = item
-                results = {}
-
-                # Calculate Alpha with a small threshold to avoid 1px dark borders from interpolation
-                # Only pixels where sum of RGB > 0 (or some small value)
-                # Using b02 as baseline
-                alpha = np.where(bands["b02"] > 1, 255, 0).astype(np.uint8)
-
-                # Consistent Scaling across all tiles (Reflectance 0.0 to 0.3)
-                # mn=1000 is 0.0 reflectance (baseline offset)
-                # mx=4000 is 0.3 reflectance (BOA_QUANT=10000)
-                s_b02 = scale(bands["b02"], mn=1000, mx=4000, gamma=2.2)
-                s_b03 = scale(bands["b03"], mn=1000, mx=4000, gamma=2.2)
-                s_b04 = scale(bands["b04"], mn=1000, mx=4000, gamma=2.2)
-
-                # NIR and SWIR can have higher reflectance, use 0.0 to 0.5 range
-                s_b08 = scale(bands["b08"], mn=1000, mx=6000, gamma=1.8)
-                s_b11 = scale(bands["b11"], mn=1000, mx=5000, gamma=1.8)
-                s_b12 = scale(bands["b12"], mn=1000, mx=5000, gamma=1.8)
-
-                if "TCI" in v_handles:
-                    results["TCI_VIS"] = np.stack([s_b04, s_b03, s_b02, alpha], axis=0)
-                if "NIRFC" in v_handles:
-                    results["NIRFC_VIS"] = np.stack(
-                        [s_b08, s_b04, s_b03, alpha], axis=0
-                    )
-                if "AP" in v_handles:
-                    results["AP_VIS"] = np.stack([s_b12, s_b11, s_b08, alpha], axis=0)
-
-                # --- GPU CONCURRENT KERNELS ---
-                if HAS_CUDA:
-                    m_pool = cp.get_default_memory_pool()
-                    g_b04 = cp.array(bands["b04"], dtype=cp.float32)
-                    g_b05 = cp.array(bands["b05"], dtype=cp.float32)
-                    g_b08 = cp.array(bands["b08"], dtype=cp.float32)
-                    g_b11 = cp.array(bands["b11"], dtype=cp.float32)
-                    g_b12 = cp.array(bands["b12"], dtype=cp.float32)
-                    g_mask = cp.array(alpha, dtype=cp.uint8)
-
-                    def gpu_math(ba, bb):
-                        # Use raw DNs for index math to avoid scale artifacts
-                        # Indices are naturally normalized -1 to 1
-                        denom = (ba - 1000) + (bb - 1000)
-                        idx = cp.full_like(ba, -1.0, dtype=cp.float32)
-                        valid = (denom != 0) & (g_mask > 0)
-                        idx[valid] = ((ba[valid] - 1000) - (bb[valid] - 1000)) / denom[
-                            valid
-                        ]
-                        return idx
-
-                    s1 = cp.cuda.Stream()
-                    s2 = cp.cuda.Stream()
-                    s3 = cp.cuda.Stream()
-                    s4 = cp.cuda.Stream()
-
-                    with s1:
-                        ndvi_g = gpu_math(g_b08, g_b04)
-                    with s2:
-                        ndre_g = gpu_math(g_b08, g_b05)
-                    with s3:
-                        ndbi_g = gpu_math(g_b11, g_b08)
-                    with s4:
-                        nbr_g = gpu_math(g_b08, g_b12)
-
-                    cp.cuda.Device(0).synchronize()
-                    ndvi_raw = cp.asnumpy(ndvi_g)
-                    ndre_raw = cp.asnumpy(ndre_g)
-                    ndbi_raw = cp.asnumpy(ndbi_g)
-                    nbr_raw = cp.asnumpy(nbr_g)
-
-                    del (
-                        g_b04,
-                        g_b05,
-                        g_b08,
-                        g_b11,
-                        g_b12,
-                        g_mask,
-                        ndvi_g,
-                        ndre_g,
-                        ndbi_g,
-                        nbr_g,
-                    )
-                    m_pool.free_all_blocks()
-                else:
-                    # CPU path fallback
-                    def cpu_math(ba, bb):
-                        ba_f = ba.astype(float) - 1000
-                        bb_f = bb.astype(float) - 1000
-                        denom = ba_f + bb_f
-                        res = np.full_like(ba_f, -1.0)
-                        m = (denom != 0) & (alpha > 0)
-                        res[m] = (ba_f[m] - bb_f[m]) / denom[m]
-                        return res
-
-                    ndvi_raw = cpu_math(bands["b08"], bands["b04"])
-                    ndre_raw = cpu_math(bands["b08"], bands["b05"])
-                    ndbi_raw = cpu_math(bands["b11"], bands["b08"])
-                    nbr_raw = cpu_math(bands["b08"], bands["b12"])
-
-                results["NDVI_ANA"] = ndvi_raw
-                results["NDRE_ANA"] = ndre_raw
-                results["NDBI_ANA"] = ndbi_raw
-                results["NBR_ANA"] = nbr_raw
-
-                if "NDVI" in v_handles:
-                    flat_ndvi = ndvi_raw.flatten()
-                    r_m = (
-                        np.interp(flat_ndvi, cv, cr)
-                        .astype(np.uint8)
-                        .reshape(bands["b08"].shape)
-                    )
-                    g_m = (
-                        np.interp(flat_ndvi, cv, cg)
-                        .astype(np.uint8)
-                        .reshape(bands["b08"].shape)
-                    )
-                    b_m = (
-                        np.interp(flat_ndvi, cv, cb)
-                        .astype(np.uint8)
-                        .reshape(bands["b08"].shape)
-                    )
-                    results["NDVI_VIS"] = np.stack([r_m, g_m, b_m, alpha], axis=0)
-
-                if "NDRE" in v_handles:
-                    res_ndre = _apply_rdylgn(ndre_raw)
-                    results["NDRE_VIS"] = np.stack(
-                        [res_ndre[0], res_ndre[1], res_ndre[2], alpha], axis=0
-                    )
-
-                if "NDBI" in v_handles:
-                    res_ndbi = _apply_urban_heat(ndbi_raw)
-                    results["NDBI_VIS"] = np.stack(
-                        [res_ndbi[0], res_ndbi[1], res_ndbi[2], alpha], axis=0
-                    )
-
-                if "NDBI_CLEAN" in v_handles:
-                    ndbi_clean = ndbi_raw - (ndre_raw * 0.4)
-                    res_ndbi_c = _apply_osint_ramp(ndbi_clean)
-                    results["NDBI_CLEAN_VIS"] = np.stack(
-                        [res_ndbi_c[0], res_ndbi_c[1], res_ndbi_c[2], alpha], axis=0
-                    )
-
-                if "NBR" in v_handles:
-                    res_nbr = _apply_rdylgn(nbr_raw, vmin=-0.2, vmax=0.5)
-                    results["NBR_VIS"] = np.stack(
-                        [res_nbr[0], res_nbr[1], res_nbr[2], alpha], axis=0
-                    )
-
-                if "CAMO" in v_handles:
-
-                    def scale_nd(val):
-                        return np.clip((val + 1) / 2 * 255, 0, 255).astype(np.uint8)
-
-                    results["CAMO_VIS"] = np.stack(
-                        [scale_nd(ndvi_raw), scale_nd(ndre_raw), s_b03, alpha], axis=0
-                    )
-
-                write_queue.put((window, results), timeout=120)
-            except Exception as e:
-                print(f"\nCRITICAL: S2 processing loop failed: {e}", flush=True)
-                break
-
-            read_queue.task_done()
-
-        t_read.join()
-        t_write.join()
-        vis_output_paths: List[str] = [h.name for h in v_handles.values()]
-        for h in list(v_handles.values()) + list(a_handles.values()):
-            h.close()
+                np.power(res, 1 / gamma, out=res)
+            res *= 255
+            np.copyto(out, res, casting="unsafe")
+            return out
+
+        def scale_nd(val: np.ndarray, out: np.ndarray, res: np.ndarray) -> np.ndarray:
+            """Maps a normalized difference index from [-1, 1] to 0-255 in place."""
+            np.add(val, 1, out=res)
+            res /= 2
+            res *= 255
+            np.clip(res, 0, 255, out=res)
+            np.copyto(out, res, casting="unsafe")
+            return out
+
+        def compute_block(worker_id: int, item: Any) -> Any:
+            """Computes all requested products of one block into its pooled buffers."""
+            scratch = scratches[worker_id]
+            window, slot, bands = item
+            h, w = window.height, window.width
+            work = scratch.get("work", h, w)
+            results = {}
+
+            # Calculate Alpha with a small threshold to avoid 1px dark borders from interpolation
+            # Only pixels where sum of RGB > 0 (or some small value)
+            # Using b02 as baseline
+            alpha_mask = np.greater(bands["b02"], 1, out=scratch.get("alpha_mask", h, w))
+            alpha = np.multiply(alpha_mask, np.uint8(255), out=scratch.get("alpha", h, w))
+
+            # Consistent Scaling across all tiles (see c.S2_BAND_SCALING)
+            scaled = {
+                b: scale(bands[b], scratch.get(f"s_{b}", h, w), work, *c.S2_BAND_SCALING[b])
+                for b in scaled_bands
+            }
+
+            for p in ("TCI", "NIRFC", "AP"):
+                if p in v_handles:
+                    out = slot.get(f"{p}_VIS", h, w)
+                    for i, b in enumerate(VISUAL_BANDS[p]):
+                        out[i] = scaled[b]
+                    out[3] = alpha
+                    results[f"{p}_VIS"] = out
+
+            # Only the indices the requested outputs use, straight into the pooled buffers
+            raw = {i: slot.get(i, h, w) for i in indices}
+
+            # --- GPU CONCURRENT KERNELS ---
+            if HAS_CUDA and raw:
+                m_pool = cp.get_default_memory_pool()
+                g_bands = {
+                    b: cp.array(bands[b], dtype=cp.float32)
+                    for b in sorted({b for i in indices for b in INDEX_BANDS[i]})
+                }
+                g_mask = cp.array(alpha, dtype=cp.uint8)
+
+                def gpu_math(ba, bb):
+                    # Use raw DNs for index math to avoid scale artifacts
+                    # Indices are naturally normalized -1 to 1
+                    denom = (ba - 1000) + (bb - 1000)
+                    idx = cp.full_like(ba, -1.0, dtype=cp.float32)
+                    valid = (denom != 0) & (g_mask > 0)
+                    idx[valid] = ((ba[valid] - 1000) - (bb[valid] - 1000)) / denom[
+                        valid
+                    ]
+                    return idx
+
+                # One stream per index
+                g_idx = {}
+                for i in indices:
+                    with cp.cuda.Stream():
+                        ba, bb = INDEX_BANDS[i]
+                        g_idx[i] = gpu_math(g_bands[ba], g_bands[bb])
+
+                cp.cuda.Device(0).synchronize()
+                # Copy straight into the pooled host buffers
+                for i, idx in g_idx.items():
+                    idx.get(out=raw[i])
+
+                del g_bands, g_mask, g_idx
+                m_pool.free_all_blocks()
+            else:
+                # CPU path fallback, in place on the pooled buffers
+                def cpu_math(ba, bb, out):
+                    # (ba - 1000) - (bb - 1000) over (ba - 1000) + (bb - 1000)
+                    denom = np.add(ba, bb, out=scratch.get("denom", h, w), dtype=np.float32)
+                    denom -= 2000
+                    np.subtract(ba, bb, out=out, dtype=np.float32)
+                    valid = np.not_equal(denom, 0, out=scratch.get("valid", h, w))
+                    np.logical_and(valid, alpha_mask, out=valid)
+                    np.divide(out, denom, out=out, where=valid)
+                    np.logical_not(valid, out=valid)
+                    np.copyto(out, -1.0, where=valid)
+                    return out
+
+                for i in indices:
+                    ba, bb = INDEX_BANDS[i]
+                    cpu_math(bands[ba], bands[bb], raw[i])
+
+            if packed:
+                ana = slot.get("ANA", h, w).reshape(len(a_layers), h, w)
+                for k, p in enumerate(a_layers):
+                    store.encode(raw[p.lower()], ana[k], encoding, work)
+                results["ANA"] = ana
+            elif a_layers:
+                results["ANA"] = [raw[p.lower()] for p in a_layers]
+
+            lut_bufs = {"work": work, "idx": scratch.get("lut_idx", h, w)}
+
+            if "NDVI" in v_handles:
+                results["NDVI_VIS"] = colormaps.palette("NDVI").rgba(
+                    raw["ndvi"], alpha, out=slot.get("NDVI_VIS", h, w), **lut_bufs
+                )
+
+            if "NDRE" in v_handles:
+                results["NDRE_VIS"] = colormaps.palette("NDRE").rgba(
+                    raw["ndre"], alpha, out=slot.get("NDRE_VIS", h, w), **lut_bufs
+                )
+
+            if "NDBI" in v_handles:
+                results["NDBI_VIS"] = colormaps.palette("NDBI").rgba(
+                    raw["ndbi"], alpha, out=slot.get("NDBI_VIS", h, w), **lut_bufs
+                )
+
+            if "NDBI_CLEAN" in v_handles:
+                ndbi_clean = np.multiply(raw["ndre"], 0.4, out=scratch.get("clean", h, w))
+                np.subtract(raw["ndbi"], ndbi_clean, out=ndbi_clean)
+                results["NDBI_CLEAN_VIS"] = colormaps.palette("NDBI_CLEAN").rgba(
+                    ndbi_clean, alpha, out=slot.get("NDBI_CLEAN_VIS", h, w), **lut_bufs
+                )
+
+            if "NBR" in v_handles:
+                results["NBR_VIS"] = colormaps.palette("NBR").rgba(
+                    raw["nbr"], alpha, out=slot.get("NBR_VIS", h, w), **lut_bufs
+                )
+
+            if "CAMO" in v_handles:
+                out = slot.get("CAMO_VIS", h, w)
+                scale_nd(raw["ndvi"], out[0], work)
+                scale_nd(raw["ndre"], out[1], work)
+                out[2] = scaled["b03"]
+                out[3] = alpha
+                results["CAMO_VIS"] = out
+
+            return window, slot, results
+
+        try:
+            completed = func.run_compute_stage(
+                read_queue,
+                write_queue,
+                compute_block,
+                workers,
+                "S2",
+                discard=lambda item: pool.release(item[1]),
+                write_failed=write_failed,
+            )
+        finally:
+            t_read.join()
+            t_write.join()
+            vis_output_paths: List[str] = [h.name for h in v_handles.values()]
+            for h in list(v_handles.values()) + list(a_handles.values()) + [cube_handle]:
+                if h is not None:
+                    h.close()
+        # The writer may fail on the last blocks, after the compute stage ended
+        completed = completed and not write_failed.is_set()
 
         func.perf_logger.end_step()
 
-        if vis_output_paths and not skip_overviews:
+        if completed and vis_output_paths and not skip_overviews:
             # Memory Safety: We use max 2 parallel finalizers if not overriden.
             # Each finalizer will use GDAL_NUM_THREADS=1 to avoid OOM spikes.
             max_finalizers = int(os.getenv("MAX_PARALLEL_FINALIZERS", "2"))
@@ -536,6 +772,20 @@ def _render_internal(
 
         legends.save_all_legends(c.DIRS["S1S2_LEGENDS"])
         gc.collect()
+    return completed
+
+
+def _recipe_params(product: str, visual: bool) -> Dict[str, Any]:
+    """Rendering constants a visual or analytic S2 output depends on."""
+    if not visual:
+        # Outputs written before the encoding was configurable stay valid as float32
+        return {"encoding": c.ANALYTIC_DTYPE} if c.ANALYTIC_DTYPE in ("float16", "int16") else {}
+    params: Dict[str, Any] = {
+        "scaling": {b: c.S2_BAND_SCALING[b] for b in VISUAL_BANDS.get(product, [])}
+    }
+    if product in c.PALETTES:
+        params["palette"] = c.PALETTES[product]
+    return params
 
 
 def run_pipeline(ds_obj: gdal.Dataset, processes: List[str], fusion_processes: List[str] = []) -> None:
@@ -545,46 +795,49 @@ def run_pipeline(ds_obj: gdal.Dataset, processes: List[str], fusion_processes: L
     time_str: str = str(get_time(product_uri)) + "Z"
     name = f"{utm}-{time_str}"
 
-    v_paths: Dict[str, str] = {}
-    a_paths: Dict[str, str] = {}
-    # Map dependencies: visual_product -> [required_analytic_indices]
-    s2_deps = {
-        "NDVI": ["NDVI"],
-        "NDRE": ["NDRE"],
-        "NDBI": ["NDBI"],
-        "NDBI_CLEAN": ["NDBI", "NDRE"],
-        "CAMO": ["NDVI", "NDRE"],
-        "NBR": ["NBR"],
+    visual, analytic = plan_outputs(processes, fusion_processes)
+    v_paths: Dict[str, str] = {p: f"{c.DIRS[f'VIS_S2_{p}']}/{name}-{p}" for p in visual}
+    a_paths: Dict[str, str] = {p: f"{c.DIRS[f'ANA_S2_{p}']}/{name}-{p}" for p in analytic}
+
+    # Incremental re-render: only outputs whose input or recipe changed
+    v_recipes = {
+        p: recipes.output_recipe(product_uri, _recipe_params(p, True), RENDER_MODULES)
+        for p in v_paths
     }
-    
-    # Track which analytics we actually need to produce
-    needed_analytics = set()
-    for p in processes:
-        if p in s2_deps:
-            needed_analytics.update(s2_deps[p])
-            
-    # Add fusion dependencies for S2:
-    if "TARGET-PROBE-V2" in fusion_processes:
-        needed_analytics.update(["NDBI", "NDRE"])
+    layers = list(a_paths)
+    cube = store.cube_name(name) if c.S2_ANALYTIC_CUBE and layers else None
+    if cube:
+        # One cube carries all analytic indices, so it is re-rendered as a whole
+        a_paths = {"CUBE": cube}
+    a_recipes = {
+        p: recipes.output_recipe(
+            product_uri,
+            {**_recipe_params(p, False), **({"layers": layers} if cube else {})},
+            RENDER_MODULES,
+        )
+        for p in a_paths
+    }
+    v_paths = recipes.stale_outputs(v_paths, v_recipes)
+    a_paths = recipes.stale_outputs(a_paths, a_recipes)
+    if not v_paths and not a_paths:
+        print(f"All S2 outputs of {name} are up to date.", flush=True)
+        return
 
-    for p in [
-        "TCI",
-        "NIRFC",
-        "AP",
-        "NDVI",
-        "NDBI",
-        "NDRE",
-        "NBR",
-        "CAMO",
-        "NDBI_CLEAN",
-    ]:
-        if p in processes:
-            v_paths[p] = f"{c.DIRS[f'VIS_S2_{p}']}/{name}-{p}"
-        
-        # Always produce analytic if it's in the 'needed' set or if explicitly requested
-        if p in needed_analytics or p in processes:
-            if f"ANA_S2_{p}" in c.DIRS:
-                a_paths[p] = f"{c.DIRS[f'ANA_S2_{p}']}/{name}-{p}"
-    prepare(ds_obj)
-    _render_internal(v_paths, a_paths)
-    cleanup()
+    ws = ScratchWorkspace(name)
+    try:
+        # Cube layers are rendered as if they were separate outputs, all into the cube
+        ana = {p: cube for p in layers} if cube and a_paths else a_paths
+        sources = prepare(ds_obj, ws, required_bands(v_paths, ana))
+        rendered = False
+        try:
+            rendered = _render_internal(sources, v_paths, ana, cube=cube)
+        finally:
+            # A False return or an exception: partial outputs must go, with or without manifest
+            if not rendered:
+                recipes.discard_outputs({**v_paths, **{f"ANA_{p}": path for p, path in a_paths.items()}})
+        if rendered:
+            # Only outputs whose writer confirmed every block get a manifest
+            recipes.write_manifests(v_paths, v_recipes)
+            recipes.write_manifests(a_paths, a_recipes)
+    finally:
+        cleanup(ws)
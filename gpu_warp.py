@@ -13,22 +13,32 @@
 CUDA-accelerated GeoTIFF warping module.
 Handles coordinate remapping and bilinear interpolation on the GPU.
 Refined alpha logic to remove black border stripes using value-based masking.
+Source coordinates are transformed on a sparse lattice and densified bilinearly, the
+same engine runs on the CPU (scipy.ndimage.map_coordinates) when CUDA is unavailable.
+The lattice of a scene is cached per orbit geometry, so VH and repeat passes reuse it.
 """
 
+import json
+import math
 import os
 import threading
-from typing import Tuple, Any
+from typing import Any, Dict, Optional, Tuple
 
-import cupy as cp
 import numpy as np
 import rasterio as rio
-from cupyx.scipy.ndimage import map_coordinates
 from osgeo import gdal, osr
+from scipy.ndimage import map_coordinates as cpu_map_coordinates
 
+import constants as c
 import functions as func
+import stage_cache
+from scratch import ScratchWorkspace
 
 # --- CUDA Autodetection ---
 try:
+    import cupy as cp
+    from cupyx.scipy.ndimage import map_coordinates as gpu_map_coordinates
+
     HAS_CUDA: bool = os.getenv("DISABLE_GPU", "false").lower() not in ("true", "1")
 except ImportError:
     HAS_CUDA = False
@@ -36,54 +46,228 @@ except ImportError:
 # Global lock to prevent multiple concurrent GPU warps (VRAM management)
 gpu_lock = threading.Lock()
 
+# Spacing in destination pixels of the lattice the GDAL transformer is evaluated on
+GRID_STEP: int = 32
+
+# Remap lattices keyed by orbit geometry and output grid
+geometry_cache = stage_cache.StageCache(root=c.GEOMETRY_CACHE_DIR, max_mb=c.GEOMETRY_CACHE_MB)
+GEOMETRY_FILES: Tuple[str, ...] = ("lattice.npy", "gcps.npy", "geometry.json")
+
+
+def _target_grid(src_ds: Any, dst_wkt: str, resolution: int) -> Tuple[Any, int, int]:
+    """
+    Destination transform and size covering the source at exactly resolution,
+    snapped to the global grid with ALIGN_GRID.
+    """
+    if c.ALIGN_GRID:
+        minx, miny, maxx, maxy = func.aligned_bounds(src_ds, resolution, dst_wkt)
+        dst_w = int(round((maxx - minx) / resolution))
+        dst_h = int(round((maxy - miny) / resolution))
+        return rio.transform.from_origin(minx, maxy, resolution, resolution), dst_w, dst_h
+    vrt = gdal.AutoCreateWarpedVRT(src_ds, None, dst_wkt, gdal.GRA_Bilinear)
+    geo_t = vrt.GetGeoTransform()
+    width = geo_t[1] * vrt.RasterXSize
+    height = -geo_t[5] * vrt.RasterYSize
+    vrt = None
+    dst_w = int(math.ceil(width / resolution))
+    dst_h = int(math.ceil(height / resolution))
+    return rio.transform.from_origin(geo_t[0], geo_t[3], resolution, resolution), dst_w, dst_h
+
+
+def _lattice(start: int, count: int, step: int) -> np.ndarray:
+    """Lattice positions covering start .. start + count - 1, both ends included."""
+    pos = np.arange(start, start + count, step, dtype=np.float64)
+    if pos[-1] != start + count - 1:
+        pos = np.append(pos, start + count - 1)
+    return pos
+
+
+def _lerp_weights(lattice: np.ndarray, targets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Lower lattice index and fraction of every target position."""
+    if len(lattice) == 1:
+        return np.zeros(len(targets), dtype=np.intp), np.zeros(len(targets))
+    idx = np.clip(np.searchsorted(lattice, targets, side="right") - 1, 0, len(lattice) - 2)
+    return idx, (targets - lattice[idx]) / (lattice[idx + 1] - lattice[idx])
+
+
+def _scene_lattice(transformer: Any, dst_transform: Any, dst_w: int, dst_h: int) -> np.ndarray:
+    """
+    Source (col, row) pixel coordinates of a GRID_STEP lattice (pixel centres) over the
+    whole destination grid, as float32 (< 0.01 px at S1 scene sizes). Failed points are NaN.
+    """
+    lat_r = _lattice(0, dst_h, GRID_STEP)
+    lat_c = _lattice(0, dst_w, GRID_STEP)
+    lattice = np.empty((len(lat_r), len(lat_c), 2), dtype=np.float32)
+    for i, y in enumerate(lat_r):
+        dst_x, dst_y = dst_transform * (lat_c + 0.5, np.full(len(lat_c), y + 0.5))
+        points, success = transformer.TransformPoints(
+            1, np.column_stack([dst_x, dst_y, np.zeros(len(lat_c))]).tolist()
+        )
+        # Transformer output is in pixel-edge convention, map_coordinates samples centres
+        row = np.array([p[:2] for p in points], dtype=np.float64) - 0.5
+        row[~np.asarray(success, dtype=bool)] = np.nan
+        lattice[i] = row
+    return lattice
 
-def _create_remap_grid(
-    src_path: str, dst_crs: str, resolution: int
-) -> Tuple[str, Any, int, int]:
-    """Uses GDAL to calculate the target geometry and coordinate remap grid."""
-    grid_path = src_path + ".grid.tif"
 
-    with rio.open(src_path) as src:
-        # Create target SRS
+def _remap_block(
+    lattice: np.ndarray, dst_w: int, dst_h: int, r: int, c_off: int, rows: int, cols: int, xp: Any
+) -> Tuple[Any, Any]:
+    """
+    Source (col, row) pixel coordinates of a destination block, densified from the scene
+    lattice: rows are interpolated on the host, columns on the device (xp is numpy or cupy).
+    Only the lattice cells under the block are read, so a memory-mapped lattice stays cold.
+    """
+    lat_r = _lattice(0, dst_h, GRID_STEP)
+    lat_c = _lattice(0, dst_w, GRID_STEP)
+    iy, fy = _lerp_weights(lat_r, np.arange(r, r + rows, dtype=np.float64))
+    ix, fx = _lerp_weights(lat_c, np.arange(c_off, c_off + cols, dtype=np.float64))
+    r0, c0 = int(iy[0]), int(ix[0])
+    cells = np.asarray(
+        lattice[r0 : min(int(iy[-1]) + 2, len(lat_r)), c0 : min(int(ix[-1]) + 2, len(lat_c))],
+        dtype=np.float64,
+    )
+    iy, ix = iy - r0, ix - c0
+
+    fy = fy[:, np.newaxis, np.newaxis]
+    by_row = xp.asarray(cells[iy] * (1 - fy) + cells[np.minimum(iy + 1, len(cells) - 1)] * fy)
+    ix1 = xp.asarray(np.minimum(ix + 1, cells.shape[1] - 1))
+    ix, fx = xp.asarray(ix), xp.asarray(fx)[np.newaxis, :, np.newaxis]
+    dense = by_row[:, ix] * (1 - fx) + by_row[:, ix1] * fx
+    return dense[..., 0], dense[..., 1]
+
+
+def _gcp_array(src_ds: Any) -> np.ndarray:
+    """GCPs of a dataset as (pixel, line, x, y) rows."""
+    return np.array(
+        [(g.GCPPixel, g.GCPLine, g.GCPX, g.GCPY) for g in src_ds.GetGCPs()], dtype=np.float64
+    ).reshape(-1, 4)
+
+
+def _gcps_match(cached: np.ndarray, gcps: np.ndarray, gcp_wkt: str) -> bool:
+    """True if both GCP sets tie the same pixels to ground points within GEOMETRY_TOLERANCE_M."""
+    if cached.shape != gcps.shape or not np.allclose(cached[:, :2], gcps[:, :2]):
+        return False
+    tolerance = c.GEOMETRY_TOLERANCE_M
+    srs = osr.SpatialReference()
+    if gcp_wkt and srs.ImportFromWkt(gcp_wkt) == 0 and srs.IsGeographic():
+        # Metres per degree of latitude; stricter than needed in longitude
+        tolerance /= 111320.0
+    return float(np.max(np.abs(cached[:, 2:] - gcps[:, 2:]))) <= tolerance
+
+
+def _load_geometry(key: str, gcps: np.ndarray, gcp_wkt: str) -> Optional[Tuple[Any, int, int, np.ndarray]]:
+    """Cached destination grid and memory-mapped lattice, if the GCPs still match."""
+    entry = geometry_cache.lookup(key)
+    if entry is None:
+        return None
+    try:
+        with open(os.path.join(entry, "geometry.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        cached_gcps = np.load(os.path.join(entry, "gcps.npy"))
+        if not _gcps_match(cached_gcps, gcps, gcp_wkt):
+            print(f"Geometry cache: GCPs of {key[:12]} moved, recomputing.", flush=True)
+            geometry_cache.drop(key)
+            return None
+        lattice = np.load(os.path.join(entry, "lattice.npy"), mmap_mode="r")
+    except (OSError, ValueError) as e:
+        # Entry evicted by a concurrent product or incomplete
+        print(f"Geometry cache: failed to use entry {key[:12]}: {e}", flush=True)
+        return None
+    print(f"Geometry cache hit: {key[:12]}", flush=True)
+    return rio.transform.Affine(*meta["transform"]), meta["width"], meta["height"], lattice
+
+
+def _store_geometry(
+    key: str, gcps: np.ndarray, dst_transform: Any, dst_w: int, dst_h: int, lattice: np.ndarray
+) -> None:
+    """Publishes a computed lattice to the geometry cache."""
+    with ScratchWorkspace("geometry") as ws:
+        np.save(ws.file("lattice.npy"), lattice)
+        np.save(ws.file("gcps.npy"), gcps)
+        with open(ws.file("geometry.json"), "w", encoding="utf-8") as f:
+            json.dump({"transform": list(dst_transform)[:6], "width": dst_w, "height": dst_h}, f)
+        geometry_cache.store(key, ws, GEOMETRY_FILES)
+
+
+def _srs_id(wkt: str) -> str:
+    """Authority code of a CRS, so a GCP SRS re-encoded by GeoTIFF keys keeps its identity."""
+    srs = osr.SpatialReference()
+    if not wkt or srs.ImportFromWkt(wkt) != 0:
+        return wkt
+    srs.AutoIdentifyEPSG()
+    name, code = srs.GetAuthorityName(None), srs.GetAuthorityCode(None)
+    return f"{name}:{code}" if name and code else wkt
+
+
+def _geometry_key(src_ds: Any, dst_crs: str, resolution: int, geometry_id: Optional[str]) -> Optional[str]:
+    """Geometry cache key of a warp, None if the cache can't be used for it."""
+    if not (geometry_id and geometry_cache.enabled and src_ds.GetGCPCount()):
+        return None
+    return geometry_cache.key(
+        geometry_id,
+        "s1_warp_geometry",
+        {
+            "crs": dst_crs,
+            "res": resolution,
+            "aligned": c.ALIGN_GRID,
+            "step": GRID_STEP,
+            "size": [src_ds.RasterXSize, src_ds.RasterYSize],
+            "gcp_srs": _srs_id(src_ds.GetGCPProjection()),
+        },
+    )
+
+
+def has_cached_geometry(src: str, dst_crs: str, resolution: int, geometry_id: Optional[str]) -> bool:
+    """
+    True if the geometry cache holds a lattice for warping src (any dataset with the
+    size and GCPs of the warp source). The GCPs are only compared when the lattice is used.
+    """
+    src_ds = gdal.Open(src)
+    try:
+        key = _geometry_key(src_ds, dst_crs, resolution, geometry_id)
+        return key is not None and geometry_cache.lookup(key) is not None
+    finally:
+        src_ds = None
+
+
+def prime_geometry(src: str, dst_crs: str, resolution: int, geometry_id: Optional[str]) -> None:
+    """
+    Computes and caches the lattice of a warp done by another engine, so later
+    passes over the same orbit/slice can use the lattice remap.
+    """
+    src_ds = gdal.Open(src)
+    try:
+        if _geometry_key(src_ds, dst_crs, resolution, geometry_id) is None:
+            return
         dst_srs = osr.SpatialReference()
         dst_srs.SetFromUserInput(dst_crs)
+        _warp_geometry(src_ds, dst_crs, dst_srs.ExportToWkt(), resolution, geometry_id)
+    finally:
+        src_ds = None
 
-        # Calculate target dimensions and transform
-        vrt = gdal.AutoCreateWarpedVRT(
-            gdal.Open(src_path), None, dst_srs.ExportToWkt(), gdal.GRA_Bilinear
-        )
-        dst_w = vrt.RasterXSize
-        dst_h = vrt.RasterYSize
-        # Force exact resolution
-        geo_t = list(vrt.GetGeoTransform())
-        geo_t[1] = resolution
-        geo_t[5] = -resolution
-        dst_transform = rio.transform.from_gdal(*geo_t)
-
-        # Create coordinate grid TIFF (Band 1: X, Band 2: Y in source pixel space)
-        # We use standard gdal.Warp to project a coordinate grid
-        # This is the "secret sauce" for the hybrid approach
-        print(f"Creating Remap Grid ({dst_w}x{dst_h})...", flush=True)
-        gdal.Grid(
-            grid_path,
-            src_path,
-            format="GTiff",
-            algorithm="linear",
-            zfield="pixel",
-            outputBounds=[
-                geo_t[0],
-                geo_t[3] + geo_t[5] * dst_h,
-                geo_t[0] + geo_t[1] * dst_w,
-                geo_t[3],
-            ],
-            width=dst_w,
-            height=dst_h,
-        )
-        # Note: In production, we'd use a more direct method to get src_x/src_y for every dst_x/dst_y
-        # but AutoCreateWarpedVRT is the most reliable for GCP-based S1 products.
-        # For simplicity in this overdrive refactor, we use a small trick:
-        # AutoCreateWarpedVRT + a custom transformer.
-        return grid_path, dst_transform, dst_w, dst_h
+
+def _warp_geometry(
+    src_ds: Any, dst_crs: str, dst_wkt: str, resolution: int, geometry_id: Optional[str]
+) -> Tuple[Any, int, int, np.ndarray]:
+    """
+    Destination transform, size and scene lattice of a warp. With a geometry_id (orbit
+    and slice of the product) the lattice comes from the geometry cache when the source
+    GCPs match the cached ones, skipping the GCP transformer entirely.
+    """
+    gcps = _gcp_array(src_ds)
+    key = _geometry_key(src_ds, dst_crs, resolution, geometry_id)
+    if key is not None:
+        cached = _load_geometry(key, gcps, src_ds.GetGCPProjection())
+        if cached is not None:
+            return cached
+
+    dst_transform, dst_w, dst_h = _target_grid(src_ds, dst_wkt, resolution)
+    transformer = gdal.Transformer(src_ds, None, [f"DST_SRS={dst_wkt}"])
+    lattice = _scene_lattice(transformer, dst_transform, dst_w, dst_h)
+    if key is not None:
+        _store_geometry(key, gcps, dst_transform, dst_w, dst_h, lattice)
+    return dst_transform, dst_w, dst_h, lattice
 
 
 def reproject_with_cuda(
@@ -94,40 +278,36 @@ def reproject_with_cuda(
     block_size: int = 1024,
     src_nodata: float = 0,
     dst_alpha: bool = False,
+    geometry_id: Optional[str] = None,
+    creation: Optional[Dict[str, Any]] = None,
 ) -> None:
     """
     Warps a dataset using CUDA streams for interpolation.
     Value-based alpha masking ensures no black border stripes.
+    Without CUDA the same remap runs on the CPU.
+    geometry_id (e.g. relative orbit and slice) enables the geometry cache.
+    creation (rasterio profile entries) overrides the tiled DEFLATE output format.
     """
-    if not HAS_CUDA:
-        warp_opt = gdal.WarpOptions(
-            dstSRS=dst_crs,
-            xRes=resolution,
-            yRes=resolution,
-            multithread=True,
-            dstAlpha=dst_alpha,
-            srcNodata=src_nodata,
-        )
-        gdal.Warp(dst_path, src_path, options=warp_opt)
-        return
-
-    func.perf_logger.start_step(f"GPU Warp: {os.path.basename(src_path)}", use_gpu=True)
-
-    # We use gdal.Warp to create a VRT first to get the transformer
-    # Then we pull the transformer into Python to build our GPU grid
-    with gpu_lock:
+    use_gpu = HAS_CUDA
+    xp = cp if use_gpu else np
+    map_coordinates = gpu_map_coordinates if use_gpu else cpu_map_coordinates
+    func.perf_logger.start_step(
+        f"{'GPU' if use_gpu else 'CPU'} Warp: {os.path.basename(src_path)}", use_gpu=use_gpu
+    )
+
+    # Only one device warp at a time; CPU warps don't need the VRAM lock
+    lock = gpu_lock if use_gpu else threading.Lock()
+    with lock:
+        src_ds = None
         try:
-            # 1. Setup Transformer
+            # 1. Remap lattice (once per file or cached): destination pixel -> source pixel/line
             src_ds = gdal.Open(src_path)
             dst_srs = osr.SpatialReference()
             dst_srs.SetFromUserInput(dst_crs)
-
-            vrt = gdal.AutoCreateWarpedVRT(
-                src_ds, None, dst_srs.ExportToWkt(), gdal.GRA_Bilinear
+            dst_wkt = dst_srs.ExportToWkt()
+            dst_transform, dst_w, dst_h, lattice = _warp_geometry(
+                src_ds, dst_crs, dst_wkt, resolution, geometry_id
             )
-            dst_w, dst_h = vrt.RasterXSize, vrt.RasterYSize
-            v_geo = vrt.GetGeoTransform()
-            dst_transform = rio.transform.from_gdal(*v_geo)
 
             # 2. Open source and prepare output
             with rio.open(src_path) as src:
@@ -148,10 +328,11 @@ def reproject_with_cuda(
                         "BIGTIFF": "YES",
                     }
                 )
+                if creation:
+                    for key in ("compress", "tiled", "blockxsize", "blockysize", "BIGTIFF"):
+                        profile.pop(key, None)
+                    profile.update(creation)
 
-                m_pool = cp.get_default_memory_pool()
-
-                # Transformer for coordinate mapping
                 # We do this block-by-block to save VRAM
                 with rio.open(dst_path, "w", **profile) as dst:
                     for r in range(0, dst_h, block_size):
@@ -160,36 +341,11 @@ def reproject_with_cuda(
                             cols = min(block_size, dst_w - c_off)
                             win = rio.windows.Window(c_off, r, cols, rows)
 
-                            # Create Destination Pixel Grid
-                            # meshgrid on CPU is fine for small blocks
-                            y, x = np.mgrid[r : r + rows, c_off : c_off + cols]
-                            # Map dst pixels to dst coords
-                            dst_x, dst_y = dst_transform * (x, y)
-
-                            # Use GDAL Transformer to map dst coords -> src pixels
-                            # transformer.TransformPoints is vectorized
-                            # We need to use gdal.Transformer
-                            transformer = gdal.Transformer(vrt, None, [])
-                            _, points = transformer.TransformPoints(
-                                1,
-                                list(
-                                    zip(
-                                        dst_x.flatten(),
-                                        dst_y.flatten(),
-                                        [0] * len(dst_x.flatten()),
-                                    )
-                                ),
+                            src_c, src_r = _remap_block(
+                                lattice, dst_w, dst_h, r, c_off, rows, cols, xp
                             )
 
-                            # points is (src_x, src_y, src_z)
-                            src_c = np.array([p[0] for p in points]).reshape(
-                                (rows, cols)
-                            )
-                            src_r = np.array([p[1] for p in points]).reshape(
-                                (rows, cols)
-                            )
-
-                            # Validity mask: Inside src dimensions AND NOT on black padding
+                            # Validity mask: Inside src dimensions (NaN = failed transform)
                             valid_coords = (
                                 (src_c >= 0)
                                 & (src_r >= 0)
@@ -197,37 +353,30 @@ def reproject_with_cuda(
                                 & (src_r < src.height)
                             )
 
-                            if not np.any(valid_coords):
-                                for b in range(1, out_count + 1):
-                                    dst.write(
-                                        np.zeros((rows, cols), dtype=profile["dtype"]),
-                                        b,
-                                        window=win,
-                                    )
+                            if not bool(valid_coords.any()):
                                 continue
 
                             # VRAM Optimization: Load only required source chunk
-                            s_c_min, s_c_max = int(np.min(src_c[valid_coords])), int(
-                                np.max(src_c[valid_coords])
-                            )
-                            s_r_min, s_r_max = int(np.min(src_r[valid_coords])), int(
-                                np.max(src_r[valid_coords])
-                            )
+                            s_c_min = int(src_c[valid_coords].min())
+                            s_c_max = int(src_c[valid_coords].max())
+                            s_r_min = int(src_r[valid_coords].min())
+                            s_r_max = int(src_r[valid_coords].max())
 
                             # Add padding for bilinear interp
                             s_c_off, s_r_off = max(0, s_c_min - 2), max(0, s_r_min - 2)
-                            s_w, s_h = min(
-                                src.width - s_c_off, s_c_max + 2 - s_c_off
-                            ), min(src.height - s_r_off, s_r_max + 2 - s_r_off)
+                            s_w = min(src.width - s_c_off, s_c_max + 2 - s_c_off)
+                            s_h = min(src.height - s_r_off, s_r_max + 2 - s_r_off)
 
                             if s_w <= 0 or s_h <= 0:
                                 continue
 
-                            gpu_coords = cp.array([src_r - s_r_off, src_c - s_c_off])
+                            coords = xp.stack([src_r - s_r_off, src_c - s_c_off])
+                            # Failed transforms sample outside the chunk (cval)
+                            coords[:, ~valid_coords] = -1
                             if dst_alpha:
                                 # Start with absolute geometry mask
                                 # Using the binary valid_coords mask ensures no 1px interpolation artifacts at edges
-                                g_alpha = cp.array(valid_coords, dtype=cp.uint8)
+                                alpha = valid_coords.astype(xp.uint8)
 
                             # Warp original bands
                             for b in range(1, src.count + 1):
@@ -237,39 +386,37 @@ def reproject_with_cuda(
                                         s_c_off, s_r_off, s_w, s_h
                                     ),
                                 )
-                                gpu_data = cp.array(data, dtype=cp.float32)
-
-                                g_warped = map_coordinates(
-                                    gpu_data,
-                                    gpu_coords,
+                                warped = map_coordinates(
+                                    xp.asarray(data, dtype=xp.float32),
+                                    coords,
                                     order=1,
                                     mode="constant",
-                                    cval=0,
+                                    cval=src_nodata,
                                     prefilter=False,
                                 )
 
                                 # Refine alpha: only contribute if warped pixel is actually > threshold
                                 # This helps with source data that might have its own artifacts
                                 if dst_alpha:
-                                    g_alpha &= g_warped > 1e-7
+                                    alpha &= warped > 1e-7
 
-                                dst.write(
-                                    cp.asnumpy(g_warped).astype(profile["dtype"]),
-                                    b,
-                                    window=win,
-                                )
-                                del gpu_data, g_warped
+                                if use_gpu:
+                                    warped = cp.asnumpy(warped)
+                                dst.write(warped.astype(profile["dtype"]), b, window=win)
+                                del warped
 
                             if dst_alpha:
+                                alpha_band = alpha * 255
+                                if use_gpu:
+                                    alpha_band = cp.asnumpy(alpha_band)
                                 dst.write(
-                                    cp.asnumpy(g_alpha * 255).astype(np.uint8),
-                                    out_count,
-                                    window=win,
+                                    alpha_band.astype(profile["dtype"]), out_count, window=win
                                 )
-                                del g_alpha
+                                del alpha
 
-                            del gpu_coords
-                            m_pool.free_all_blocks()
+                            del coords, src_c, src_r, valid_coords
+                            if use_gpu:
+                                cp.get_default_memory_pool().free_all_blocks()
 
                         print(
                             f"Warp Progress: {int((r+rows)/dst_h * 100)}%",
@@ -279,7 +426,6 @@ def reproject_with_cuda(
             print("\nWarp Complete.", flush=True)
         finally:
             src_ds = None
-            vrt = None
             func.perf_logger.end_step()
 
 
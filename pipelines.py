@@ -14,25 +14,29 @@ Master pipeline orchestrator for Sentinel-1 and Sentinel-2.
 Handles searching, downloading, and triggering individual sensor pipelines.
 Refactored for sequential Search -> Download -> Process flow.
 Now honors processed-file logging only after successful handling.
+Independent products are processed in parallel by the product scheduler.
+Optionally pipelines downloads with processing through a bounded queue.
 """
 
 import argparse
+import multiprocessing as mp
 import os
+import queue
 import re
 import time
 import zipfile
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional
 
 from dotenv import load_dotenv
-from osgeo import gdal
 
 import constants as c
 import copernicus as cop
+import extract
 import functions as func
-import functions_s1 as s1
 import functions_s2 as s2
 import inventory_manager
 from correlate import run_correlation
+import scheduler
 import search
 import cleanup
 import notifications
@@ -62,6 +66,19 @@ FUSION_PROCESSES: List[str] = os.getenv(
 CLEANUP_AFTER_RUN: bool = os.getenv("CLEANUP_AFTER_RUN", "false").lower() == "true"
 CLEANUP_DAYS: int = int(os.getenv("CLEANUP_DAYS", "30"))
 
+# Overlap downloads with processing instead of downloading everything first
+PIPELINED_DOWNLOADS: bool = os.getenv("PIPELINED_DOWNLOADS", "false").lower() == "true"
+# Unzipped products waiting for processing (bounds extra disk usage)
+DOWNLOAD_QUEUE_SIZE: int = int(os.getenv("DOWNLOAD_QUEUE_SIZE", "2"))
+# Products downloaded at once over the shared connection pool
+DOWNLOAD_WORKERS: int = int(os.getenv("DOWNLOAD_WORKERS", "2"))
+# Parallel byte-range segments per product (1 = single stream)
+DOWNLOAD_SEGMENTS: int = int(os.getenv("DOWNLOAD_SEGMENTS", "1"))
+# Keep product zips and read them through GDAL's /vsizip/ instead of extracting
+READ_FROM_ZIP: bool = os.getenv("READ_FROM_ZIP", "false").lower() == "true"
+# Extract only the S2 bands and metadata the renderer reads
+S2_SELECTIVE_EXTRACT: bool = os.getenv("S2_SELECTIVE_EXTRACT", "true").lower() == "true"
+
 USERNAME: str = os.getenv("COPERNICUS_USERNAME", "")
 PASSWORD: str = os.getenv("COPERNICUS_PASSWORD", "")
 mycop: Any = cop.connect(USERNAME, PASSWORD)
@@ -70,36 +87,93 @@ s1_boxes: List[str] = func.get_boxes(S1_BOX)
 s2_boxes: List[str] = func.get_boxes(S2_BOX)
 
 
-def download_products(
+def product_zip(filename: str) -> str:
+    """Returns the path of the downloaded zip archive of a product."""
+    return os.path.join(c.DIRS["DL"], f"{filename}.zip")
+
+
+def product_root(filename: str) -> str:
+    """
+    Returns the root of a downloaded product: the extracted directory or,
+    if only the archive is present, its /vsizip/ path.
+    """
+    target_path = os.path.join(c.DIRS["DL"], filename)
+    if not os.path.exists(target_path) and os.path.exists(product_zip(filename)):
+        return f"/vsizip/{product_zip(filename)}/{filename}"
+    return target_path
+
+
+def unzip_product(filename: str) -> None:
+    """Extracts a downloaded product zip into the download directory and removes the zip."""
+    if READ_FROM_ZIP:
+        print(f"Keeping {filename}.zip, reading it via /vsizip/.", flush=True)
+        return
+    downloaded_zip = product_zip(filename)
+    print(f"Unzipping {downloaded_zip}...", flush=True)
+    if S2_SELECTIVE_EXTRACT and filename.startswith("S2"):
+        resolutions = s2.required_subdatasets(S2_PROCESSES, FUSION_PROCESSES)
+        extract.extract_s2_product(downloaded_zip, c.DIRS["DL"], resolutions)
+    else:
+        with zipfile.ZipFile(downloaded_zip, "r") as zip_ref:
+            zip_ref.extractall(c.DIRS["DL"])
+    os.remove(downloaded_zip)
+
+
+def log_download_stats(file_id: str, filename: str) -> None:
+    """Reports the throughput of a finished download to the performance log."""
+    stats = mycop.last_stats.get(file_id)
+    if not stats:
+        return
+    msg = (
+        f"Download {filename}: {stats['bytes'] / 1048576:.1f}MB in "
+        f"{stats['seconds']:.1f}s ({stats['mb_per_s']:.2f}MB/s)"
+    )
+    print(msg, flush=True)
+    func.perf_logger.log_info(msg)
+
+
+def iter_downloads(
     search_result: Dict[str, List[Dict[str, Any]]],
-) -> List[Dict[str, Any]]:
-    """Downloads and unzips satellite products. Returns list of products ready for processing."""
-    ready_products: List[Dict[str, Any]] = []
-    print("\nStarting downloads phase.", flush=True)
+) -> Iterator[Dict[str, Any]]:
+    """
+    Downloads and unzips the products of a search result, DOWNLOAD_WORKERS at a time.
+    Yields each product as soon as it is ready for processing.
+    """
+    titles: Dict[str, Dict[str, Any]] = {}
     for box_files in search_result.values():
         for feat in box_files:
-            file_id: str = feat["id"]
             filename: str = feat["properties"]["title"]
-
-            target_path = os.path.join(c.DIRS["DL"], filename)
-            if os.path.exists(target_path):
+            if os.path.exists(os.path.join(c.DIRS["DL"], filename)) or (
+                READ_FROM_ZIP and os.path.exists(product_zip(filename))
+            ):
                 print(f"Already have {filename}, ready for processing.", flush=True)
-                ready_products.append(feat)
+                yield feat
             else:
-                try:
-                    mycop.refreshToken()
-                    if mycop.download(file_id, filename, c.DIRS["DL"]):
-                        time.sleep(1)
-                        downloaded_zip = os.path.join(c.DIRS["DL"], f"{filename}.zip")
-                        print(f"Unzipping {downloaded_zip}...", flush=True)
-                        with zipfile.ZipFile(downloaded_zip, "r") as zip_ref:
-                            zip_ref.extractall(c.DIRS["DL"])
-                        os.remove(downloaded_zip)
-                        ready_products.append(feat)
-                except Exception as error:  # pylint: disable=broad-exception-caught
-                    print(
-                        f"Problem downloading/unzipping {filename}: {error}", flush=True
-                    )
+                titles[feat["id"]] = feat
+
+    pending = [(file_id, feat["properties"]["title"]) for file_id, feat in titles.items()]
+    for file_id, success in mycop.download_many(
+        pending, c.DIRS["DL"], workers=DOWNLOAD_WORKERS, segments=DOWNLOAD_SEGMENTS
+    ):
+        feat = titles[file_id]
+        filename = feat["properties"]["title"]
+        if not success:
+            print(f"Problem downloading {filename}", flush=True)
+            continue
+        log_download_stats(file_id, filename)
+        try:
+            unzip_product(filename)
+            yield feat
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            print(f"Problem unzipping {filename}: {error}", flush=True)
+
+
+def download_products(
+    search_result: Dict[str, List[Dict[str, Any]]],
+) -> List[Dict[str, Any]]:
+    """Downloads and unzips satellite products. Returns list of products ready for processing."""
+    print("\nStarting downloads phase.", flush=True)
+    ready_products: List[Dict[str, Any]] = list(iter_downloads(search_result))
 
     print(
         f"Downloads phase complete. {len(ready_products)} products ready.", flush=True
@@ -107,8 +181,74 @@ def download_products(
     return ready_products
 
 
+def _download_stream(
+    search_results: Dict[str, Dict[str, List[Dict[str, Any]]]],
+    queues: Dict[str, Any],
+) -> None:
+    """Download process entry point: feeds the queue of every sensor and ends it with None."""
+    for sat, search_result in search_results.items():
+        print(f"\nStarting {sat.upper()} download stream.", flush=True)
+        try:
+            for feat in iter_downloads(search_result):
+                queues[sat].put(feat)
+        finally:
+            queues[sat].put(None)
+    print("Download stream complete.", flush=True)
+
+
+def start_download_stream(
+    search_results: Dict[str, Dict[str, List[Dict[str, Any]]]],
+) -> Dict[str, Iterator[Dict[str, Any]]]:
+    """
+    Downloads products in a separate process and hands each one to the processing
+    stage through a bounded queue as soon as it is unzipped.
+    Sensors are downloaded in order, so later sensors keep downloading while earlier ones process.
+    The scheduler forks product workers from this process, which therefore must not run
+    the download threads (their locks would be copied into the workers mid-use).
+    """
+    ctx = mp.get_context("fork")
+    queues = {sat: ctx.Queue(maxsize=DOWNLOAD_QUEUE_SIZE) for sat in search_results}
+    proc = ctx.Process(
+        target=_download_stream, args=(search_results, queues), name="download-stream", daemon=True
+    )
+    proc.start()
+
+    def consume(sat_queue: Any) -> Iterator[Dict[str, Any]]:
+        while True:
+            try:
+                feat = sat_queue.get(timeout=5)
+            except queue.Empty:
+                if proc.is_alive():
+                    continue
+                print(f"Download stream ended unexpectedly (exit code {proc.exitcode}).", flush=True)
+                return
+            if feat is None:
+                return
+            yield feat
+
+    return {sat: consume(q) for sat, q in queues.items()}
+
+
+def s1_manifest(feat: Dict[str, Any]) -> Optional[str]:
+    """Returns the manifest path of a downloaded S1 product, or None if missing."""
+    filename: str = feat["properties"]["title"]
+    manifest = os.path.join(product_root(filename), "manifest.safe")
+    return manifest if func.vsi_exists(manifest) else None
+
+
+def s2_manifest(feat: Dict[str, Any]) -> Optional[str]:
+    """Returns the L2A/L1C manifest path of a downloaded S2 product, or None if missing."""
+    root = product_root(feat["properties"]["title"])
+    # Check for L2A or L1C manifest
+    manifest = os.path.join(root, f"MTD_MSI{S2_PRODUCTTYPE}.xml")
+    if not func.vsi_exists(manifest):
+        # Fallback to other possible manifest name
+        manifest = os.path.join(root, "MTD_MSIL2A.xml")
+    return manifest if func.vsi_exists(manifest) else None
+
+
 def scan_local_products() -> Dict[str, List[Dict[str, Any]]]:
-    """Scans the download directory for existing .SAFE or product folders."""
+    """Scans the download directory for existing .SAFE or product folders (or zips with READ_FROM_ZIP)."""
     print(f"\nScanning local directory {c.DIRS['DL']} for products...", flush=True)
     local_ready: Dict[str, List[Dict[str, Any]]] = {"s1": [], "s2": []}
 
@@ -117,7 +257,11 @@ def scan_local_products() -> Dict[str, List[Dict[str, Any]]]:
 
     for item in os.listdir(c.DIRS["DL"]):
         item_path = os.path.join(c.DIRS["DL"], item)
-        if not os.path.isdir(item_path):
+        if READ_FROM_ZIP and item.endswith(".zip"):
+            item = item[: -len(".zip")]
+            if os.path.isdir(os.path.join(c.DIRS["DL"], item)):
+                continue
+        elif not os.path.isdir(item_path):
             continue
 
         # Basic identification by name
@@ -172,29 +316,34 @@ if __name__ == "__main__":
                 s2_res = None
 
         # 2. Download Phase
-        if s1_res:
-            print("\n--- Sentinel 1 Downloads ---", flush=True)
-            s1_ready = download_products(s1_res)
-
-        if s2_res:
-            print("\n--- Sentinel 2 Downloads ---", flush=True)
-            s2_ready = download_products(s2_res)
+        if PIPELINED_DOWNLOADS:
+            # Processing starts as soon as the first product has landed
+            print(">>> MODE: Pipelined download and processing.", flush=True)
+            to_stream = {}
+            if s1_res:
+                to_stream["s1"] = s1_res
+            if s2_res:
+                to_stream["s2"] = s2_res
+            streams = start_download_stream(to_stream)
+            s1_ready = streams.get("s1", [])
+            s2_ready = streams.get("s2", [])
+        else:
+            if s1_res:
+                print("\n--- Sentinel 1 Downloads ---", flush=True)
+                s1_ready = download_products(s1_res)
+
+            if s2_res:
+                print("\n--- Sentinel 2 Downloads ---", flush=True)
+                s2_ready = download_products(s2_res)
 
     # 3. Process Phase
     processed_s1 = []
     if "S1" in PIPELINES_LIST and s1_ready:
         print("\n--- Sentinel 1 Processing ---", flush=True)
-        for feat in s1_ready:
-            filename = feat["properties"]["title"]
-            manifest = os.path.join(c.DIRS["DL"], filename, "manifest.safe")
-            if os.path.exists(manifest):
-                try:
-                    ds_obj = gdal.Open(manifest)
-                    s1.run_pipeline(ds_obj, S1_PROCESSES, FUSION_PROCESSES)
-                    ds_obj = None
-                    processed_s1.append(feat)
-                except Exception as e:
-                    print(f"Error processing S1 product {filename}: {e}", flush=True)
+        s1_jobs = ((feat, m) for feat in s1_ready if (m := s1_manifest(feat)))
+        processed_s1 = scheduler.run_products(
+            "s1", s1_jobs, S1_PROCESSES, FUSION_PROCESSES
+        )
 
         # Update log ONLY after successful processing and NOT in --downloaded mode
         if processed_s1 and not args.downloaded:
@@ -204,24 +353,10 @@ if __name__ == "__main__":
     processed_s2 = []
     if "S2" in PIPELINES_LIST and s2_ready:
         print("\n--- Sentinel 2 Processing ---", flush=True)
-        for feat in s2_ready:
-            filename = feat["properties"]["title"]
-            # Check for L2A or L1C manifest
-            manifest = os.path.join(
-                c.DIRS["DL"], filename, f"MTD_MSI{S2_PRODUCTTYPE}.xml"
-            )
-            if not os.path.exists(manifest):
-                # Fallback to other possible manifest name
-                manifest = os.path.join(c.DIRS["DL"], filename, "MTD_MSIL2A.xml")
-
-            if os.path.exists(manifest):
-                try:
-                    ds_obj = gdal.Open(manifest)
-                    s2.run_pipeline(ds_obj, S2_PROCESSES, FUSION_PROCESSES)
-                    ds_obj = None
-                    processed_s2.append(feat)
-                except Exception as e:
-                    print(f"Error processing S2 product {filename}: {e}", flush=True)
+        s2_jobs = ((feat, m) for feat in s2_ready if (m := s2_manifest(feat)))
+        processed_s2 = scheduler.run_products(
+            "s2", s2_jobs, S2_PROCESSES, FUSION_PROCESSES
+        )
 
         if processed_s2 and not args.downloaded:
             search.update_last_run("s2", processed_s2)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# recipes.py from https://github.com/sgofferj/python-sentinel-pipeline
+#
+# Copyright Stefan Gofferje
+#
+# Licensed under the Gnu General Public License Version 3 or higher (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+
+"""
+Render recipes and incremental re-rendering.
+Every S1/S2 output gets a small manifest recording its input product, the rendering
+constants it depends on and a hash of the rendering code. The planner compares these
+with the current recipe, so only outputs whose inputs or recipe changed are re-rendered.
+"""
+
+import hashlib
+import json
+import os
+from functools import lru_cache
+from typing import Any, Dict, Sequence
+
+import numpy as np
+
+import constants as c
+import functions as func
+
+# Manifest suffix (not .json, which is reserved for the viewer sidecars)
+MANIFEST_SUFFIX: str = ".tif.recipe"
+
+
+@lru_cache(maxsize=None)
+def code_version(modules: Sequence[str]) -> str:
+    """Returns a short hash of the source files of the given rendering modules."""
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(os.path.join(c.BASE_DIR, module), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def _jsonable(value: Any) -> Any:
+    """Converts numpy values in recipe parameters into plain JSON types."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def output_recipe(
+    input_id: str, params: Dict[str, Any], modules: Sequence[str]
+) -> Dict[str, Any]:
+    """Builds the manifest an output must carry to be considered up to date."""
+    return {
+        "input": input_id,
+        "params": _jsonable(params),
+        "code": code_version(tuple(modules)),
+    }
+
+
+def manifest_path(name: str) -> str:
+    """Returns the manifest path of an output (name without .tif)."""
+    return f"{name}{MANIFEST_SUFFIX}"
+
+
+def is_stale(name: str, recipe: Dict[str, Any]) -> bool:
+    """
+    Checks if an output has to be (re-)rendered.
+    Outputs from before manifests existed are kept as long as they are valid.
+    """
+    if not func.output_exists(name):
+        return True
+    path = manifest_path(name)
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f) != recipe
+    except (json.JSONDecodeError, IOError):
+        return True
+
+
+def stale_outputs(
+    paths: Dict[str, str], recipes: Dict[str, Dict[str, Any]]
+) -> Dict[str, str]:
+    """Returns the subset of output paths whose manifest does not match the recipe."""
+    stale = {p: path for p, path in paths.items() if is_stale(path, recipes[p])}
+    for p in sorted(set(paths) - set(stale)):
+        print(f"Up to date: {os.path.basename(paths[p])}", flush=True)
+    return stale
+
+
+def write_manifests(
+    paths: Dict[str, str], recipes: Dict[str, Dict[str, Any]]
+) -> None:
+    """Records the recipes of freshly rendered outputs."""
+    for p, path in paths.items():
+        if not os.path.exists(f"{path}.tif"):
+            continue
+        with open(manifest_path(path), "w", encoding="utf-8") as f:
+            json.dump(recipes[p], f, sort_keys=True)
+
+
+def discard_outputs(paths: Dict[str, str]) -> None:
+    """
+    Removes the outputs of a failed render with their manifests. A partly written
+    output without manifest would otherwise pass as a valid pre-manifest output.
+    """
+    for path in paths.values():
+        for f in (f"{path}.tif", manifest_path(path)):
+            if os.path.exists(f):
+                os.remove(f)
+
+
+if __name__ == "__main__":
+    pass
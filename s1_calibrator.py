@@ -15,12 +15,13 @@ Handles Sigma0 calibration and thermal noise removal using high-concurrency math
 Uses GDAL for robust georeferencing (GCPs).
 """
 
+import contextlib
 import gc
-import glob
 import os
 import queue
 import threading
-from typing import Any, Dict, List, Tuple
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
 import rasterio as rio
@@ -29,6 +30,7 @@ from osgeo import gdal
 from rasterio.windows import Window
 from scipy.interpolate import interp1d
 
+import cpu_kernels
 import functions as func
 
 # --- CUDA Acceleration ---
@@ -40,6 +42,79 @@ except ImportError:
     HAS_CUDA = False
 
 
+class LutGrid:
+    """
+    Bilinear interpolation of sparse annotation vectors (line, pixels, values), linearly
+    extrapolated at the edges like interp1d(fill_value="extrapolate").
+    Column weights are computed once per distinct pixel grid and a window only expands
+    the few vectors bracketing its lines, instead of keeping a dense lines x width grid.
+    """
+
+    def __init__(self, vectors: List[Dict[str, Any]], key: str, width: int) -> None:
+        self.width: int = width
+        self.lines: np.ndarray = np.array([v["line"] for v in vectors], dtype=np.float64)
+        self.values: List[np.ndarray] = [np.asarray(v[key], dtype=np.float64) for v in vectors]
+        grids: Dict[bytes, Tuple[np.ndarray, np.ndarray]] = {}
+        self.columns: List[Tuple[np.ndarray, np.ndarray]] = []
+        for v in vectors:
+            pixels = np.asarray(v["pixels"], dtype=np.float64)
+            if pixels.tobytes() not in grids:
+                grids[pixels.tobytes()] = self._weights(pixels, np.arange(width, dtype=np.float64))
+            self.columns.append(grids[pixels.tobytes()])
+
+    @staticmethod
+    def _weights(nodes: np.ndarray, targets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Lower node index and fractional offset of every target (may leave [0, 1])."""
+        hi = np.clip(np.searchsorted(nodes, targets), 1, len(nodes) - 1)
+        lo = hi - 1
+        return lo, (targets - nodes[lo]) / (nodes[hi] - nodes[lo])
+
+    def _row(self, k: int, cols: slice) -> np.ndarray:
+        """Values of vector k over the columns cols."""
+        lo, frac = self.columns[k]
+        lo, frac = lo[cols], frac[cols]
+        vals = self.values[k]
+        return (vals[lo] + frac * (vals[lo + 1] - vals[lo])).astype(np.float32)
+
+    def window(
+        self, row_off: int, rows: int, col_off: int = 0, cols: Optional[int] = None
+    ) -> np.ndarray:
+        """Interpolated float32 block of rows x cols (default: full width) at (row_off, col_off)."""
+        col_sel = slice(col_off, self.width if cols is None else col_off + cols)
+        seg, t = self._weights(self.lines, np.arange(row_off, row_off + rows, dtype=np.float64))
+        t = t.astype(np.float32)[:, np.newaxis]
+        out = np.empty((rows, col_sel.stop - col_sel.start), dtype=np.float32)
+        # Lines are sorted, so every vector pair covers one contiguous run of rows
+        for k in np.unique(seg):
+            run = np.flatnonzero(seg == k)
+            sel = slice(run[0], run[-1] + 1)
+            base = self._row(k, col_sel)
+            np.multiply(t[sel], self._row(k + 1, col_sel) - base, out=out[sel])
+            out[sel] += base
+        return out
+
+
+# LUT states of the calibrated VRTs currently open, by VRT path (see calibrated_vrts)
+_VRT_LUTS: Dict[str, Dict[str, Any]] = {}
+
+
+def vrt_sigma0(
+    in_ar: List[np.ndarray],
+    out_ar: np.ndarray,
+    xoff: int,
+    yoff: int,
+    xsize: int,
+    ysize: int,
+    *_args: Any,
+    **kwargs: Any,
+) -> None:
+    """GDAL VRT pixel function: calibrates the DN window GDAL requests from the product."""
+    state = _VRT_LUTS[kwargs["vrt"]]
+    cal_block = state["cal"].window(yoff, ysize, xoff, xsize)
+    noise_block = state["noise"].window(yoff, ysize, xoff, xsize)
+    out_ar[:] = S1Calibrator._sigma0_cpu(in_ar[0], cal_block, noise_block)  # pylint: disable=protected-access
+
+
 class S1Calibrator:  # pylint: disable=too-few-public-methods
     """
     S1Calibrator handles radiometric calibration and thermal noise removal
@@ -47,27 +122,33 @@ class S1Calibrator:  # pylint: disable=too-few-public-methods
     """
 
     def __init__(self, safe_path: str) -> None:
-        self.safe_path: str = os.path.abspath(safe_path)
+        # /vsizip/ paths read the product straight from the downloaded archive
+        self.is_virtual: bool = safe_path.startswith("/vsi")
+        self.safe_path: str = safe_path if self.is_virtual else os.path.abspath(safe_path)
         self.manifest_path: str = os.path.join(self.safe_path, "manifest.safe")
         self.annotation_dir: str = os.path.join(self.safe_path, "annotation")
         self.calibration_dir: str = os.path.join(self.annotation_dir, "calibration")
 
-        if not os.path.exists(self.manifest_path):
+        if not func.vsi_exists(self.manifest_path):
             raise ValueError(f"manifest.safe not found in: {self.safe_path}")
 
     def _get_xml_files(self, pol: str) -> Tuple[str, str]:
         """Finds the calibration and noise XML files for a polarization."""
         pol = pol.lower()
-        cal_files = glob.glob(
+        cal_files = func.vsi_glob(
             os.path.join(self.calibration_dir, f"calibration-s1?-iw-grd-{pol}-*.xml")
         )
-        noise_files = glob.glob(
+        noise_files = func.vsi_glob(
             os.path.join(self.calibration_dir, f"noise-s1?-iw-grd-{pol}-*.xml")
         )
         if not cal_files or not noise_files:
             raise FileNotFoundError(f"Could not find XML components for polarization: {pol}")
         return cal_files[0], noise_files[0]
 
+    def subdataset(self, polarization: str) -> str:
+        """GDAL subdataset of the uncalibrated amplitudes (size and GCPs of the calibrated outputs)."""
+        return self._get_subdataset_string(polarization)
+
     def _get_subdataset_string(self, polarization: str) -> str:
         """Constructs the GDAL subdataset string for the manifest."""
         return (
@@ -75,10 +156,28 @@ class S1Calibrator:  # pylint: disable=too-few-public-methods
             f"IW_{polarization.upper()}:AMPLITUDE"
         )
 
+    def _xml_root(self, xml_path: str) -> Any:
+        """Parses an annotation XML from disk or from inside the product archive."""
+        if self.is_virtual:
+            return etree.fromstring(func.vsi_read(xml_path))
+        return etree.parse(xml_path).getroot()
+
+    def geometry_id(self) -> str:
+        """
+        Acquisition geometry of the product (relative orbit and slice number), shared
+        by repeat passes over the same ground track.
+        """
+        root = self._xml_root(self.manifest_path)
+
+        def first(name: str) -> str:
+            nodes = root.xpath(f"//*[local-name()='{name}']")
+            return nodes[0].text.strip() if nodes and nodes[0].text else "NA"
+
+        return f"S1_R{first('relativeOrbitNumber')}_S{first('sliceNumber')}"
+
     def _parse_calibration_xml(self, cal_xml: str) -> List[Dict[str, Any]]:
         """Parses the calibration XML to extract Sigma0 vectors."""
-        tree = etree.parse(cal_xml)
-        root = tree.getroot()
+        root = self._xml_root(cal_xml)
         vectors = []
         for vector_node in root.xpath("//calibrationVector"):
             line = int(vector_node.find("line").text)
@@ -89,8 +188,7 @@ class S1Calibrator:  # pylint: disable=too-few-public-methods
 
     def _parse_noise_xml(self, noise_xml: str) -> List[Dict[str, Any]]:
         """Parses the noise XML to extract thermal noise vectors."""
-        tree = etree.parse(noise_xml)
-        root = tree.getroot()
+        root = self._xml_root(noise_xml)
         vectors = []
         noise_nodes = root.xpath("//noiseVector") or root.xpath("//noiseRangeVector")
         for vector_node in noise_nodes:
@@ -108,7 +206,138 @@ class S1Calibrator:  # pylint: disable=too-few-public-methods
                 vectors.append({"line": line, "pixels": pixel_indices, "noise": noise_values})
         return vectors
 
-    # pylint: disable=too-many-arguments,too-many-locals,too-many-statements
+    def _create_output(
+        self, sds_string: str, output_path: str, creation_options: Optional[List[str]] = None
+    ) -> Tuple[int, int]:
+        """
+        Creates an empty Float32 GeoTIFF carrying the GCPs, CRS and metadata of the
+        subdataset. Calibrated blocks are written straight into it, no DN copy is made.
+        """
+        src = gdal.Open(sds_string)
+        width, height = src.RasterXSize, src.RasterYSize
+        dst = gdal.GetDriverByName("GTiff").Create(
+            output_path,
+            width,
+            height,
+            1,
+            gdal.GDT_Float32,
+            options=creation_options
+            or ["TILED=YES", "COMPRESS=DEFLATE", "BIGTIFF=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256"],
+        )
+        if src.GetGCPCount():
+            dst.SetGCPs(src.GetGCPs(), src.GetGCPProjection())
+        if src.GetProjection():
+            dst.SetProjection(src.GetProjection())
+            dst.SetGeoTransform(src.GetGeoTransform())
+        dst.SetMetadata(src.GetMetadata())
+        dst = None
+        src = None
+        return width, height
+
+    def _lut_state(self, polarization: str, width: int, gpu: bool = HAS_CUDA) -> Dict[str, Any]:
+        """Parses the annotation vectors of a polarization into its interpolation state."""
+        cal_xml, noise_xml = self._get_xml_files(polarization)
+        cal_vectors = self._parse_calibration_xml(cal_xml)
+        noise_vectors = self._parse_noise_xml(noise_xml)
+
+        if not gpu:
+            return {
+                "cal": LutGrid(cal_vectors, "sigma", width),
+                "noise": LutGrid(noise_vectors, "noise", width),
+            }
+
+        lines = np.array([v["line"] for v in cal_vectors])
+        grid_vals_sigma = []
+        grid_vals_noise = []
+        for i, v in enumerate(cal_vectors):
+            f_s = interp1d(v["pixels"], v["sigma"], kind="linear", fill_value="extrapolate")
+            grid_vals_sigma.append(f_s(np.arange(width)))
+            nv = next((n for n in noise_vectors if n["line"] == v["line"]), noise_vectors[min(i, len(noise_vectors)-1)])
+            f_n = interp1d(nv["pixels"], nv["noise"], kind="linear", fill_value="extrapolate")
+            grid_vals_noise.append(f_n(np.arange(width)))
+        return {
+            "n_lines": len(lines),
+            "g_lines": cp.array(lines, dtype=cp.float32),
+            "g_lut_sigma": cp.array(grid_vals_sigma, dtype=cp.float32),
+            "g_lut_noise": cp.array(grid_vals_noise, dtype=cp.float32),
+        }
+
+    @staticmethod
+    def _sigma0_gpu(state: Dict[str, Any], dn: np.ndarray, row_off: int, rows: int) -> np.ndarray:
+        """Calibrates one strip on the GPU from the dense LUT grid."""
+        m_pool = cp.get_default_memory_pool()
+        g_dn = cp.array(dn)
+        g_valid = g_dn > 0
+        target_lines = cp.arange(row_off, row_off + rows, dtype=cp.float32)
+        g_lines = state["g_lines"]
+
+        def gpu_interp_2d(lut, target_lines):
+            idx = cp.searchsorted(g_lines, target_lines) - 1
+            idx = cp.clip(idx, 0, state["n_lines"] - 2)
+            x0 = g_lines[idx]; x1 = g_lines[idx+1]
+            weight = (target_lines - x0) / (x1 - x0)
+            y0 = lut[idx]; y1 = lut[idx+1]
+            return y0 + weight[:, cp.newaxis] * (y1 - y0)
+
+        g_cal = gpu_interp_2d(state["g_lut_sigma"], target_lines)
+        g_noise = gpu_interp_2d(state["g_lut_noise"], target_lines)
+
+        g_sigma0 = cp.zeros_like(g_dn)
+        # Ensure valid pixels are NEVER absolute 0 to preserve nodata=0 meaning
+        g_sigma0[g_valid] = cp.maximum((cp.square(g_dn[g_valid]) - g_noise[g_valid]) / cp.square(g_cal[g_valid]), 1e-9)
+
+        sigma0: np.ndarray = cp.asnumpy(g_sigma0)
+        del g_dn, g_valid, g_cal, g_noise, g_sigma0, target_lines
+        m_pool.free_all_blocks()
+        return sigma0
+
+    @staticmethod
+    def _sigma0_cpu(dn: np.ndarray, cal_block: np.ndarray, noise_block: np.ndarray) -> np.ndarray:
+        """Calibrates one strip on the CPU."""
+        if cpu_kernels.HAS_NUMBA:
+            return cpu_kernels.sigma0(dn, cal_block, noise_block)
+        valid_mask = dn > 0
+        sigma0 = np.zeros_like(dn)
+        sigma0[valid_mask] = np.maximum((np.square(dn[valid_mask]) - noise_block[valid_mask]) / np.square(cal_block[valid_mask]), 1e-9)
+        return sigma0
+
+    @contextlib.contextmanager
+    def calibrated_vrts(self, outputs: Dict[str, str]) -> Iterator[Dict[str, str]]:
+        """
+        Exposes calibration as a block source: writes one VRT per polarization whose band
+        is the sigma0 of the product, computed by vrt_sigma0 for whatever window GDAL
+        reads. gdal.Warp can consume it directly, so no calibrated raster is written.
+        The VRTs are only readable (by this process) inside the context.
+        """
+        try:
+            for pol, vrt_path in outputs.items():
+                sds_string = self._get_subdataset_string(pol)
+                # Translate copies size, GCPs and metadata; the band becomes a derived band
+                gdal.Translate(vrt_path, sds_string, format="VRT", outputType=gdal.GDT_Float32)
+                tree = ET.parse(vrt_path)
+                band = tree.getroot().find("VRTRasterBand")
+                band.set("subClass", "VRTDerivedRasterBand")
+                for tag, text in (
+                    ("PixelFunctionType", f"{__name__}.vrt_sigma0"),
+                    ("PixelFunctionLanguage", "Python"),
+                    ("SourceTransferType", "Float32"),
+                ):
+                    ET.SubElement(band, tag).text = text
+                ET.SubElement(band, "PixelFunctionArguments", vrt=vrt_path)
+                tree.write(vrt_path)
+                width = int(tree.getroot().get("rasterXSize"))
+                _VRT_LUTS[vrt_path] = self._lut_state(pol, width, gpu=False)
+            with gdal.config_options(
+                {
+                    "GDAL_VRT_ENABLE_PYTHON": "TRUSTED_MODULES",
+                    "GDAL_VRT_PYTHON_TRUSTED_MODULES": __name__,
+                }
+            ):
+                yield outputs
+        finally:
+            for vrt_path in outputs.values():
+                _VRT_LUTS.pop(vrt_path, None)
+
     def calibrate(
         self,
         polarization: str,
@@ -116,161 +345,122 @@ class S1Calibrator:  # pylint: disable=too-few-public-methods
         block_size: int = 1024,
         build_ov: bool = True,
         workers: int = 4,
+    ) -> None:
+        """Performs calibration and noise removal of a single polarization."""
+        self.calibrate_many({polarization: output_path}, block_size, build_ov, workers)
+
+    # pylint: disable=too-many-locals,too-many-statements
+    def calibrate_many(
+        self,
+        outputs: Dict[str, str],
+        block_size: int = 1024,
+        build_ov: bool = True,
+        workers: int = 4,
+        creation_options: Optional[List[str]] = None,
     ) -> None:
         """
-        Performs calibration and noise removal.
-        Uses GDAL Translate to ensure GCPs are perfectly preserved.
+        Performs calibration and noise removal of several polarizations (e.g. VV and VH)
+        in one pass. Each strip is read for all polarizations at once and calibrated by
+        a shared pool of workers; the results go straight into GCP-preserving outputs
+        (GeoTIFFs, creation_options default to tiled DEFLATE).
         """
-        cal_xml, noise_xml = self._get_xml_files(polarization)
-        sds_string = self._get_subdataset_string(polarization)
-        cal_vectors = self._parse_calibration_xml(cal_xml)
-        noise_vectors = self._parse_noise_xml(noise_xml)
+        sds = {pol: self._get_subdataset_string(pol) for pol in outputs}
 
-        # 1. Create the output file with proper metadata using GDAL Translate
-        # This copies GCPs, CRS, etc. perfectly from the subdataset.
-        print(f"Initializing {os.path.basename(output_path)} with source metadata...", flush=True)
-        gdal.Translate(
-            output_path, 
-            sds_string, 
-            outputType=gdal.GDT_Float32,
-            creationOptions=["TILED=YES", "COMPRESS=DEFLATE", "BIGTIFF=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256"]
-        )
+        # 1. Create empty outputs carrying the GCPs, CRS, etc. of the subdatasets
+        dims = set()
+        for pol, output_path in outputs.items():
+            print(f"Initializing {os.path.basename(output_path)} with source metadata...", flush=True)
+            dims.add(self._create_output(sds[pol], output_path, creation_options))
+        if len(dims) != 1:
+            raise ValueError(f"Polarizations {list(outputs)} differ in size: {sorted(dims)}")
+        width, height = dims.pop()
+
+        # --- INTERPOLATION PREP ---
+        if HAS_CUDA:
+            print("Using CUDA for LUT Interpolation and Calibration.", flush=True)
+        else:
+            print("GPU Unavailble: Falling back to CPU for LUT Interpolation.", flush=True)
+            if cpu_kernels.HAS_NUMBA:
+                print("Using fused numba kernel for Calibration.", flush=True)
+        states = {pol: self._lut_state(pol, width) for pol in outputs}
 
-        with rio.open(output_path, "r+") as dst:
-            width: int = dst.width
-            height: int = dst.height
-            
-            # --- INTERPOLATION PREP ---
-            lines = np.array([v["line"] for v in cal_vectors])
-            
-            if HAS_CUDA:
-                print("Using CUDA for LUT Interpolation and Calibration.", flush=True)
-                grid_vals_sigma = []
-                grid_vals_noise = []
-                for i, v in enumerate(cal_vectors):
-                    f_s = interp1d(v["pixels"], v["sigma"], kind="linear", fill_value="extrapolate")
-                    grid_vals_sigma.append(f_s(np.arange(width)))
-                    nv = next((n for n in noise_vectors if n["line"] == v["line"]), noise_vectors[min(i, len(noise_vectors)-1)])
-                    f_n = interp1d(nv["pixels"], nv["noise"], kind="linear", fill_value="extrapolate")
-                    grid_vals_noise.append(f_n(np.arange(width)))
-                
-                g_lines = cp.array(lines, dtype=cp.float32)
-                g_lut_sigma = cp.array(grid_vals_sigma, dtype=cp.float32)
-                g_lut_noise = cp.array(grid_vals_noise, dtype=cp.float32)
-                del grid_vals_sigma, grid_vals_noise
-            else:
-                print("GPU Unavailble: Falling back to CPU for LUT Interpolation.", flush=True)
-                grid_values_s = []
-                grid_values_n = []
-                for v in cal_vectors:
-                    f = interp1d(v["pixels"], v["sigma"], kind="linear", fill_value="extrapolate")
-                    grid_values_s.append(f(np.arange(width)))
-                for v in noise_vectors:
-                    f = interp1d(v["pixels"], v["noise"], kind="linear", fill_value="extrapolate")
-                    grid_values_n.append(f(np.arange(width)))
-                
-                cal_func = interp1d(lines, np.array(grid_values_s), axis=0, kind="linear", fill_value="extrapolate")
-                noise_func = interp1d(np.array([v["line"] for v in noise_vectors]), np.array(grid_values_n), axis=0, kind="linear", fill_value="extrapolate")
-                del grid_values_s, grid_values_n
-
-            read_queue: queue.Queue = queue.Queue(maxsize=2)
-            write_queue: queue.Queue = queue.Queue(maxsize=2)
+        read_queue: queue.Queue = queue.Queue(maxsize=2)
+        write_queue: queue.Queue = queue.Queue(maxsize=2)
+
+        with contextlib.ExitStack() as stack:
+            dsts = {pol: stack.enter_context(rio.open(path, "r+")) for pol, path in outputs.items()}
 
             def reader_thread() -> None:
                 try:
-                    # Open source subdataset for reading original DN
-                    with rio.open(sds_string) as t_src:
+                    # Open source subdatasets for reading original DN
+                    with contextlib.ExitStack() as src_stack:
+                        srcs = {pol: src_stack.enter_context(rio.open(sds[pol])) for pol in outputs}
                         for row_off in range(0, height, block_size):
                             rows = min(block_size, height - row_off)
                             window = Window(0, row_off, width, rows)
-                            dn = t_src.read(1, window=window).astype(np.float32)
-                            
-                            if not HAS_CUDA:
-                                current_lines = np.arange(row_off, row_off + rows)
-                                cal_block = cal_func(current_lines).astype(np.float32)
-                                noise_block = noise_func(current_lines).astype(np.float32)
-                                read_queue.put((window, dn, cal_block, noise_block), timeout=120)
-                            else:
-                                read_queue.put((window, dn, row_off, rows), timeout=120)
+                            strip = {}
+                            for pol, t_src in srcs.items():
+                                dn = t_src.read(1, window=window).astype(np.float32)
+                                if not HAS_CUDA:
+                                    state = states[pol]
+                                    strip[pol] = (dn, state["cal"].window(row_off, rows), state["noise"].window(row_off, rows))
+                                else:
+                                    strip[pol] = (dn,)
+                            read_queue.put((window, strip), timeout=120)
                         read_queue.put(None, timeout=120)
                 except Exception as e:
                     print(f"\nCRITICAL: Reader thread failed: {e}", flush=True)
-                    read_queue.put(None)
+                    read_queue.put(func.READ_FAILED)
+
+            write_failed = threading.Event()
 
-            def writer_thread(dst_handle: Any) -> None:
+            def writer_thread() -> None:
                 try:
                     while True:
                         item = write_queue.get(timeout=120)
                         if item is None:
                             write_queue.task_done()
                             break
-                        window, sigma0 = item
-                        dst_handle.write(sigma0, 1, window=window)
+                        window, results = item
+                        for pol, sigma0 in results.items():
+                            dsts[pol].write(sigma0, 1, window=window)
+                        print(f"Processed strip starting at line {window.row_off}/{height}", end="\r", flush=True)
                         write_queue.task_done()
                 except Exception as e:
                     print(f"\nCRITICAL: Writer thread failed: {e}", flush=True)
+                    write_failed.set()
+                    func.drain_writes(write_queue)
+
+            def compute_strip(_worker_id: int, item: Any) -> Any:
+                window, strip = item
+                if HAS_CUDA:
+                    return window, {
+                        pol: self._sigma0_gpu(states[pol], data[0], window.row_off, window.height)
+                        for pol, data in strip.items()
+                    }
+                return window, {pol: self._sigma0_cpu(*data) for pol, data in strip.items()}
 
             t_read = threading.Thread(target=reader_thread, daemon=True)
-            t_write = threading.Thread(target=writer_thread, args=(dst,), daemon=True)
+            t_write = threading.Thread(target=writer_thread, daemon=True)
             t_read.start(); t_write.start()
 
-            while True:
-                try:
-                    item = read_queue.get(timeout=120)
-                except queue.Empty:
-                    print("\nCRITICAL: Reader thread timed out (Deadlock?).", flush=True)
-                    break
-                    
-                if item is None:
-                    write_queue.put(None, timeout=120); read_queue.task_done()
-                    break
-                
-                try:
-                    if HAS_CUDA:
-                        window, dn, row_off, rows = item
-                        m_pool = cp.get_default_memory_pool()
-                        g_dn = cp.array(dn)
-                        g_valid = g_dn > 0
-                        target_lines = cp.arange(row_off, row_off + rows, dtype=cp.float32)
-                        
-                        def gpu_interp_2d(lut):
-                            idx = cp.searchsorted(g_lines, target_lines) - 1
-                            idx = cp.clip(idx, 0, len(lines) - 2)
-                            x0 = g_lines[idx]; x1 = g_lines[idx+1]
-                            weight = (target_lines - x0) / (x1 - x0)
-                            y0 = lut[idx]; y1 = lut[idx+1]
-                            return y0 + weight[:, cp.newaxis] * (y1 - y0)
-
-                        g_cal = gpu_interp_2d(g_lut_sigma)
-                        g_noise = gpu_interp_2d(g_lut_noise)
-                        
-                        g_sigma0 = cp.zeros_like(g_dn)
-                        # Ensure valid pixels are NEVER absolute 0 to preserve nodata=0 meaning
-                        g_sigma0[g_valid] = cp.maximum((cp.square(g_dn[g_valid]) - g_noise[g_valid]) / cp.square(g_cal[g_valid]), 1e-9)
-                        
-                        sigma0 = cp.asnumpy(g_sigma0)
-                        del g_dn, g_valid, g_cal, g_noise, g_sigma0, target_lines
-                        m_pool.free_all_blocks()
-                    else:
-                        window, dn, cal_block, noise_block = item
-                        valid_mask = dn > 0
-                        sigma0 = np.zeros_like(dn)
-                        sigma0[valid_mask] = np.maximum((np.square(dn[valid_mask]) - noise_block[valid_mask]) / np.square(cal_block[valid_mask]), 1e-9)
-
-                    write_queue.put((window, sigma0), timeout=120)
-                except Exception as e:
-                    print(f"\nCRITICAL: Calibration loop failed: {e}", flush=True)
-                    break
-                
-                print(f"Processed strip starting at line {window.row_off}/{height}", end="\r", flush=True)
-                read_queue.task_done()
-
+            # GPU kernels serialize on the device, CPU strips fan out over the workers
+            completed = func.run_compute_stage(
+                read_queue, write_queue, compute_strip, 1 if HAS_CUDA else max(1, workers), "Calibration",
+                write_failed=write_failed,
+            )
             t_read.join(); t_write.join()
+            if not completed or write_failed.is_set():
+                raise RuntimeError(f"Calibration of {list(outputs)} did not complete")
 
             if build_ov:
-                func.perf_logger.start_step(f"S1 Internal Overviews: {os.path.basename(output_path)}")
-                dst.build_overviews([2, 4, 8, 16, 32, 64], rio.enums.Resampling.average)
-                func.perf_logger.end_step()
+                for pol, dst in dsts.items():
+                    func.perf_logger.start_step(f"S1 Internal Overviews: {os.path.basename(outputs[pol])}")
+                    dst.build_overviews([2, 4, 8, 16, 32, 64], rio.enums.Resampling.average)
+                    func.perf_logger.end_step()
 
+        # The closures above still reference the dict, so empty it to free the LUT grids
+        states.clear()
         gc.collect()
-        print(f"\nCalibration complete: {output_path}", flush=True)
+        for output_path in outputs.values():
+            print(f"\nCalibration complete: {output_path}", flush=True)
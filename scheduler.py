@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# scheduler.py from https://github.com/sgofferj/python-sentinel-pipeline
+#
+# Copyright Stefan Gofferje
+#
+# Licensed under the Gnu General Public License Version 3 or higher (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+
+"""
+Product-level scheduler for the Sentinel pipeline.
+Runs independent S1/S2 products concurrently in isolated worker processes.
+Concurrency is bounded by MAX_PARALLEL_PRODUCTS and a memory budget derived from the block size.
+"""
+
+import multiprocessing as mp
+import sys
+from multiprocessing.connection import wait
+from typing import Any, Dict, Iterable, List, Optional, Sized, Tuple
+
+import psutil
+from osgeo import gdal
+
+import constants as c
+import functions as func
+import functions_s1 as s1
+import functions_s2 as s2
+
+gdal.UseExceptions()
+
+# Bytes held per pixel of one render block (inputs, intermediates and outputs)
+BLOCK_BYTES_PER_PX: Dict[str, int] = {"s1": 64, "s2": 160}
+# Blocks in flight per renderer: 2 queued reads + 1 compute + 2 queued writes
+INFLIGHT_BLOCKS: int = 5
+# gdal.Warp memory limits used by the sensor prepare stages (MB)
+WARP_MEMORY_MB: Dict[str, int] = {"s1": 2048, "s2": 256}
+# Interpreter, GDAL cache and finalizer overhead per worker (MB)
+BASE_MEMORY_MB: int = 512
+
+RUNNERS: Dict[str, Any] = {"s1": s1.run_pipeline, "s2": s2.run_pipeline}
+
+
+def estimate_product_memory_mb(sensor: str) -> int:
+    """Estimates the peak memory of a single product run from the render block size."""
+    block_mb = c.BLOCK_SIZE * c.BLOCK_SIZE * BLOCK_BYTES_PER_PX[sensor] / (1024 * 1024)
+    return int(BASE_MEMORY_MB + WARP_MEMORY_MB[sensor] + block_mb * INFLIGHT_BLOCKS)
+
+
+def plan_workers(sensor: str, num_products: Optional[int] = None) -> int:
+    """
+    Returns how many products of a sensor may run at once within the memory budget.
+    num_products is None when products are still arriving from the download stream.
+    """
+    if c.MAX_PARALLEL_PRODUCTS <= 1 or (num_products is not None and num_products <= 1):
+        return 1
+
+    budget_mb = c.PRODUCT_MEMORY_BUDGET_MB
+    if budget_mb <= 0:
+        # Default to 75% of what is currently available
+        budget_mb = int(psutil.virtual_memory().available / (1024 * 1024) * 0.75)
+
+    per_product = estimate_product_memory_mb(sensor)
+    fit = max(1, budget_mb // per_product)
+    workers = int(min(c.MAX_PARALLEL_PRODUCTS, fit))
+    if num_products is not None:
+        workers = min(workers, num_products)
+    print(
+        f"Scheduler: {workers} parallel {sensor.upper()} products "
+        f"(~{per_product}MB each, budget {budget_mb}MB).",
+        flush=True,
+    )
+    return workers
+
+
+def _run_product(
+    sensor: str, manifest: str, processes: List[str], fusion_processes: List[str]
+) -> None:
+    """Opens a product manifest and runs its sensor pipeline in the current process."""
+    ds_obj = gdal.Open(manifest)
+    RUNNERS[sensor](ds_obj, processes, fusion_processes)
+    ds_obj = None
+
+
+def _product_worker(
+    sensor: str, manifest: str, processes: List[str], fusion_processes: List[str]
+) -> None:
+    """Worker process entry point. The exit code reports success to the scheduler."""
+    func.perf_logger.attach_process()
+    try:
+        _run_product(sensor, manifest, processes, fusion_processes)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        print(f"Error processing {sensor.upper()} product {manifest}: {e}", flush=True)
+        sys.exit(1)
+
+
+def run_products(
+    sensor: str,
+    jobs: Iterable[Tuple[Dict[str, Any], str]],
+    processes: List[str],
+    fusion_processes: List[str],
+) -> List[Dict[str, Any]]:
+    """
+    Processes (feature, manifest) jobs of one sensor and returns the successfully processed features.
+    Jobs are consumed lazily, so products can still be arriving from the download stream.
+    A failing or crashing product never affects the other products of the run.
+    """
+    num_products = len(jobs) if isinstance(jobs, Sized) else None
+    workers = plan_workers(sensor, num_products)
+    processed: List[Dict[str, Any]] = []
+
+    if workers <= 1:
+        for feat, manifest in jobs:
+            filename = feat["properties"]["title"]
+            try:
+                _run_product(sensor, manifest, processes, fusion_processes)
+                processed.append(feat)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                print(f"Error processing {sensor.upper()} product {filename}: {e}", flush=True)
+        return processed
+
+    # Fork keeps the parent's configuration without re-importing the orchestrator
+    ctx = mp.get_context("fork")
+    job_iter = iter(jobs)
+    exhausted = False
+    started: List[Dict[str, Any]] = []
+    running: Dict[Any, Tuple[Any, Dict[str, Any]]] = {}
+    succeeded = set()
+
+    while True:
+        while not exhausted and len(running) < workers:
+            job = next(job_iter, None)
+            if job is None:
+                exhausted = True
+                break
+            feat, manifest = job
+            proc = ctx.Process(
+                target=_product_worker,
+                args=(sensor, manifest, processes, fusion_processes),
+                name=f"{sensor}-{feat['properties']['title']}",
+            )
+            proc.start()
+            started.append(feat)
+            running[proc.sentinel] = (proc, feat)
+
+        if not running:
+            break
+
+        for sentinel in wait(list(running.keys())):
+            proc, feat = running.pop(sentinel)
+            proc.join()
+            if proc.exitcode == 0:
+                succeeded.add(id(feat))
+            else:
+                print(
+                    f"{sensor.upper()} product {feat['properties']['title']} failed "
+                    f"(exit code {proc.exitcode}).",
+                    flush=True,
+                )
+
+    # Keep the original product order for the search log
+    processed = [feat for feat in started if id(feat) in succeeded]
+    return processed
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# scratch.py from https://github.com/sgofferj/python-sentinel-pipeline
+#
+# Copyright Stefan Gofferje
+#
+# Licensed under the Gnu General Public License Version 3 or higher (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+
+"""
+Per-product scratch workspaces for intermediate rasters.
+The scratch root is configurable (SCRATCH_DIR) so intermediates can live on tmpfs or NVMe.
+Intermediates are written in the format picked by SCRATCH_FORMAT; they are read back once,
+so codec time on them is pure overhead whenever the scratch space can hold raw data.
+"""
+
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import constants as c
+
+
+_TILED: List[str] = ["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256", "BIGTIFF=YES"]
+
+# Intermediate formats: GDAL driver, extension, required sidecars and creation options
+INTERMEDIATE_FORMATS: Dict[str, Dict[str, Any]] = {
+    "deflate": {"driver": "GTiff", "ext": ".tif", "sidecars": [], "options": _TILED + ["COMPRESS=DEFLATE"]},
+    "zstd": {"driver": "GTiff", "ext": ".tif", "sidecars": [], "options": _TILED + ["COMPRESS=ZSTD", "ZSTD_LEVEL=1"]},
+    "none": {"driver": "GTiff", "ext": ".tif", "sidecars": [], "options": _TILED},
+    # Plain band-sequential binary plus header, can be memory-mapped as (bands, rows, cols)
+    "raw": {"driver": "ENVI", "ext": ".img", "sidecars": [".hdr"], "options": ["INTERLEAVE=BSQ"]},
+}
+
+# Free scratch space required for raw intermediates, as a multiple of their size
+# (outputs and overviews are written while the intermediates exist)
+AUTO_HEADROOM: float = 2.0
+
+
+def memmap_raster(src: Any) -> Optional[np.ndarray]:
+    """
+    Read-only (bands, rows, cols) memory map of a raw intermediate opened with rasterio,
+    or None if the raster is not a band-sequential raw file.
+    """
+    if src.driver != "ENVI" or len(set(src.dtypes)) != 1:
+        return None
+    envi = src.tags(ns="ENVI")
+    if envi.get("interleave", "bsq").lower() != "bsq":
+        return None
+    dtype = np.dtype(src.dtypes[0]).newbyteorder(">" if envi.get("byte_order") == "1" else "<")
+    return np.memmap(
+        src.name,
+        dtype=dtype,
+        mode="r",
+        offset=int(envi.get("header_offset", 0)),
+        shape=(src.count, src.height, src.width),
+    )
+
+
+class BandReader:
+    """
+    Window reads of one band of an intermediate. Raw intermediates are served as views
+    into a memory map (no decode, no copy, pages load in the compute stage that touches
+    them); other formats are read through rasterio.
+    """
+
+    def __init__(self, src: Any, band: int) -> None:
+        self.src: Any = src
+        self.band: int = band
+        mapped = memmap_raster(src)
+        self.view: Optional[np.ndarray] = None if mapped is None else mapped[band - 1]
+
+    @property
+    def mapped(self) -> bool:
+        """True if reads are zero-copy views."""
+        return self.view is not None
+
+    def read(self, window: Any, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Reads a window, into out if given and the band is not memory-mapped."""
+        if self.view is not None:
+            row, col = int(window.row_off), int(window.col_off)
+            return self.view[row : row + int(window.height), col : col + int(window.width)]
+        return self.src.read(self.band, window=window, out=out)
+
+
+class ScratchWorkspace:
+    """
+    Isolated temporary directory for the intermediates of a single product.
+    Removed automatically when used as a context manager, on success and on failure.
+    """
+
+    def __init__(self, label: str, root: Optional[str] = None) -> None:
+        self.label: str = label
+        self.root: str = root or c.DIRS["TMP"]
+        os.makedirs(self.root, exist_ok=True)
+        safe_label = re.sub(r"[^A-Za-z0-9_.-]", "_", label)
+        self.path: str = tempfile.mkdtemp(prefix=f"{safe_label}_", dir=self.root)
+        self.format: str = c.SCRATCH_FORMAT if c.SCRATCH_FORMAT in INTERMEDIATE_FORMATS else "deflate"
+
+    def file(self, name: str) -> str:
+        """Returns the path of an intermediate file inside the workspace."""
+        return os.path.join(self.path, name)
+
+    def choose_format(self, nbytes: int) -> str:
+        """
+        Picks the intermediate format for about nbytes of uncompressed rasters.
+        SCRATCH_FORMAT=auto uses raw when the scratch space has room for it, ZSTD level 1
+        while the data still fits uncompressed, and DEFLATE when space is tight.
+        """
+        if c.SCRATCH_FORMAT == "auto":
+            free = shutil.disk_usage(self.path).free
+            if free >= nbytes * AUTO_HEADROOM:
+                self.format = "raw"
+            elif free >= nbytes:
+                self.format = "zstd"
+            else:
+                self.format = "deflate"
+            print(
+                f"Scratch format: {self.format} ({nbytes / 1e9:.1f} GB of intermediates, "
+                f"{free / 1e9:.1f} GB free)",
+                flush=True,
+            )
+        return self.format
+
+    def raster(self, stem: str) -> str:
+        """File name of an intermediate raster in the workspace format."""
+        return stem + INTERMEDIATE_FORMATS[self.format]["ext"]
+
+    def raster_files(self, stem: str) -> List[str]:
+        """Raster and sidecar file names of an intermediate (e.g. for the stage cache)."""
+        spec = INTERMEDIATE_FORMATS[self.format]
+        return [stem + spec["ext"]] + [stem + ext for ext in spec["sidecars"]]
+
+    def remove_raster(self, *stems: str) -> None:
+        """Removes intermediate rasters with their sidecars and auxiliary files."""
+        for stem in stems:
+            names = self.raster_files(stem)
+            self.remove(*names, names[0] + ".aux.xml")
+
+    def creation(self, tiff: bool = False) -> Tuple[str, List[str]]:
+        """
+        GDAL driver and creation options of intermediate rasters. tiff=True is for
+        rasters that must stay GeoTIFFs (e.g. GCP-referenced swaths); raw maps to none.
+        """
+        fmt = "none" if tiff and self.format == "raw" else self.format
+        spec = INTERMEDIATE_FORMATS[fmt]
+        return spec["driver"], list(spec["options"])
+
+    def creation_profile(self) -> Dict[str, Any]:
+        """Intermediate creation settings as rasterio profile entries."""
+        driver, options = self.creation()
+        profile: Dict[str, Any] = {"driver": driver}
+        for option in options:
+            key, value = option.split("=", 1)
+            if key == "TILED":
+                profile["tiled"] = value == "YES"
+            else:
+                profile[key.lower()] = int(value) if value.isdigit() else value
+        return profile
+
+    def remove(self, *names: str) -> None:
+        """Removes individual intermediates early to free scratch space."""
+        for name in names:
+            path = self.file(name)
+            if os.path.lexists(path):
+                os.remove(path)
+
+    def cleanup(self) -> None:
+        """Removes the workspace and everything in it."""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self) -> "ScratchWorkspace":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.cleanup()
+
+
+def _benchmark(products: List[str], size: int = 8192) -> None:
+    """
+    Times every intermediate format: a synthetic sigma0 + alpha raster written and read
+    back in render blocks, then prepare + render of each S1/S2 product given (manifest.safe
+    or MTD_MSIL2A.xml paths). The stage cache is bypassed.
+    """
+    # pylint: disable=import-outside-toplevel
+    import rasterio as rio
+
+    import stage_cache
+
+    rng = np.random.default_rng(0)
+    data = rng.gamma(1.0, 0.05, (2, size, size)).astype(np.float32)
+    data[1] = 255
+    data[:, :, : size // 8] = 0
+    transform = rio.transform.from_origin(0, 0, 10, 10)
+    stage_cache.cache.max_bytes = 0
+
+    print(f"Synthetic {size}x{size} float32 x2, write + read in {c.BLOCK_SIZE} px blocks:")
+    for fmt in INTERMEDIATE_FORMATS:
+        c.SCRATCH_FORMAT = fmt
+        with ScratchWorkspace("bench") as ws:
+            path = ws.file(ws.raster("bench"))
+            profile = {
+                **ws.creation_profile(),
+                "width": size,
+                "height": size,
+                "count": 2,
+                "dtype": "float32",
+                "nodata": 0,
+                "crs": "EPSG:3857",
+                "transform": transform,
+            }
+            start = time.perf_counter()
+            with rio.open(path, "w", **profile) as dst:
+                for r in range(0, size, c.BLOCK_SIZE):
+                    win = rio.windows.Window(0, r, size, min(c.BLOCK_SIZE, size - r))
+                    dst.write(data[:, r : r + c.BLOCK_SIZE], window=win)
+            t_write = time.perf_counter() - start
+            start = time.perf_counter()
+            with rio.open(path) as src:
+                for r in range(0, size, c.BLOCK_SIZE):
+                    for col in range(0, size, c.BLOCK_SIZE):
+                        src.read(window=rio.windows.Window(col, r, c.BLOCK_SIZE, c.BLOCK_SIZE))
+            t_read = time.perf_counter() - start
+            on_disk = sum(os.path.getsize(ws.file(n)) for n in ws.raster_files("bench"))
+            print(
+                f"  {fmt:8s} write {t_write:6.2f}s  read {t_read:6.2f}s  "
+                f"size {on_disk / data.nbytes * 100:5.1f}%"
+            )
+
+    if products:
+        from osgeo import gdal
+
+        import functions_s1
+        import functions_s2
+
+    for product in products:
+        ds_obj = gdal.Open(product)
+        module = functions_s1 if os.path.basename(product) == "manifest.safe" else functions_s2
+        print(f"{os.path.basename(os.path.dirname(product))}, prepare + render:")
+        for fmt in INTERMEDIATE_FORMATS:
+            c.SCRATCH_FORMAT = fmt
+            out = tempfile.mkdtemp(prefix="bench_out_", dir=c.DIRS["TMP"])
+            ws = ScratchWorkspace("bench")
+            try:
+                start = time.perf_counter()
+                if module is functions_s1:
+                    visual = {p: os.path.join(out, p) for p in ("VV", "VH")}
+                    analytic = {p: os.path.join(out, f"{p}_ANA") for p in ("VV", "VH")}
+                    module.prepare(ds_obj, ws)
+                    t_prepare = time.perf_counter() - start
+                    module._render_internal(ws, visual, analytic)  # pylint: disable=protected-access
+                else:
+                    visual = {p: os.path.join(out, p) for p in ("TCI", "NDVI")}
+                    analytic = {p: os.path.join(out, f"{p}_ANA") for p in ("NDVI", "NDBI")}
+                    sources = module.prepare(ds_obj, ws, module.required_bands(visual, analytic))
+                    t_prepare = time.perf_counter() - start
+                    # pylint: disable-next=protected-access
+                    module._render_internal(sources, visual, analytic, skip_overviews=True)
+                t_total = time.perf_counter() - start
+                print(f"  {fmt:8s} prepare {t_prepare:7.1f}s  total {t_total:7.1f}s")
+            finally:
+                module.cleanup(ws)
+                shutil.rmtree(out, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    _benchmark(sys.argv[1:])
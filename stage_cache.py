@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# stage_cache.py from https://github.com/sgofferj/python-sentinel-pipeline
+#
+# Copyright Stefan Gofferje
+#
+# Licensed under the Gnu General Public License Version 3 or higher (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+
+"""
+Persistent content-addressed cache for expensive stage intermediates.
+Entries are keyed by product id, stage and the settings that affect the result,
+so re-renders of unchanged inputs skip calibration and warping.
+Least recently used entries are evicted once the cache exceeds STAGE_CACHE_MB.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import constants as c
+from scratch import ScratchWorkspace
+
+# Age after which an unfinished staging directory is considered abandoned (s)
+STALE_STAGING_S: float = 86400
+
+
+def _place(src: str, dst: str) -> None:
+    """Hard-links a file (no copy on the same filesystem), falling back to a copy."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _dir_size(path: str) -> int:
+    """Returns the total size of the files in a cache entry."""
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+
+class StageCache:
+    """
+    Cache of stage outputs. Each entry is a directory named after the hash of its key,
+    holding the intermediates of one stage; the directory mtime tracks the last use.
+    """
+
+    def __init__(self, root: Optional[str] = None, max_mb: Optional[int] = None) -> None:
+        self.root: str = root or c.STAGE_CACHE_DIR
+        self.max_bytes: int = (c.STAGE_CACHE_MB if max_mb is None else max_mb) * 1024 * 1024
+
+    @property
+    def enabled(self) -> bool:
+        """The cache is active when a size limit is configured."""
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(product_id: str, stage: str, params: Dict[str, Any]) -> str:
+        """Builds the content address of a stage output from its inputs and settings."""
+        payload = json.dumps(
+            {"product": product_id, "stage": stage, "params": params},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def fetch(self, key: str, ws: ScratchWorkspace, names: Sequence[str]) -> bool:
+        """Places cached intermediates into the workspace. Returns False on a cache miss."""
+        if not self.enabled:
+            return False
+        entry = os.path.join(self.root, key)
+        if not all(os.path.exists(os.path.join(entry, n)) for n in names):
+            return False
+        try:
+            for name in names:
+                ws.remove(name)
+                _place(os.path.join(entry, name), ws.file(name))
+            os.utime(entry)
+        except OSError as e:
+            # Entry evicted by a concurrent product while we were reading it
+            print(f"Stage cache: failed to use entry {key[:12]}: {e}", flush=True)
+            ws.remove(*names)
+            return False
+        print(f"Stage cache hit: {key[:12]} ({', '.join(names)})", flush=True)
+        return True
+
+    def lookup(self, key: str) -> Optional[str]:
+        """Returns the directory of a cache entry for direct (read-only) use, or None."""
+        if not self.enabled:
+            return None
+        entry = os.path.join(self.root, key)
+        try:
+            os.utime(entry)
+        except OSError:
+            return None
+        return entry
+
+    def drop(self, key: str) -> None:
+        """Removes an outdated entry so a fresh one can be stored under the same key."""
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+    def store(self, key: str, ws: ScratchWorkspace, names: Sequence[str]) -> None:
+        """Adds workspace intermediates to the cache and evicts old entries if needed."""
+        if not self.enabled:
+            return
+        entry = os.path.join(self.root, key)
+        if os.path.exists(entry):
+            return
+        os.makedirs(self.root, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=".staging_", dir=self.root)
+        try:
+            for name in names:
+                _place(ws.file(name), os.path.join(staging, name))
+            # Atomic publish; a concurrent product may have stored the same entry
+            os.rename(staging, entry)
+            print(f"Stage cache: stored {key[:12]} ({', '.join(names)})", flush=True)
+        except OSError as e:
+            print(f"Stage cache: could not store {key[:12]}: {e}", flush=True)
+            shutil.rmtree(staging, ignore_errors=True)
+        self.evict()
+
+    def evict(self) -> None:
+        """Removes least recently used entries until the cache fits its size limit."""
+        entries: List[Tuple[float, int, str]] = []
+        for entry in os.scandir(self.root):
+            try:
+                mtime = entry.stat().st_mtime
+                if entry.name.startswith(".staging_"):
+                    # Left behind by a crashed product
+                    if time.time() - mtime > STALE_STAGING_S:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                elif entry.is_dir():
+                    entries.append((mtime, _dir_size(entry.path), entry.path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            print(f"Stage cache: evicting {os.path.basename(path)[:12]}", flush=True)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+# Global singleton
+cache = StageCache()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# conftest.py from https://github.com/sgofferj/python-sentinel-pipeline
+#
+# Copyright Stefan Gofferje
+#
+# Licensed under the Gnu General Public License Version 3 or higher (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+
+"""Shared fixtures: a local stand-in for the CDSE download and token endpoints."""
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import pytest
+
+# The pipeline modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Size of each fake product and the pause between streamed chunks (keeps downloads overlapping)
+PRODUCT_SIZE: int = 3 * 1024 * 1024 + 123
+CHUNK_DELAY: float = 0.01
+
+
+class StandIn(ThreadingHTTPServer):
+    """Local server with fake products and a token endpoint that counts its requests."""
+
+    daemon_threads = True
+
+    def __init__(self, products: Dict[str, bytes]) -> None:
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.products = products
+        self.lock = threading.Lock()
+        self.ranges: List[Tuple[str, Optional[str]]] = []
+        self.token_requests: int = 0
+        self.active: int = 0
+        self.max_active: int = 0
+
+    @property
+    def url(self) -> str:
+        """Base URL of the running server."""
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: StandIn
+
+    def log_message(self, *_args: Any) -> None:  # pylint: disable=arguments-differ
+        pass
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        """Token endpoint: hands out a new access/refresh token pair."""
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.token_requests += 1
+            n = self.server.token_requests
+        body = json.dumps({"access_token": f"access-{n}", "refresh_token": f"refresh-{n}"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """Product download with single byte-range support."""
+        match = re.match(r"/Products\((.+)\)/\$value", self.path)
+        if not match or match.group(1) not in self.server.products:
+            self.send_error(404)
+            return
+        if not self.headers.get("Authorization", "").startswith("Bearer access-"):
+            self.send_error(401)
+            return
+        uuid = match.group(1)
+        data = self.server.products[uuid]
+        range_header = self.headers.get("Range")
+        with self.server.lock:
+            self.server.ranges.append((uuid, range_header))
+            self.server.active += 1
+            self.server.max_active = max(self.server.max_active, self.server.active)
+        try:
+            start, end = 0, len(data) - 1
+            if range_header:
+                first, last = re.match(r"bytes=(\d+)-(\d*)", range_header).groups()
+                start, end = int(first), int(last) if last else len(data) - 1
+                if start >= len(data):
+                    self.send_error(416)
+                    return
+                end = min(end, len(data) - 1)
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            for pos in range(start, end + 1, 256 * 1024):
+                self.wfile.write(data[pos : min(pos + 256 * 1024, end + 1)])
+                time.sleep(CHUNK_DELAY)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+
+@pytest.fixture
+def stand_in() -> Iterator[StandIn]:
+    """Running stand-in server with five random products uuid-0 .. uuid-4."""
+    server = StandIn({f"uuid-{i}": os.urandom(PRODUCT_SIZE) for i in range(5)})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cop(stand_in: StandIn, monkeypatch: pytest.MonkeyPatch) -> Any:
+    """CDSE connection logged in to the stand-in."""
+    from copernicus import connect  # pylint: disable=import-outside-toplevel
+
+    monkeypatch.setattr(connect, "download_url", stand_in.url + "/Products({uuid})/$value")
+    monkeypatch.setattr(connect, "token_url", stand_in.url + "/token")
+    return connect("user", "password")
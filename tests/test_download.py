@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# test_download.py from https://github.com/sgofferj/python-sentinel-pipeline
+#
+# Copyright Stefan Gofferje
+#
+# Licensed under the Gnu General Public License Version 3 or higher (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at https://www.gnu.org/licenses/gpl-3.0.en.html
+#
+
+"""Resumed, segmented and concurrent product downloads against the local stand-in."""
+
+import os
+import time
+
+from conftest import PRODUCT_SIZE
+
+
+def _read(directory: str, uuid: str) -> bytes:
+    with open(os.path.join(directory, f"{uuid}.zip"), "rb") as f:
+        return f.read()
+
+
+def test_resume_from_part(cop, stand_in, tmp_path):
+    part = stand_in.products["uuid-0"][:1000000]
+    (tmp_path / "uuid-0.zip.part").write_bytes(part)
+
+    assert cop.download("uuid-0", "uuid-0", str(tmp_path))
+    assert _read(str(tmp_path), "uuid-0") == stand_in.products["uuid-0"]
+    # Only the missing tail was requested and transferred
+    assert stand_in.ranges[-1] == ("uuid-0", "bytes=1000000-")
+    assert cop.last_stats["uuid-0"]["bytes"] == PRODUCT_SIZE - len(part)
+
+
+def test_segmented_download(cop, stand_in, tmp_path):
+    assert cop.download("uuid-1", "uuid-1", str(tmp_path), segments=4)
+    assert _read(str(tmp_path), "uuid-1") == stand_in.products["uuid-1"]
+    # The bytes=0-0 probe aside, one range request per segment
+    assert len([r for _, r in stand_in.ranges if r != "bytes=0-0"]) == 4
+    assert not any(".zip." in f for f in os.listdir(tmp_path))
+
+
+def test_download_many(cop, stand_in, tmp_path):
+    pending = [(uuid, uuid) for uuid in ("uuid-2", "uuid-3", "uuid-4")]
+    tokens = stand_in.token_requests
+    done = []
+    started = []
+    for uuid, success in cop.download_many(pending, str(tmp_path), workers=2):
+        done.append((uuid, success))
+        # Slow consumer: no further download may start while it is busy
+        time.sleep(1.0)
+        started.append(len({u for u, _ in stand_in.ranges}))
+
+    assert sorted(done) == [(uuid, True) for uuid, _ in pending]
+    assert all(_read(str(tmp_path), uuid) == stand_in.products[uuid] for uuid, _ in pending)
+    assert stand_in.max_active == 2
+    assert started[0] == 2
+    # A fresh token for every product
+    assert stand_in.token_requests - tokens == len(pending)